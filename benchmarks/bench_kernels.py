@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the in-process Python kernels of the pipeline on synthetic phantoms
+(see phantoms.py): wall time, peak memory and throughput per kernel.
+
+    python benchmarks/bench_kernels.py                          # all kernels, 400^3 neonatal sizes
+    python benchmarks/bench_kernels.py --size small m_5tt       # quick run of one kernel
+    python benchmarks/bench_kernels.py --json after.json --compare before.json
+    python benchmarks/bench_kernels.py seg_save_serial seg_save   # writing the outputs of a stage:
+                                                                  # nibabel one after another vs. image_writer.py
+
+Every kernel runs in a fresh process, so the peak memory of one kernel does not
+hide the next one. The phantom is created before the clock starts; peak memory
+is the high-water mark of the resident memory while the kernel runs (including
+the phantom it works on). A kernel whose packages are missing (dipy, keras,
+antspyx) is reported as skipped. With --compare the run fails (exit code 1) if
+a kernel got slower than the baseline by more than --tolerance.
+
+@author: anna speckert
+"""
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import multiprocessing
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # pipe_helpers
+
+
+###############
+### KERNELS ###
+###############
+# Every kernel gets the preset (image sizes) and returns (function to time, number of processed voxels).
+# Imports of the pipeline modules are inside, a missing package only skips the kernel.
+
+def fivett_image(probabilities):
+    # the 5tt image as build_5tt computes it, from the labels in memory instead of the label files
+    import numpy as np
+    from pipe_helpers.make_5tt import LABEL_TISSUES, correct_slabs
+    fivett = np.zeros(probabilities.shape[:3] + (5,), dtype=np.float32, order="F")
+    for label in range(1, 9):
+        fivett[:, :, :, LABEL_TISSUES[label]] += probabilities[:, :, :, label - 1]
+    return correct_slabs(fivett)
+
+
+def kernel_m_5tt(preset):
+    import phantoms
+    probabilities = phantoms.label_probabilities(preset["t2"])
+
+    def run():
+        fivett_image(probabilities)
+    return run, probabilities.size
+
+
+def kernel_m_5tt_fromAbs(preset):
+    import numpy as np
+    import phantoms
+    from pipe_helpers.make_5tt_fromAbsolute import labels_to_5tt
+    labels = phantoms.label_image(preset["t2"]).astype(np.float64) # as returned by get_fdata
+
+    def run():
+        labels_to_5tt(labels)
+    return run, labels.size
+
+
+def kernel_m_5tt_slabs(preset):
+    # the 5tt step as it runs: from the 8 label files on disk to 5tt.nii.gz (compare the peak memory with m_5tt)
+    import tempfile
+    import numpy as np
+    import phantoms
+    from pipe_helpers import image_writer
+    from pipe_helpers.make_5tt import build_5tt
+    probabilities = phantoms.label_probabilities(preset["t2"])
+    label_dir = tempfile.mkdtemp()
+    label_paths = [label_dir + "/label_prob_" + str(k) + ".nii.gz" for k in range(1, 9)]
+    for k, path in enumerate(label_paths):
+        image_writer.save(probabilities[:, :, :, k], path, np.diag([0.4, 0.4, 0.4, 1.0]))
+    voxels = probabilities.size
+    del probabilities
+
+    def run():
+        build_5tt(label_paths, label_dir + "/5tt.nii.gz")
+    return run, voxels
+
+
+def kernel_patch2self(preset):
+    import numpy as np
+    import phantoms
+    from pipe_helpers.Denoising_DWI import denoise
+    dwi, bvals, _ = phantoms.dwi_image(preset["dwi"], preset["n_b0"], preset["n_dirs"])
+    dwi = np.asfortranarray(dwi, dtype=np.float32) # as the denoising step loads it
+
+    def run():
+        denoise(dwi, bvals)
+    return run, dwi.size
+
+
+def kernel_patch2self_dipy(preset):
+    # dipy's patch2self with the settings of the pipeline, the reference of patch2self (see bench_patch2self.py for the outputs)
+    import dipy # a missing dipy skips the kernel
+    import phantoms
+    from bench_patch2self import dipy_patch2self
+    dwi, bvals, _ = phantoms.dwi_image(preset["dwi"], preset["n_b0"], preset["n_dirs"])
+
+    def run():
+        dipy_patch2self(dwi, bvals)
+    return run, dwi.size
+
+
+def kernel_unet(preset):
+    import phantoms
+    from pipe_helpers.neonatal_segmentation_single_file_probabilityLabels import load_model, predict_probabilities
+    t2 = phantoms.t2_image((400, 400, preset["unet_slices"])) # the UNet only takes 400x400 slices
+    model = load_model(None) # random weights: the time does not depend on the trained values
+
+    def run():
+        predict_probabilities(model, t2, margin=None) # all slices as a whole
+    return run, t2.size
+
+
+def kernel_unet_crop(preset):
+    # skull-stripped T2 with a newborn brain (~100 mm) in the 160 mm field of view: only the slices and the box with brain are segmented
+    import phantoms
+    from pipe_helpers.neonatal_segmentation_single_file_probabilityLabels import load_model, predict_probabilities
+    shape = (400, 400, preset["unet_slices"])
+    t2 = phantoms.t2_image(shape) * (phantoms.label_image(shape, scale=0.7) > 0)
+    model = load_model(None)
+
+    def run():
+        predict_probabilities(model, t2)
+    return run, t2.size
+
+
+def kernel_label_warp(preset):
+    import tempfile
+    import numpy as np
+    import ants
+    import phantoms
+    from pipe_helpers.neonatal_parcellation import warp_labels
+    shape = preset["t2"]
+    fixed = ants.from_numpy(phantoms.t2_image(shape), spacing=(0.4, 0.4, 0.4))
+    moving = ants.from_numpy(phantoms.label_image(shape).astype(np.float32), spacing=(0.4, 0.4, 0.4))
+    # a small rotation and scaling around the image centre instead of the SyN warp of a real registration
+    angle = np.deg2rad(5)
+    matrix = 1.05 * np.array([[np.cos(angle), -np.sin(angle), 0], [np.sin(angle), np.cos(angle), 0], [0, 0, 1]])
+    centre = [0.4 * (size - 1) / 2.0 for size in shape]
+    transform = ants.create_ants_transform(transform_type="AffineTransform", dimension=3, matrix=matrix, center=centre)
+    transform_file = tempfile.NamedTemporaryFile(suffix=".mat", delete=False).name
+    ants.write_transform(transform, transform_file)
+
+    def run():
+        warp_labels(fixed, moving, [transform_file])
+    return run, int(np.prod(shape))
+
+
+def output_images(stage, preset):
+    # the images the segmentation resp. the 5tt stage writes, as (name, array)
+    import numpy as np
+    import phantoms
+    probabilities = phantoms.label_probabilities(preset["t2"])
+    if stage == "segmentation":
+        return [("T2_SVRTK_reformatted_labels.nii.gz", np.argmax(probabilities, axis=3).astype(np.uint8))] + \
+               [("label_prob_" + str(k) + ".nii.gz", probabilities[:, :, :, k - 1].astype(np.float32, order="F")) for k in range(1, 9)]
+    return [("5tt.nii.gz", fivett_image(probabilities))]
+
+
+def saving_kernel(stage, parallel):
+    # wall time of writing the outputs of a stage: one after another with nibabel (as before) resp. with image_writer
+    def kernel(preset):
+        import tempfile
+        import numpy as np
+        import nibabel as nib
+        from pipe_helpers import image_writer
+        images = output_images(stage, preset)
+        out_dir = tempfile.mkdtemp()
+        affine = np.diag([0.4, 0.4, 0.4, 1.0])
+
+        def run():
+            if parallel:
+                with image_writer.saving() as saves:
+                    for name, data in images:
+                        saves.submit(image_writer.save, data, out_dir + "/" + name, affine)
+            else:
+                for name, data in images:
+                    nib.save(nib.Nifti1Image(data, affine), out_dir + "/" + name)
+        return run, sum(data.size for _, data in images)
+    return kernel
+
+
+KERNELS = {"m_5tt": kernel_m_5tt,
+           "m_5tt_slabs": kernel_m_5tt_slabs,
+           "m_5tt_fromAbs": kernel_m_5tt_fromAbs,
+           "patch2self": kernel_patch2self,
+           "patch2self_dipy": kernel_patch2self_dipy,
+           "unet": kernel_unet,
+           "unet_crop": kernel_unet_crop,
+           "label_warp": kernel_label_warp,
+           "seg_save_serial": saving_kernel("segmentation", False),
+           "seg_save": saving_kernel("segmentation", True),
+           "5tt_save_serial": saving_kernel("5tt", False),
+           "5tt_save": saving_kernel("5tt", True)}
+
+
+###############
+### RUNNING ###
+###############
+
+def reset_peak_rss():
+    # Linux: "5" resets the high-water mark (VmHWM) of the resident memory
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # KB on Linux, bytes on macOS
+    return peak / 1024.0**2 if sys.platform == "darwin" else peak / 1024.0
+
+
+def measure(name, size, repeat, results):
+    # runs in a fresh process
+    try:
+        import phantoms
+        tic = time.perf_counter()
+        run, voxels = KERNELS[name](phantoms.PRESETS[size])
+        setup_seconds = time.perf_counter() - tic
+    except ImportError as error:
+        results.put({"kernel": name, "skipped": str(error)})
+        return
+    input_mb = peak_rss_mb()
+    if not reset_peak_rss():
+        print("The peak memory of", name, "includes the creation of the phantom.")
+    times = []
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - tic)
+    results.put({"kernel": name, "size": size, "voxels": voxels, "setup_s": round(setup_seconds, 2),
+                 "wall_s": round(min(times), 3), "mean_s": round(sum(times) / len(times), 3),
+                 "peak_rss_mb": round(peak_rss_mb(), 1), "input_rss_mb": round(input_mb, 1),
+                 "mvox_per_s": round(voxels / min(times) / 1e6, 2)})
+
+
+def run_kernel(name, size, repeat):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=measure, args=(name, size, repeat, results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        return {"kernel": name, "failed": "exit code " + str(process.exitcode)}
+    return results.get()
+
+
+def compare(results, baseline_file, tolerance):
+    """Prints the change against a baseline run. Returns the names of the kernels which got slower."""
+    with open(baseline_file) as jsonfile:
+        baseline = {result["kernel"]: result for result in json.load(jsonfile) if "wall_s" in result}
+    slower = []
+    for result in results:
+        before = baseline.get(result["kernel"])
+        if "wall_s" not in result or before is None or before["size"] != result["size"]:
+            continue
+        change = result["wall_s"] / before["wall_s"] - 1
+        memory = result["peak_rss_mb"] / before["peak_rss_mb"] - 1
+        print("{:<15s} time {:+7.1%}   peak memory {:+7.1%}".format(result["kernel"], change, memory))
+        if change > tolerance:
+            slower.append(result["kernel"])
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the Python kernels of the pipeline on synthetic phantoms.")
+    parser.add_argument("kernels", nargs="*", help="kernels to run (default: all): " + ", ".join(KERNELS))
+    parser.add_argument("--size", default="neonatal", choices=["neonatal", "small"], help="phantom sizes (see phantoms.PRESETS)")
+    parser.add_argument("--repeat", type=int, default=1, help="timed runs per kernel (the fastest counts)")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results of an earlier run (--json) to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed slow-down against --compare (0.15 = 15 %%)")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.kernels if name not in KERNELS]
+    if unknown:
+        parser.error("unknown kernels: " + ", ".join(unknown))
+
+    results = []
+    print("{:<15s} {:>10s} {:>10s} {:>12s} {:>10s}".format("kernel", "wall [s]", "Mvox/s", "peak [MB]", "setup [s]"))
+    for name in args.kernels or list(KERNELS):
+        result = run_kernel(name, args.size, args.repeat)
+        results.append(result)
+        if "wall_s" in result:
+            print("{:<15s} {:>10.3f} {:>10.2f} {:>12.1f} {:>10.2f}".format(name, result["wall_s"], result["mvox_per_s"], result["peak_rss_mb"], result["setup_s"]))
+        else:
+            print("{:<15s} {}".format(name, "skipped (" + result["skipped"] + ")" if "skipped" in result else "failed (" + result["failed"] + ")"))
+
+    if args.json:
+        with open(args.json, "w") as jsonfile:
+            json.dump(results, jsonfile, indent=1)
+    if args.compare:
+        slower = compare(results, args.compare, args.tolerance)
+        if slower:
+            print("Slower than the baseline:", ", ".join(slower))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Equivalence check of the patch2self of the pipeline (denoise in
+pipe_helpers/Denoising_DWI.py, computed from the covariance of the volumes)
+against a plain least-squares reference on a synthetic DWI (see phantoms.py):
+
+    python benchmarks/bench_patch2self.py                      # small phantom, all voxels and brain mask
+    python benchmarks/bench_patch2self.py --size neonatal --tolerance 1e-5 --json patch2self.json
+
+The reference does what dipy's patch2self does with the settings of the
+pipeline (model 'ols', patch radius 0, b0 threshold 50, shift_intensity):
+every volume of a group (b0 resp. diffusion weighted) is fitted by least
+squares with an intercept on all other volumes of its group, one volume after
+the other over all voxels, and replaced by the prediction shifted to the
+minimum of the original. With the mask the fit only uses the voxels of the
+mask and the background keeps its values, as with "denoising_mask": "yes".
+If dipy is installed, the output for all voxels is compared with dipy's
+patch2self as well (in newer dipy versions with its version 1, the algorithm of
+dipy 1.5 which the pipeline pins, and the intensity shift of dipy 1.5 applied).
+
+Reported per case: time of both, the largest absolute difference and the
+largest difference relative to the intensity range of the image. The exit
+code is 1 if a relative difference is above --tolerance, so a change of the
+covariance computation cannot drift away from the reference unnoticed.
+
+@author: anna speckert
+"""
+import os
+import sys
+import json
+import time
+import inspect
+import argparse
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # pipe_helpers
+
+B0_THRESHOLD = 50 # as in Denoising_DWI.py
+
+
+def reference_patch2self(data, bvals, mask=None):
+    """Leave-one-volume-out least squares fit of every volume, as in dipy's patch2self (see above)."""
+    import numpy as np
+    shape = data.shape
+    voxels = np.reshape(data, (-1, shape[3]), order='F').astype(float)
+    rows = np.arange(len(voxels)) if mask is None else np.flatnonzero(np.ravel(mask, order='F'))
+    denoised = voxels.copy()
+    for group in (np.flatnonzero(bvals <= B0_THRESHOLD), np.flatnonzero(bvals > B0_THRESHOLD)):
+        if len(group) < 2: # a single b0 volume is not denoised
+            continue
+        fitted = voxels[np.ix_(rows, group)]
+        for position, volume in enumerate(group):
+            others = np.delete(fitted, position, axis=1)
+            design = np.column_stack((others, np.ones(len(rows)))) # ols with intercept
+            coefficients = np.linalg.lstsq(design, fitted[:, position], rcond=None)[0]
+            prediction = design @ coefficients
+            denoised[rows, volume] = prediction + (fitted[:, position].min() - prediction.min()) # shift_intensity
+    return np.reshape(denoised, shape, order='F')
+
+
+def dipy_patch2self(data, bvals):
+    """dipy's patch2self with the settings of the pipeline, as dipy 1.5 computes it (see above)."""
+    import numpy as np
+    from dipy.denoise.patch2self import patch2self
+    keywords = {"version": 1} if "version" in inspect.signature(patch2self).parameters else {}
+    denoised = patch2self(data, bvals, model='ols', shift_intensity=True, clip_negative_vals=False, b0_threshold=B0_THRESHOLD, **keywords)
+    # shift_intensity of dipy 1.5, a no-op in later versions: the minimum of every volume is the one of the original
+    return denoised + (data.min(axis=(0, 1, 2)) - denoised.min(axis=(0, 1, 2)))
+
+
+def difference(result, reference, data):
+    import numpy as np
+    absolute = float(np.abs(np.asarray(result, dtype=float) - reference).max())
+    return {"max_abs_difference": absolute, "max_rel_difference": absolute / float(data.max() - data.min())}
+
+
+def main():
+    import numpy as np
+    import phantoms
+    from pipe_helpers.Denoising_DWI import denoise
+    parser = argparse.ArgumentParser(description="patch2self of the pipeline against a least-squares reference (and dipy, if installed).")
+    parser.add_argument("--size", default="small", choices=["neonatal", "small"], help="phantom sizes (see phantoms.PRESETS)")
+    parser.add_argument("--tolerance", type=float, default=1e-5, help="largest difference relative to the intensity range that passes")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    preset = phantoms.PRESETS[args.size]
+    dwi, bvals, _ = phantoms.dwi_image(preset["dwi"], preset["n_b0"], preset["n_dirs"])
+    order = np.argsort(np.arange(len(bvals)) % (preset["n_dirs"] // preset["n_b0"] + 1), kind="stable")[::-1] # b0s spread over the series
+    dwi, bvals = np.asfortranarray(dwi[..., order], dtype=np.float32), bvals[order] # as the denoising step loads it
+    brain = phantoms.label_image(preset["dwi"]) > 0
+    print("DWI", dwi.shape, "with", int((bvals <= B0_THRESHOLD).sum()), "b0 volumes, brain mask of", int(brain.sum()), "voxels")
+
+    results = []
+    print("{:<18}{:>12}{:>14}{:>14}{:>14}".format("case", "time_s", "reference_s", "max_abs", "max_rel"))
+    for case, mask in (("all voxels", None), ("brain mask", brain)):
+        tic = time.perf_counter()
+        denoised = denoise(dwi, bvals, mask)
+        seconds = time.perf_counter() - tic
+        tic = time.perf_counter()
+        reference = reference_patch2self(dwi, bvals, mask)
+        reference_s = time.perf_counter() - tic
+        results.append(dict(difference(denoised, reference, dwi), case=case, size=args.size, seconds=round(seconds, 3), reference_seconds=round(reference_s, 3)))
+    tic = time.perf_counter()
+    try:
+        reference = dipy_patch2self(dwi.astype(float), bvals)
+    except ImportError:
+        print("dipy is not installed, the comparison with dipy's patch2self is skipped.")
+    else:
+        reference_s = time.perf_counter() - tic
+        seconds = results[0]["seconds"]
+        results.append(dict(difference(denoise(dwi, bvals), reference, dwi), case="dipy, all voxels", size=args.size, seconds=seconds, reference_seconds=round(reference_s, 3)))
+
+    failed = False
+    for result in results:
+        above = result["max_rel_difference"] > args.tolerance
+        failed = failed or above
+        print("{:<18}{:>12.3f}{:>14.3f}{:>14.3g}{:>14.3g}{}".format(result["case"], result["seconds"], result["reference_seconds"],
+              result["max_abs_difference"], result["max_rel_difference"], "  above " + str(args.tolerance) if above else ""))
+
+    if args.json:
+        with open(args.json, "w") as jsonfile:
+            json.dump(results, jsonfile, indent=1)
+    if failed:
+        print("\nThe patch2self of the pipeline differs from the reference by more than", args.tolerance, "of the intensity range.")
+    else:
+        print("\nThe patch2self of the pipeline matches the reference within", args.tolerance, "of the intensity range.")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
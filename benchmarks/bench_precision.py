@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Accuracy harness of the reduced-precision modes of the neonatal segmentation
+(config "segmentation_precision", see PRECISIONS in
+pipe_helpers/neonatal_segmentation_single_file_probabilityLabels.py):
+
+    python benchmarks/bench_precision.py sub-01/processing/t2/T2_SVRTK_reformatted.nii.gz ... [--modes bfloat16 int8]
+                                         [--min-dice 0.98] [--json precision.json]
+
+Every reference volume (reformatted T2 images of own subjects) is segmented
+in float32 and in every mode. Reported per volume and mode: inference time,
+speed-up against float32, Dice of every label (1-8) against the float32
+labels and the largest difference of the label probabilities. The exit code
+is 1 if the Dice of a label is below --min-dice in some volume, so a mode is
+only chosen with evidence. Needs TensorFlow, medpy and the trained weights
+(--ckpt, default neonate_seg_tf2_v4.h5 in the working directory).
+
+@author: anna speckert
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # pipe_helpers
+
+LABELS = range(1, 9) # gm, wm, ext_csf, vent, brainstem, cerebellum, deep gm, hippocampus (0: not brain)
+
+
+def dice(reference, labels, label):
+    """Dice coefficient of one label (None if it is in neither image)."""
+    import numpy as np
+    a = reference == label
+    b = labels == label
+    total = int(a.sum()) + int(b.sum())
+    return None if total == 0 else 2.0 * int(np.logical_and(a, b).sum()) / total
+
+
+def compare(reference, outputs):
+    """Dice of every label and largest probability difference of outputs against the float32 reference (SegmentationOutputs)."""
+    import numpy as np
+    result = {"dice": {str(label): dice(reference.labels, outputs.labels, label) for label in LABELS}}
+    result["max_probability_difference"] = float(max(np.abs(a - b).max() for a, b in zip(reference.probabilities, outputs.probabilities)))
+    return result
+
+
+def segment(model, image_data, margin):
+    from pipe_helpers.neonatal_segmentation_single_file_probabilityLabels import predict_probabilities
+    tic = time.perf_counter()
+    outputs = predict_probabilities(model, image_data, margin=margin)
+    return outputs, time.perf_counter() - tic
+
+
+def main():
+    from pipe_helpers import neonatal_segmentation_single_file_probabilityLabels as segmentation
+    parser = argparse.ArgumentParser(description="Dice and speed of the reduced-precision segmentation against float32.")
+    parser.add_argument("volumes", nargs="+", help="reference T2 images (T2_SVRTK_reformatted.nii.gz)")
+    parser.add_argument("--modes", nargs="+", default=[mode for mode in segmentation.PRECISIONS if mode != "float32"],
+                        choices=segmentation.PRECISIONS[1:], help="precisions to compare with float32")
+    parser.add_argument("--ckpt", default=segmentation.ckpt_path, help="trained weights")
+    parser.add_argument("--margin", default=str(segmentation.CROP_MARGIN), help="crop margin as in the config (none: whole slices)")
+    parser.add_argument("--min-dice", type=float, default=0.98, help="smallest Dice of a label that passes")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    from medpy.io import load
+    margin = segmentation.crop_margin(args.margin)
+    models = {}
+    for mode in ["float32"] + args.modes: # every model is built once, the Keras ones keep their own precision
+        tic = time.perf_counter()
+        models[mode] = segmentation.load_model(args.ckpt, mode)
+        print("Loaded", mode, "in", round(time.perf_counter() - tic, 1), "s")
+
+    results = []
+    failed = False
+    for path in args.volumes:
+        image_data, _ = load(path)
+        reference, reference_s = segment(models["float32"], image_data, margin)
+        print("\n" + path + ": float32", round(reference_s, 1), "s")
+        print("{:<10}{:>8}{:>9}{:>11}  {}".format("mode", "time_s", "speedup", "max_dprob", "Dice of the labels 1-8 (- : label in neither)"))
+        for mode in args.modes:
+            outputs, seconds = segment(models[mode], image_data, margin)
+            result = dict(compare(reference, outputs), volume=path, mode=mode, seconds=round(seconds, 2),
+                          speedup=round(reference_s / seconds, 2), float32_seconds=round(reference_s, 2))
+            del outputs
+            low = [label for label, value in result["dice"].items() if value is not None and value < args.min_dice]
+            failed = failed or bool(low)
+            print("{:<10}{:>8.1f}{:>9.2f}{:>11.4f}  {}{}".format(mode, seconds, result["speedup"], result["max_probability_difference"],
+                  " ".join("-" if value is None else "{:.4f}".format(value) for value in result["dice"].values()),
+                  "  below " + str(args.min_dice) + ": " + ", ".join(low) if low else ""))
+            results.append(result)
+        del reference
+
+    if args.json:
+        with open(args.json, "w") as jsonfile:
+            json.dump(results, jsonfile, indent=1)
+    if failed:
+        print("\nSome labels stay below a Dice of", args.min_dice, "(see above).")
+    else:
+        print("\nAll labels reach a Dice of", args.min_dice, "in every volume.")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
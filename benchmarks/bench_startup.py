@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Startup benchmark: how long it takes before the pipeline does any work.
+
+    python benchmarks/bench_startup.py [--runs 5] [--subjects 50]
+
+Measures in fresh interpreters (median over --runs):
+    import DTI_Pipeline          what every run and every spawned worker pays
+    DTI_Pipeline.py --status     a status query over --subjects empty subjects
+    worker import                the modules a worker needs to unpickle a stage
+and checks that none of the heavy backends (numpy, nibabel, dipy, antspyx,
+matplotlib, Keras/TensorFlow, ...) is imported before a stage using it runs
+(see BACKENDS in pipe_helpers/subject_processing.py). Exit code 1 if one is.
+
+@author: anna speckert
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+import statistics
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ["numpy", "scipy", "nibabel", "dipy", "ants", "matplotlib", "keras", "tensorflow", "medpy"]
+
+# builds the stages of the default config and prints the heavy modules which were imported
+CHECK_IMPORTS = """
+import sys, json
+sys.path[0] = {repo!r}
+import DTI_Pipeline
+from pipe_helpers.pipeline_stages import build_stages
+configurations = json.load(open({config!r}))
+build_stages(configurations, [])
+print(json.dumps(sorted(name for name in {heavy!r} if name in sys.modules)))
+"""
+
+
+def timed(command, cwd, runs):
+    times = []
+    for _ in range(runs):
+        tic = time.perf_counter()
+        subprocess.run(command, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - tic)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time of DTI_Pipeline.py and its helpers.")
+    parser.add_argument("--runs", type=int, default=5, help="runs per measurement (the median counts)")
+    parser.add_argument("--subjects", type=int, default=50, help="number of (empty) subjects for the status query")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench_startup_")
+    try:
+        base_dir = work_dir + "/base"
+        for number in range(args.subjects):
+            os.makedirs(base_dir + "/subj" + str(number).zfill(3))
+        with open(REPO + "/config_dti.json") as jsonfile:
+            configurations = json.load(jsonfile)
+        configurations["base_dir"] = base_dir
+        with open(work_dir + "/config_dti.json", "w") as jsonfile:
+            json.dump(configurations, jsonfile)
+
+        python = sys.executable
+        results = [("python itself", timed([python, "-c", "pass"], work_dir, args.runs)),
+                   ("import DTI_Pipeline", timed([python, "-c", "import sys; sys.path[0] = " + repr(REPO) + "; import DTI_Pipeline"], work_dir, args.runs)),
+                   ("worker import", timed([python, "-c", "import sys; sys.path[0] = " + repr(REPO) + "; import pipe_helpers.subject_processing, pipe_helpers.stage_graph"], work_dir, args.runs)),
+                   ("--status (" + str(args.subjects) + " subjects)", timed([python, REPO + "/DTI_Pipeline.py", "--status"], work_dir, args.runs))]
+        for name, seconds in results:
+            print("{:<28s} {:8.3f} s".format(name, seconds))
+
+        check = CHECK_IMPORTS.format(repo=REPO, config=work_dir + "/config_dti.json", heavy=HEAVY_MODULES)
+        imported = json.loads(subprocess.run([python, "-c", check], cwd=work_dir, check=True, capture_output=True, text=True).stdout.strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(work_dir)
+
+    if imported:
+        print("Imported at startup although no stage ran:", ", ".join(imported))
+        sys.exit(1)
+    print("No heavy backend is imported at startup.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic phantoms for the benchmarks: a brain made of nested ellipsoids with
+the 8 labels of the neonatal UNet, the matching T2 image, label probabilities
+and a single-shell DWI. They have the sizes of real data but need no scanner
+data, MRtrix, FSL or GPU. All phantoms are deterministic (fixed seed), so two
+benchmark runs process exactly the same voxels.
+
+@author: anna speckert
+"""
+import numpy as np
+
+
+# Image sizes of the benchmark presets
+    # t2:  the reformatted T2 and the UNet labels (400x400x400 at 0.4 mm for newborns)
+    # dwi: diffusion image (x, y, z), n_b0 b0 volumes + n_dirs directions at b=1000
+    # unet_slices: number of 400x400 slices the UNet segments
+PRESETS = {"neonatal": {"t2": (400, 400, 400), "dwi": (128, 128, 64), "n_b0": 4, "n_dirs": 32, "unet_slices": 400},
+           "small": {"t2": (96, 96, 96), "dwi": (48, 48, 32), "n_b0": 2, "n_dirs": 16, "unet_slices": 8}}
+
+# label: (T2 intensity, S0 of the DWI, mean diffusivity in mm2/s); 1 ext. csf, 2 cortical gm, 3 wm, 4 ventricles,
+# 5 cerebellum, 6 deep gm, 7 brainstem, 8 hippocampus (label k of the UNet = probability volume k-1)
+TISSUES = {0: (0, 0, 0), 1: (1800, 1500, 3.0e-3), 2: (1100, 900, 0.9e-3), 3: (1400, 1000, 1.2e-3), 4: (1900, 1500, 3.0e-3),
+           5: (1000, 900, 0.9e-3), 6: (1000, 850, 0.9e-3), 7: (1200, 950, 1.1e-3), 8: (1050, 900, 0.9e-3)}
+
+SEED = 20231
+
+
+def radius(shape, scale=1.0):
+    """Normalised ellipsoid radius (1 = brain surface) of every voxel of a 3D grid, float32."""
+    axes = [(np.arange(size, dtype=np.float32) - (size - 1) / 2.0) / (0.45 * size * scale) for size in shape]
+    x, y, z = np.ix_(*axes)
+    return np.sqrt(x**2 + y**2 + z**2), (x, y, z)
+
+
+def label_image(shape, scale=1.0):
+    """Label image (uint8) with the labels 0 (background) to 8."""
+    r, (x, y, z) = radius(shape, scale)
+    labels = np.zeros(shape, dtype=np.uint8)
+    labels[r <= 1.0] = 1
+    labels[r <= 0.92] = 2
+    labels[r <= 0.8] = 3
+    labels[(r <= 0.8) & (r > 0.35) & (z < -0.45)] = 5
+    labels[r <= 0.35] = 7
+    labels[(r <= 0.35) & (x > 0.15)] = 8
+    labels[r <= 0.22] = 6
+    labels[r <= 0.12] = 4
+    return labels
+
+
+def label_probabilities(shape, dtype=np.float64):
+    """
+    Label probabilities like the UNet output (x, y, z, 8): one label dominates in the
+    interior of a tissue, at the tissue borders the probability is shared with the
+    neighbouring label, and every brain voxel carries a little softmax noise.
+    """
+    rng = np.random.default_rng(SEED)
+    inner = label_image(shape)
+    outer = label_image(shape, scale=1.03) # label of the neighbour towards the surface
+    weight = rng.uniform(0.55, 1.0, size=shape).astype(np.float32)
+    weight[inner == outer] = 1
+    probabilities = np.zeros(shape + (8,), dtype=dtype)
+    for k in range(1, 9):
+        volume = probabilities[..., k - 1]
+        volume[inner == k] = weight[inner == k]
+        volume += (outer == k) * (1 - weight)
+    brain = inner > 0
+    noise = rng.uniform(0, 0.005, size=brain.sum()).astype(dtype)
+    probabilities[brain, rng.integers(0, 8, size=noise.size)] += noise
+    return probabilities
+
+
+def t2_image(shape):
+    """T2 weighted image (float32) with Gaussian noise."""
+    rng = np.random.default_rng(SEED)
+    lookup = np.array([TISSUES[label][0] for label in range(9)], dtype=np.float32)
+    t2 = lookup[label_image(shape)]
+    t2 += rng.normal(0, 30, size=shape).astype(np.float32)
+    return np.clip(t2, 0, None)
+
+
+def gradient_directions(n_dirs):
+    """Directions spread evenly over the half sphere (Fibonacci lattice)."""
+    i = np.arange(n_dirs) + 0.5
+    z = 1 - i / n_dirs
+    phi = np.pi * (1 + 5**0.5) * i
+    return np.stack((np.sqrt(1 - z**2) * np.cos(phi), np.sqrt(1 - z**2) * np.sin(phi), z), axis=1)
+
+
+def dwi_image(shape, n_b0, n_dirs, bval=1000):
+    """
+    Single-shell DWI (x, y, z, n_b0 + n_dirs) with Rician noise. White matter is
+    anisotropic (fibres running around the z-axis), the other tissues are isotropic.
+
+    Output:
+        (dwi as float64 like nibabel's get_fdata, bvals, bvecs (3, n))
+    """
+    rng = np.random.default_rng(SEED)
+    labels = label_image(shape)
+    s0 = np.array([TISSUES[label][1] for label in range(9)], dtype=np.float32)[labels]
+    md = np.array([TISSUES[label][2] for label in range(9)], dtype=np.float32)[labels]
+    _, (x, y, z) = radius(shape)
+    fibre = np.stack(np.broadcast_arrays(-y, x, 0 * z), axis=-1)
+    fibre /= np.maximum(np.linalg.norm(fibre, axis=-1, keepdims=True), 1e-6)
+    wm = labels == 3
+    bvals = np.array([0] * n_b0 + [bval] * n_dirs, dtype=float)
+    bvecs = np.concatenate((np.zeros((n_b0, 3)), gradient_directions(n_dirs)))
+    dwi = np.empty(shape + (len(bvals),), dtype=np.float64)
+    sigma = 0.05 * s0.max()
+    for volume, (b, g) in enumerate(zip(bvals, bvecs)):
+        adc = md.copy()
+        # wm tensor with the same mean diffusivity: lambda1 = 2 md, lambda2 = lambda3 = md / 2
+        cos2 = (fibre[wm] @ g.astype(np.float32))**2
+        adc[wm] = md[wm] * (0.5 + 1.5 * cos2)
+        signal = s0 * np.exp(-b * adc)
+        dwi[..., volume] = np.sqrt((signal + rng.normal(0, sigma, size=shape))**2 + rng.normal(0, sigma, size=shape)**2)
+    return dwi, bvals, bvecs.T
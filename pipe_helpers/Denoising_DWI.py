@@ -3,61 +3,135 @@
 """
 Created on Tue Mar  8 10:44:51 2022
 
+Patch2Self denoising (dipy 1.5: model 'ols', patch radius 0, b0 threshold 50,
+shift_intensity) computed from the covariance of the volumes:
+
+    patch2self regresses every volume on all other volumes of its group (the
+    b0 volumes resp. the diffusion weighted ones) with an ordinary least squares
+    fit over the voxels, and replaces it by the prediction. All these fits follow
+    from the mean and the covariance C of the volumes of a group: volume v is
+    predicted with the weights solving C[-v,-v] w = C[-v,v]. So the voxels are
+    read twice (mean and covariance) and predicted once, instead of once per
+    volume, in chunks of CHUNK_VOXELS on a pool of threads which share the
+    read-only data.
+
+The image is loaded as float32 (memory-mapped if it is an uncompressed float32
+NIfTI), the sums are computed in float64. The output matches dipy's patch2self
+to float32 precision. With "denoising_mask": "yes" only the voxels of a dilated
+brain mask are fitted and denoised, the background keeps its values (the
+output then differs from dipy's, which also fits the background).
+
 @author: anna
 """
 # Denoising with dipy 
 import numpy as np
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pipe_helpers.command_executor import call
+from pipe_helpers.resources import limit_threads
+from pipe_helpers.image_writer import n_threads, save
 import nibabel as nib 
-from dipy.io.image import save_nifti
-import matplotlib.pyplot as plt
-from dipy.denoise.patch2self import patch2self
 
 
-def denoising(data_dir):  # where data_dir = base_dir + subj
+B0_THRESHOLD = 50
+CHUNK_VOXELS = 32768
+MASK_DILATION = 3 # voxels the brain mask is grown by, so the edge of the brain is denoised as well
+
+
+def brain_mask(data, bvals):
+    """Brain mask of the mean b0 (median_otsu of dipy), dilated by MASK_DILATION voxels."""
+    from dipy.segment.mask import median_otsu
+    mean_b0 = np.mean(data[..., np.asarray(bvals) <= B0_THRESHOLD], axis=3)
+    _, mask = median_otsu(mean_b0, median_radius=2, numpass=1, dilate=MASK_DILATION)
+    return mask
+
+
+def prediction_weights(covariance):
+    """
+    Weights of the leave-one-volume-out regressions (volumes x volumes, zero diagonal): column v predicts
+    volume v from the others (after subtracting the means).
+    """
+    n = len(covariance)
+    weights = np.zeros((n, n))
+    for volume in range(n):
+        others = np.arange(n) != volume
+        # least squares as in dipy (scikit-learn's LinearRegression): also for volumes which are linearly dependent
+        weights[others, volume] = np.linalg.lstsq(covariance[np.ix_(others, others)], covariance[others, volume], rcond=None)[0]
+    return weights
+
+
+def denoise(data, bvals, mask=None):
+    """
+    Patch2Self with the settings of the pipeline (see above).
+
+    Inputs:
+        data: 4D dwi (float32 is not copied)
+        bvals: one b-value per volume
+        mask: 3D mask of the voxels to fit and denoise (None: all voxels)
+
+    Output:
+        denoised dwi (float32)
+    """
+    bvals = np.ravel(bvals)
+    shape = np.shape(data)
+    voxels = np.reshape(data, (-1, shape[3]), order='F') # voxels x volumes, a view of the (Fortran ordered) nibabel data
+    rows = None if mask is None else np.flatnonzero(np.ravel(mask, order='F'))
+    n_rows = len(voxels) if rows is None else len(rows)
+    chunks = [slice(start, min(n_rows, start + CHUNK_VOXELS)) for start in range(0, n_rows, CHUNK_VOXELS)]
+    if rows is None:
+        denoised = np.empty(voxels.shape, dtype=np.float32, order='F')
+    else:
+        denoised = np.array(voxels, dtype=np.float32, order='F') # the background keeps its values
+
+    def index(chunk, group):
+        return (chunk, group) if rows is None else np.ix_(rows[chunk], group)
+
+    threads = n_threads()
+    with ThreadPoolExecutor(max_workers=threads) as pool, limit_threads(1): # one BLAS thread per chunk
+        for group in (np.flatnonzero(bvals <= B0_THRESHOLD), np.flatnonzero(bvals > B0_THRESHOLD)):
+            if len(group) < 2: # a single b0 volume is not denoised (as in dipy)
+                if rows is None:
+                    denoised[:, group] = voxels[:, group]
+                continue
+
+            def read(chunk):
+                return np.asarray(voxels[index(chunk, group)], dtype=float)
+
+            means = sum(pool.map(lambda chunk: read(chunk).sum(axis=0), chunks)) / n_rows
+
+            def covariance(chunk):
+                centred = read(chunk) - means
+                return centred.T @ centred, centred.min(axis=0)
+            parts = list(pool.map(covariance, chunks))
+            weights = prediction_weights(sum(part[0] for part in parts))
+            data_minima = np.min([part[1] for part in parts], axis=0) + means
+
+            def predict(chunk):
+                prediction = (read(chunk) - means) @ weights + means
+                denoised[index(chunk, group)] = prediction
+                return prediction.min(axis=0)
+            # shift_intensity: every volume is shifted so that its minimum is the one of the original
+            shifts = (data_minima - np.min(list(pool.map(predict, chunks)), axis=0)).astype(np.float32)
+
+            def shift(chunk):
+                denoised[index(chunk, group)] += shifts
+            list(pool.map(shift, chunks))
+    return np.reshape(denoised, shape, order='F')
+
+
+def denoising(data_dir, use_mask=False):  # where data_dir = base_dir + subj
     nii = nib.load(data_dir + "/dti" +"/dti.nii.gz") 
     affine = nii.affine
-    data = nii.get_fdata() # get the actual data 
+    data = nii.get_fdata(dtype=np.float32) # get the actual data (memory-mapped if possible)
     
     bvals = np.loadtxt(data_dir + "/dti/bvals")
-    denoised_arr = patch2self(data, bvals, model='ols', shift_intensity=True,
-                              clip_negative_vals=False, b0_threshold=50)
-    
-    # Gets the center slice and the middle volume of the 4D diffusion data.
-    sli = data.shape[2] // 2
-    gra = 21  # pick out a random volume for a particular gradient direction
-    
-    orig = data[:, :, sli, gra]
-    den = denoised_arr[:, :, sli, gra]
-    
-    # computes the residuals
-    rms_diff = np.sqrt((orig - den) ** 2)
-    
-    fig1, ax = plt.subplots(1, 3, figsize=(12, 6),
-                            subplot_kw={'xticks': [], 'yticks': []})
-    
-    fig1.subplots_adjust(hspace=0.3, wspace=0.05)
-    
-    ax.flat[0].imshow(orig.T, cmap='gray', interpolation='none',
-                      origin='lower')
-    ax.flat[0].set_title('Original')
-    ax.flat[1].imshow(den.T, cmap='gray', interpolation='none',
-                      origin='lower')
-    ax.flat[1].set_title('Denoised Output')
-    ax.flat[2].imshow(rms_diff.T, cmap='gray', interpolation='none',
-                      origin='lower')
-    ax.flat[2].set_title('Residuals')
-    
-    subprocess.call(["mkdir", "-m777", data_dir + "/processing/dti/denoising"])
-    
-    fig1.savefig(data_dir + '/processing/dti/denoising/denoised_patch2self.png')
-    subprocess.call(["chmod", "a+rwx", data_dir + "/processing/dti/denoising/denoised_patch2self.png"])
-    print("The result saved in", data_dir +"/processing/dti/denoising/denoised_patch2self.png")
+    denoised_arr = denoise(data, bvals, brain_mask(data, bvals) if use_mask else None)
     
+    call(["mkdir", "-m777", data_dir + "/processing/dti/denoising"])
     
-    save_nifti(data_dir + '/processing/dti/denoising/denoised_patch2self.nii.gz', denoised_arr, affine)
+    # uncompressed: mrdegibbs reads it right after, gzip would only cost a compression and a decompression pass
+    save(denoised_arr, data_dir + '/processing/dti/denoising/denoised_patch2self.nii', affine)
     # new line for chmod
-    subprocess.call(["chmod", "a+rwx", data_dir + "/processing/dti/denoising/denoised_patch2self.nii.gz"])
+    call(["chmod", "a+rwx", data_dir + "/processing/dti/denoising/denoised_patch2self.nii"])
    
 
-    print("Entire denoised data saved in", data_dir +"/processing/dti/denoising/denoised_patch2self.nii.gz")
+    print("Entire denoised data saved in", data_dir +"/processing/dti/denoising/denoised_patch2self.nii")
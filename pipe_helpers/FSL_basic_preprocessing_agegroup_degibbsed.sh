@@ -23,7 +23,7 @@ cd $data_directory/
 #### 1) Create non-diffusion-weighted image from denoised dti data.
 ####### If the denoising should start from raw dti data, change the first input of fslroi
 
-fslroi ./processing/dti/degibbs.nii.gz ./processing/dti/nodif 0 1 # takes first volume (=0) and Anzahl (=1) creates image called nodif
+fslroi ./processing/dti/degibbs.nii ./processing/dti/nodif 0 1 # takes first volume (=0) and Anzahl (=1) creates image called nodif
 
 
 #### 2) TOPUP cant be run because there is only one single encoding direction
@@ -75,18 +75,20 @@ chmod a+rwx ./processing/dti/process/acqp.txt
 # if eddy_cuda8.0 does not work, only use eddy. However, simply eddy cant do slice-to-volume correction. Hence, the command --mporder needs to be deleted. 
 
 # When running this script directly on CS5, this command like this works. 
+# eddy writes eddy_images uncompressed (.nii): it is only read once more, by dwibiascorrect
+export FSLOUTPUTTYPE=NIFTI
 if [[ "$age" == "newborn" ]]; then 
-eddy_cuda8.0 --imain=./processing/dti/degibbs.nii.gz	--mask=./processing/dti/hifi_nodif_brain_mask.nii.gz --index=./processing/dti/process/index.txt	--acqp=./processing/dti/process/acqp.txt --bvecs=./dti/bvecs	--bvals=./dti/bvals --out=./processing/dti/eddy_images	--niter=6 --fwhm=10,6,4,2,0,0 --fep --repol --ol_nstd=4	--mporder=5 --s2v_niter=10 --verbose
+eddy_cuda8.0 --imain=./processing/dti/degibbs.nii	--mask=./processing/dti/hifi_nodif_brain_mask.nii.gz --index=./processing/dti/process/index.txt	--acqp=./processing/dti/process/acqp.txt --bvecs=./dti/bvecs	--bvals=./dti/bvals --out=./processing/dti/eddy_images	--niter=6 --fwhm=10,6,4,2,0,0 --fep --repol --ol_nstd=4	--mporder=5 --s2v_niter=10 --verbose
 
 elif [[ "$age" == "child" ]]; then
-eddy_cuda8.0 --imain=./processing/dti/degibbs.nii.gz	--mask=./processing/dti/hifi_nodif_brain_mask.nii.gz --index=./processing/dti/process/index.txt	--acqp=./processing/dti/process/acqp.txt --bvecs=./dti/bvecs	--bvals=./dti/bvals --out=./processing/dti/eddy_images	--niter=5 --fwhm=10 --fep --repol --ol_nstd=4	--mporder=5 --s2v_niter=10 --verbose # almost default settings
+eddy_cuda8.0 --imain=./processing/dti/degibbs.nii	--mask=./processing/dti/hifi_nodif_brain_mask.nii.gz --index=./processing/dti/process/index.txt	--acqp=./processing/dti/process/acqp.txt --bvecs=./dti/bvecs	--bvals=./dti/bvals --out=./processing/dti/eddy_images	--niter=5 --fwhm=10 --fep --repol --ol_nstd=4	--mporder=5 --s2v_niter=10 --verbose # almost default settings
 
 elif [[ "$age" == "adolescent" ]]; then
-eddy_cuda8.0 --imain=./processing/dti/degibbs.nii.gz	--mask=./processing/dti/hifi_nodif_brain_mask.nii.gz --index=./processing/dti/process/index.txt	--acqp=./processing/dti/process/acqp.txt --bvecs=./dti/bvecs	--bvals=./dti/bvals --out=./processing/dti/eddy_images	--niter=5 --fwhm=10 --fep --repol --ol_nstd=4	--mporder=5 --s2v_niter=10 --verbose # almost default settings 
+eddy_cuda8.0 --imain=./processing/dti/degibbs.nii	--mask=./processing/dti/hifi_nodif_brain_mask.nii.gz --index=./processing/dti/process/index.txt	--acqp=./processing/dti/process/acqp.txt --bvecs=./dti/bvecs	--bvals=./dti/bvals --out=./processing/dti/eddy_images	--niter=5 --fwhm=10 --fep --repol --ol_nstd=4	--mporder=5 --s2v_niter=10 --verbose # almost default settings 
 fi
 
 chmod a+rwx ./processing/dti/hifi_nodif_brain_mask.nii.gz 
-chmod a+rwx ./processing/dti/eddy_images.nii.gz 
+chmod a+rwx ./processing/dti/eddy_images.nii 
  
 
 #  To check if eddy worked well, you can run Qualitiy Control FSL_QC_ofeddy_v1
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Atomic writing of output files.
+
+A file is first written under a temporary name in the same directory
+(.partial_<pid>_<name>, the suffix stays the same so MRtrix, FSL and nibabel
+still recognise the format) and only renamed to its final name when it was
+completely written. A process killed in the middle of writing therefore never
+leaves a truncated degibbs.mif or tracks_10mio.tck behind which a later run
+would take for a result.
+
+    with writing(path) as partial:       # python code
+        nib.save(image, partial)
+
+    call_atomic(["mrdegibbs", denoised, degibbs], [degibbs])   # external commands
+
+The shell scripts do the same with a temporary name and mv. Outputs of stages
+which were interrupted anyway (e.g. by a node preemption) are discarded by the
+stage graph when the next run starts (see stage_cache.py).
+
+@author: anna speckert
+"""
+import os
+from contextlib import contextmanager
+
+from pipe_helpers.command_executor import call, is_dry_run
+
+
+def partial_path(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, ".partial_" + str(os.getpid()) + "_" + name)
+
+
+def commit(partial, path):
+    os.replace(partial, path) # atomic within the same file system
+
+
+def remove_partial(partial):
+    if os.path.exists(partial):
+        os.remove(partial)
+
+
+@contextmanager
+def writing(path):
+    """Yields the temporary path to write to. Renamed to path if the block ran through, otherwise removed."""
+    partial = partial_path(path)
+    try:
+        yield partial
+    except BaseException:
+        remove_partial(partial)
+        raise
+    commit(partial, path)
+
+
+def call_atomic(command, outputs, **kwargs):
+    """
+    Runs an external command whose output files are written atomically.
+
+    Inputs:
+        command: command as list, the outputs appear in it as separate arguments
+        outputs: output paths of the command
+
+    Output:
+        exit code of the command. The outputs are only renamed to their final
+        names if the command succeeded and wrote all of them.
+    """
+    if is_dry_run():
+        return call(command) # the plan shows the final names
+    partials = {output: partial_path(output) for output in outputs}
+    returncode = call([partials.get(argument, argument) for argument in command], **kwargs)
+    if returncode == 0 and all(os.path.exists(partial) for partial in partials.values()):
+        for output, partial in partials.items():
+            commit(partial, output)
+    else:
+        for partial in partials.values():
+            remove_partial(partial)
+    return returncode
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Preflight of the cohort: before anything is computed, the input files of every
+subject are checked and written to the cohort manifest (wor_dir/cohort_manifest.json):
+
+    subject:    input paths, dimensions, voxel sizes, number of volumes, b-value shells,
+                qform/sform agreement and structural type, the problems found,
+                warnings and whether the subject is valid
+
+Only the headers of the NIfTI images are read (the first 348 resp. 540 bytes,
+decompressing a .nii.gz only that far), so hundreds of subjects are checked in
+seconds. The inputs checked are the ones the chosen stages read from the subject
+folder (see pipeline_stages.py). Invalid subjects are rejected before the run
+instead of failing hours later inside eddy or the segmentation UNet. Warnings
+(e.g. a T2 larger than the field of view of the UNet, which the reformatting
+may still bring into it) are written to the manifest and printed, but do not
+reject the subject.
+
+@author: anna speckert
+"""
+import os
+import sys
+import gzip
+import json
+import math
+import struct
+import time
+
+from pipe_helpers.atomic_outputs import writing
+
+
+QFORM_SFORM_TOLERANCE = 1e-3 # mm, largest difference of the two voxel to scanner matrices
+SHELL_EPSILON = 80 # b-values closer than this belong to the same shell (as in MRtrix)
+B0_THRESHOLD = 50 # b-values up to this count as b=0
+UNET_FIELD_OF_VIEW_MM = 400 * 0.4 # the reformatted T2 is regridded to 0.4 mm and segmented in slices of 400x400 voxels (only a warning, see check_subject)
+
+
+def manifest_path(wor_dir):
+    return wor_dir + "/cohort_manifest.json"
+
+
+def list_subjects(base_dir):
+    """Only directories count as subjects: stray files (notes, archives, .DS_Store) in the base_dir are ignored."""
+    return [entry for entry in sorted(os.listdir(base_dir)) if os.path.isdir(base_dir + "/" + entry) and not entry.startswith(".")]
+
+
+def read_nifti_header(path):
+    """
+    Reads the header of a NIfTI-1 or NIfTI-2 image (.nii or .nii.gz) without loading the image.
+
+    Output:
+        dict with "dims" (list), "voxel_sizes" (list), "qform_code", "sform_code",
+        "qform" and "sform" (3x4 voxel to scanner matrices as lists of rows)
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as image:
+        raw = image.read(540)
+    if len(raw) < 348:
+        raise ValueError("too short for a NIfTI header")
+    for endian in "<>":
+        size = struct.unpack(endian + "i", raw[:4])[0]
+        if size in (348, 540):
+            break
+    else:
+        raise ValueError("not a NIfTI image")
+    if size == 348:
+        dim = struct.unpack(endian + "8h", raw[40:56])
+        pixdim = struct.unpack(endian + "8f", raw[76:108])
+        qform_code, sform_code = struct.unpack(endian + "2h", raw[252:256])
+        quatern = struct.unpack(endian + "6f", raw[256:280])
+        srow = struct.unpack(endian + "12f", raw[280:328])
+    else:
+        if len(raw) < 540:
+            raise ValueError("too short for a NIfTI-2 header")
+        dim = struct.unpack(endian + "8q", raw[16:80])
+        pixdim = struct.unpack(endian + "8d", raw[104:168])
+        qform_code, sform_code = struct.unpack(endian + "2i", raw[344:352])
+        quatern = struct.unpack(endian + "6d", raw[352:400])
+        srow = struct.unpack(endian + "12d", raw[400:496])
+    n_dims = dim[0]
+    if not 1 <= n_dims <= 7:
+        raise ValueError("invalid number of dimensions " + str(n_dims))
+    return {"dims": list(dim[1:n_dims + 1]),
+            "voxel_sizes": [round(size, 6) for size in pixdim[1:n_dims + 1]],
+            "qform_code": qform_code,
+            "sform_code": sform_code,
+            "qform": qform_matrix(quatern, pixdim),
+            "sform": [list(srow[0:4]), list(srow[4:8]), list(srow[8:12])]}
+
+
+def qform_matrix(quatern, pixdim):
+    # voxel to scanner matrix of the quaternion (NIfTI-1 standard, method 2)
+    b, c, d, x, y, z = quatern
+    a = math.sqrt(max(0.0, 1.0 - (b * b + c * c + d * d)))
+    rotation = [[a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+                [2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b)],
+                [2 * (b * d - a * c), 2 * (c * d + a * b), a * a + d * d - c * c - b * b]]
+    qfac = -1.0 if pixdim[0] < 0 else 1.0
+    scales = [pixdim[1], pixdim[2], pixdim[3] * qfac]
+    return [[row[0] * scales[0], row[1] * scales[1], row[2] * scales[2], offset] for row, offset in zip(rotation, (x, y, z))]
+
+
+def qform_sform_agreement(header):
+    """"identical", "different", "qform only", "sform only" or "none"."""
+    if header["qform_code"] > 0 and header["sform_code"] > 0:
+        difference = max(abs(q - s) for q_row, s_row in zip(header["qform"], header["sform"]) for q, s in zip(q_row, s_row))
+        return "identical" if difference <= QFORM_SFORM_TOLERANCE else "different"
+    if header["qform_code"] > 0:
+        return "qform only"
+    if header["sform_code"] > 0:
+        return "sform only"
+    return "none"
+
+
+def read_numbers(path):
+    """Rows of numbers of a bvals/bvecs text file."""
+    with open(path) as text_file:
+        return [[float(value) for value in line.replace(",", " ").split()] for line in text_file if line.strip()]
+
+
+def b_value_shells(bvals):
+    """Returns [[b-value, number of volumes], ...] with b-values closer than SHELL_EPSILON in one shell."""
+    shells = []
+    for value in sorted(0.0 if b <= B0_THRESHOLD else b for b in bvals):
+        if shells and value - shells[-1][-1] <= SHELL_EPSILON:
+            shells[-1].append(value)
+        else:
+            shells.append([value])
+    return [[int(round(sum(shell) / len(shell))), len(shell)] for shell in shells]
+
+
+def subject_inputs(stages, base_dir, subj):
+    """Files of the subject folder read by the stages (the raw inputs, not the results of earlier stages)."""
+    inputs = []
+    for stage in stages:
+        for template in stage.inputs:
+            if template.startswith("{subject_dir}/") and "/processing/" not in template:
+                path = template.format(subject_dir=base_dir + "/" + subj, subj=subj, wor_dir=sys.path[0])
+                if path not in inputs:
+                    inputs.append(path)
+    return inputs
+
+
+def check_subject(base_dir, subj, inputs, configurations):
+    """
+    Checks the input files of one subject.
+
+    Output:
+        manifest entry of the subject (see above)
+    """
+    entry = {"inputs": inputs, "problems": [], "warnings": []}
+    problems = entry["problems"]
+    warnings = entry["warnings"]
+    for path in inputs:
+        if not os.path.isfile(path):
+            problems.append("missing " + os.path.relpath(path, base_dir + "/" + subj))
+    dti_dir = base_dir + "/" + subj + "/dti"
+    dwi_path = dti_dir + "/dti.nii.gz"
+    if dwi_path in inputs and os.path.isfile(dwi_path):
+        try:
+            header = read_nifti_header(dwi_path)
+        except (OSError, ValueError, EOFError) as error:
+            problems.append("dti/dti.nii.gz cannot be read: " + str(error))
+        else:
+            entry["dwi"] = {"dims": header["dims"][:3], "voxel_sizes": header["voxel_sizes"][:3],
+                            "volumes": header["dims"][3] if len(header["dims"]) > 3 else 1,
+                            "qform_sform": qform_sform_agreement(header)}
+            if len(header["dims"]) != 4:
+                problems.append("dti/dti.nii.gz is not 4D (dimensions " + str(header["dims"]) + ")")
+            if entry["dwi"]["qform_sform"] == "different":
+                problems.append("dti/dti.nii.gz: q- and s-form differ (e.g. fslorient -qform2sform)")
+    if os.path.isfile(dti_dir + "/bvals"):
+        try:
+            bvals = [value for row in read_numbers(dti_dir + "/bvals") for value in row]
+            entry["dwi"] = dict(entry.get("dwi", {}), shells=b_value_shells(bvals))
+            if not any(b <= B0_THRESHOLD for b in bvals):
+                problems.append("dti/bvals has no b=0 volume")
+            volumes = entry.get("dwi", {}).get("volumes")
+            if volumes is not None and volumes != len(bvals):
+                problems.append("dti/bvals has " + str(len(bvals)) + " values for " + str(volumes) + " volumes")
+            if os.path.isfile(dti_dir + "/bvecs"):
+                bvecs = read_numbers(dti_dir + "/bvecs")
+                shape = (len(bvecs), len(bvecs[0]) if bvecs else 0)
+                if any(len(row) != shape[1] for row in bvecs) or sorted(shape) != sorted((3, len(bvals))):
+                    problems.append("dti/bvecs is not 3 x " + str(len(bvals)) + " (one direction per b-value)")
+        except ValueError as error:
+            problems.append("dti/bvals or dti/bvecs is not a text file of numbers: " + str(error))
+    structural_path = base_dir + "/" + subj + "/t2/T2_SVRTK.nii.gz"
+    if structural_path in inputs and os.path.isfile(structural_path):
+        try:
+            header = read_nifti_header(structural_path)
+        except (OSError, ValueError, EOFError) as error:
+            problems.append("t2/T2_SVRTK.nii.gz cannot be read: " + str(error))
+        else:
+            entry["structural"] = {"type": configurations.get("structural_type", "") or "t2", "dims": header["dims"],
+                                   "voxel_sizes": header["voxel_sizes"], "qform_sform": qform_sform_agreement(header)}
+            if len([size for size in header["dims"] if size > 1]) != 3:
+                problems.append("t2/T2_SVRTK.nii.gz is not 3D (dimensions " + str(header["dims"]) + ")")
+            if entry["structural"]["qform_sform"] == "different":
+                problems.append("t2/T2_SVRTK.nii.gz: q- and s-form differ (e.g. fslorient -qform2sform)")
+            if configurations.get("5tt_provided") == "no" and configurations.get("ageGroup") == "newborn":
+                # raw header: the reformatting regrids the T2 before the segmentation, so this does not reject the subject
+                extent = [size * voxel for size, voxel in zip(header["dims"][:3], header["voxel_sizes"][:3])]
+                if max(extent) > UNET_FIELD_OF_VIEW_MM:
+                    warnings.append("t2/T2_SVRTK.nii.gz covers " + " x ".join(str(round(length)) for length in extent)
+                                    + " mm, more than the " + str(round(UNET_FIELD_OF_VIEW_MM)) + " mm the segmentation UNet sees")
+    entry["valid"] = not problems
+    return entry
+
+
+def preflight(stages, base_dir, subjects, configurations, not_working_subj):
+    """
+    Checks the inputs of all subjects and writes the cohort manifest.
+
+    Inputs:
+        stages: stages of the run (their inputs in the subject folder are checked)
+        not_working_subj: invalid subjects are appended as [subj, "preflight"]
+
+    Output:
+        valid subjects, which the run processes
+    """
+    tic = time.time()
+    manifest = {}
+    for subj in subjects:
+        manifest[subj] = check_subject(base_dir, subj, subject_inputs(stages, base_dir, subj), configurations)
+    with writing(manifest_path(sys.path[0])) as partial:
+        with open(partial, "w") as jsonfile:
+            json.dump(manifest, jsonfile, indent=1)
+    valid = [subj for subj in subjects if manifest[subj]["valid"]]
+    for subj in subjects:
+        if not manifest[subj]["valid"]:
+            not_working_subj.append([subj, "preflight"])
+            print(subj, "is rejected by the preflight: ", "; ".join(manifest[subj]["problems"]))
+        elif manifest[subj]["warnings"]:
+            print(subj, "preflight warning: ", "; ".join(manifest[subj]["warnings"]))
+    print("Preflight: ", len(valid), "of ", len(subjects), "subjects are valid (", round(time.time() - tic, 2), "s), see", manifest_path(sys.path[0]))
+    return valid
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+State of the cohort kept between runs (wor_dir/GroupComparison/cohort_state.json),
+so that a cohort which grows only costs the time of its new subjects
+(config "cohort_mode": "incremental"):
+
+    subjects:                subjects which ran through, with the date of their first run
+    response:                per-subject contributions and running sums of the group
+                             response function, the published average (group_processing.py)
+    intensity normalisation: the subjects the FA template of dwinormalise group was built
+                             from and the subjects normalised against it since
+
+In incremental mode
+    - new subjects are normalised against the existing FA template instead of
+      rebuilding it from all subjects. The template is rebuilt once more than
+      "incremental_rebuild_fraction" of the subjects are not part of it.
+    - the group response function is updated from the stored contributions, but
+      only published (written to GroupComparison/responsemean) if it moved by more
+      than "incremental_tolerance" (relative change) from the published one.
+      Otherwise the FODs, tractograms and connectomes of the existing subjects stay
+      valid and only the new subjects are processed (see stage_cache.py).
+
+Every group stage replaces only its own section, under a lock, so the stages may
+finish in any order.
+
+@author: anna speckert
+"""
+import os
+import json
+import time
+import fcntl
+from contextlib import contextmanager
+
+from pipe_helpers.atomic_outputs import writing
+
+
+def state_path(wor_dir):
+    return wor_dir + "/GroupComparison/cohort_state.json"
+
+
+def is_incremental(configurations):
+    return configurations.get("cohort_mode", "full") == "incremental"
+
+
+def incremental_tolerance(configurations):
+    if not is_incremental(configurations):
+        return 0.0 # full mode: every change of the group average is published
+    return float(configurations.get("incremental_tolerance", "0.01") or 0)
+
+
+def rebuild_fraction(configurations):
+    return float(configurations.get("incremental_rebuild_fraction", "0.5") or 0)
+
+
+def load_state(wor_dir):
+    path = state_path(wor_dir)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as jsonfile:
+        return json.load(jsonfile)
+
+
+@contextmanager
+def updating(wor_dir, section):
+    """Yields the section (dict) of the state to change in place, writes it back when the block ran through."""
+    path = state_path(wor_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = load_state(wor_dir)
+        data = state.setdefault(section, {})
+        yield data
+        with writing(path) as partial:
+            with open(partial, "w") as jsonfile:
+                json.dump(state, jsonfile)
+
+
+def file_signature(path):
+    # size and modification time: enough to see that an input was rewritten, without reading it
+    if not os.path.exists(path):
+        return None
+    info = os.stat(path)
+    return [info.st_size, info.st_mtime_ns]
+
+
+def new_subjects(wor_dir, subjects):
+    """Returns the subjects which have not run through the pipeline before."""
+    known = load_state(wor_dir).get("subjects", {})
+    return [subj for subj in subjects if subj not in known]
+
+
+def record_subjects(wor_dir, subjects):
+    with updating(wor_dir, "subjects") as known:
+        for subj in subjects:
+            known.setdefault(subj, time.strftime("%Y-%m-%d"))
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The one place where the pipeline runs commands: call() replaces subprocess.call
+in all helpers.
+
+    - mkdir, cp, ln -f and chmod are done in-process instead of starting a
+      process for every directory and file. The chmod a+rwx of the outputs of
+      a stage are collected and applied together when the stage ends. ln -f
+      falls back to a reflink resp. a copy if source and destination are on
+      different file systems.
+    - External tools run through tracing.call (timed and traced). Within a
+      stage their stdout and stderr go to a log file per stage
+      (base_dir/subj/processing/logs/<stage>.log, group stages:
+      wor_dir/GroupComparison/logs/), a non-zero exit code is reported with
+      the end of that log.
+    - Dry run (python DTI_Pipeline.py --dry-run): nothing is run, every
+      command is printed. Together with the python backends (see
+      subject_processing.backend) this gives the command plan of a cohort.
+
+@author: anna speckert
+"""
+import os
+import sys
+import time
+import shlex
+import shutil
+import tempfile
+import subprocess
+
+from pipe_helpers import tracing
+
+
+_settings = {"dry_run": False}
+_stage = {} # log file and pending chmods of the stage running in this process
+
+
+def set_dry_run(dry_run):
+    _settings["dry_run"] = dry_run
+
+
+def is_dry_run():
+    return _settings["dry_run"]
+
+
+def log_path(base_dir, subj, stage_name):
+    log_dir = sys.path[0] + "/GroupComparison/logs" if subj is None else base_dir + "/" + subj + "/processing/logs"
+    return log_dir + "/" + stage_name.replace(" ", "_") + ".log"
+
+
+def begin_stage(path):
+    """Output of the external commands goes to path, chmods are collected until end_stage()."""
+    _stage.update(log=path, chmod={})
+
+
+def end_stage():
+    for path, mode in _stage.get("chmod", {}).items():
+        _chmod(path, mode)
+    _stage.clear()
+
+
+#########################
+### IN-PROCESS COMMANDS ###
+#########################
+# Each returns the exit code the command line tool would have returned, or None
+# if the arguments are not understood (the tool is then started as usual).
+
+def _mode(text):
+    if text.isdigit():
+        return lambda old: int(text, 8)
+    if text in ("a+rwx", "ugo+rwx", "+rwx"):
+        return lambda old: old | 0o777
+    return None
+
+
+def _chmod(path, mode):
+    try:
+        os.chmod(path, mode(os.stat(path).st_mode & 0o7777))
+        return 0
+    except OSError:
+        return 1
+
+
+def _mkdir(arguments):
+    parents, mode, paths = False, None, []
+    arguments = list(arguments)
+    while arguments:
+        argument = arguments.pop(0)
+        if argument == "-p":
+            parents = True
+        elif argument.startswith("-m"):
+            mode = _mode(argument[2:] or arguments.pop(0))
+            if mode is None:
+                return None
+        elif argument.startswith("-"):
+            return None
+        else:
+            paths.append(argument)
+    returncode = 0
+    for path in paths:
+        try:
+            if parents:
+                os.makedirs(path, exist_ok=True)
+            else:
+                os.mkdir(path)
+        except FileExistsError:
+            returncode = 1 # as mkdir without -p, e.g. for the processing folders of a rerun
+            continue
+        except OSError as error:
+            print("mkdir:", path, ":", error)
+            returncode = 1
+            continue
+        if mode is not None:
+            _chmod(path, mode) # unlike os.mkdir, mkdir -m is not restricted by the umask
+    return returncode
+
+
+def _chmod_command(arguments):
+    if len(arguments) < 2 or arguments[0].startswith("-"):
+        return None
+    mode = _mode(arguments[0])
+    if mode is None:
+        return None
+    if "chmod" in _stage:
+        for path in arguments[1:]:
+            _stage["chmod"][path] = mode # applied once when the stage ends
+        return 0
+    return max(_chmod(path, mode) for path in arguments[1:])
+
+
+def _cp(arguments):
+    if len(arguments) != 2 or any(argument.startswith("-") for argument in arguments):
+        return None
+    try:
+        shutil.copy(arguments[0], arguments[1])
+        return 0
+    except OSError as error:
+        print("cp:", error)
+        return 1
+
+
+FICLONE = 0x40049409 # ioctl of Linux copying a file as reflink (btrfs, xfs): shares the blocks until one side is written
+
+
+def link_or_copy(source, destination):
+    """
+    Makes destination the same file as source at the least cost: hard link, else (other
+    file system) reflink, else copy. Returns "hardlink", "reflink" or "copy".
+    """
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+        return "hardlink"
+    except OSError:
+        pass
+    try:
+        import fcntl
+        with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+        return "reflink"
+    except (OSError, ImportError):
+        shutil.copyfile(source, destination)
+        return "copy"
+
+
+def _ln(arguments):
+    # only "ln -f source destination": the staging of files which are read, never written, by the next step
+    if len(arguments) != 3 or arguments[0] != "-f":
+        return None
+    try:
+        link_or_copy(arguments[1], arguments[2])
+        return 0
+    except OSError as error:
+        print("ln:", error)
+        return 1
+
+
+IN_PROCESS = {"mkdir": _mkdir, "chmod": _chmod_command, "cp": _cp, "ln": _ln}
+
+
+###############
+### COMMANDS ###
+###############
+
+def command_text(command):
+    return command if isinstance(command, str) else " ".join(shlex.quote(str(argument)) for argument in command)
+
+
+def _tail(path, n_lines=5):
+    with open(path, "rb") as log:
+        log.seek(max(0, os.path.getsize(path) - 4096))
+        return log.read().decode("utf-8", "replace").splitlines()[-n_lines:]
+
+
+def call(command, check=False, **kwargs):
+    """
+    Drop-in replacement of subprocess.call (see above).
+
+    Inputs:
+        command: list of arguments resp. a string with shell=True
+        check: raise subprocess.CalledProcessError on a non-zero exit code
+
+    Output:
+        exit code of the command
+    """
+    if is_dry_run():
+        print("    " + ("(cd " + kwargs["cwd"] + ") " if "cwd" in kwargs else "") + command_text(command))
+        return 0
+    returncode = None
+    if not isinstance(command, str) and len(command) > 0 and command[0] in IN_PROCESS and "cwd" not in kwargs:
+        returncode = IN_PROCESS[command[0]]([str(argument) for argument in command[1:]])
+    if returncode is None:
+        if "log" in _stage and "stdout" not in kwargs and "stderr" not in kwargs:
+            os.makedirs(os.path.dirname(_stage["log"]), exist_ok=True)
+            with open(_stage["log"], "a") as log:
+                log.write("### " + command_text(command) + "\n")
+                log.flush()
+                tic = time.time()
+                returncode = tracing.call(command, stdout=log, stderr=subprocess.STDOUT, **kwargs)
+                log.write("### exit code " + str(returncode) + " after " + str(round(time.time() - tic, 1)) + " s\n")
+            if returncode != 0:
+                print("The command", command_text(command)[:200], "exited with", returncode, "- end of", _stage["log"], ":")
+                for line in _tail(_stage["log"]):
+                    print("    " + line)
+        else:
+            returncode = tracing.call(command, **kwargs)
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+    return returncode
+
+
+def output(command, **kwargs):
+    """Runs a command like call() and returns its standard output (e.g. of mrstats). Raises subprocess.CalledProcessError if it fails."""
+    if is_dry_run():
+        call(command, **kwargs)
+        return ""
+    with tempfile.TemporaryFile("w+") as stdout:
+        call(command, check=True, stdout=stdout, **kwargs)
+        stdout.seek(0)
+        return stdout.read()
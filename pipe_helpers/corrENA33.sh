@@ -19,6 +19,6 @@ c3d $conDir/parcels_corr2_ENA33.nii.gz -replace 94 91 95 92 96 93 97 94 98 95 99
 
 # Cleanup
 rm $conDir/parcels_corr2_ENA33.nii.gz
-mrconvert -force $conDir/parcels_corr_ENA33_improved.nii.gz $conDir/nodes.mif
+mrconvert -force $conDir/parcels_corr_ENA33_improved.nii.gz $conDir/.partial_$$_nodes.mif && mv $conDir/.partial_$$_nodes.mif $conDir/nodes.mif || rm -f $conDir/.partial_$$_nodes.mif
 echo "Nodes were created for " $subj
                                                                       
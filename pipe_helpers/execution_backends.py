@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Where the stages of the stage graph run (config key "executor"):
+
+    inprocess: one stage after the other in the pipeline process itself
+               (debugging, profiling, machines where new processes are expensive).
+               A stage killed e.g. by the out-of-memory killer takes the pipeline with it.
+    pool:      a pool of local worker processes, a fresh one per stage (default;
+               before Python 3.11 one new process per stage, see ProcessPerJobExecutor)
+    queue:     jobs of a batch queue (see local_queue.py). Workers on several
+               nodes take the jobs, so one launch of DTI_Pipeline.py processes
+               the whole cohort on as many nodes as there are workers. Group
+               stages (responsemean, dwinormalise group) are jobs as well and
+               read the results of all subjects from base_dir, which must
+               therefore be on a file system shared by all nodes.
+
+All three are concurrent.futures executors: run_graph submits a stage and waits
+for its future, no matter where it runs.
+
+Queue config keys:
+    queue_dir:           directory of the queues (empty = wor_dir/queue), on the shared file system.
+                         Every run has its own queue queue_dir/<date>_<time>_<pid>, which
+                         further workers are started with (DTI_Pipeline.py --queue-worker <queue>)
+    queue_workers:       number of workers started together with the pipeline
+    queue_worker_launch: command starting one worker, {command} is replaced by the worker
+                         command line, e.g. "sbatch -c 8 --mem 32G --wrap '{command}'"
+                         (empty = start the workers as local processes)
+
+@author: anna speckert
+"""
+import os
+import sys
+import time
+import shlex
+import threading
+import subprocess
+import multiprocessing
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+
+from pipe_helpers.local_queue import LocalFileQueue
+
+
+EXECUTORS = ("inprocess", "pool", "queue")
+
+POLL_SECONDS = 2
+
+
+def executor_kind(configurations):
+    kind = configurations.get("executor", "pool") or "pool"
+    if kind not in EXECUTORS:
+        raise ValueError("Unknown executor '" + kind + "' in the config file. Choose between: " + ", ".join(EXECUTORS))
+    return kind
+
+
+def uses_local_resources(configurations):
+    """False if the stages run on other machines, whose memory and cores the pipeline cannot budget."""
+    return executor_kind(configurations) != "queue"
+
+
+class InProcessExecutor(Executor):
+    """Runs a job as soon as it is submitted. The returned future is already done."""
+
+    def submit(self, function, *arguments, **keywords):
+        future = Future()
+        try:
+            future.set_result(function(*arguments, **keywords))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+
+def _run_job(connection, function, arguments, keywords):
+    # runs in the process of the job, sends (kind, value) back as the queue workers do
+    try:
+        outcome = ("result", function(*arguments, **keywords))
+    except BaseException as error:
+        outcome = ("error", error)
+    try:
+        connection.send(outcome)
+    except Exception as error: # a result or exception which cannot be pickled
+        connection.send(("error", RuntimeError(type(error).__name__ + ": " + str(error))))
+    connection.close()
+
+
+class ProcessPerJobExecutor(Executor):
+    """
+    Runs every job in a new process which ends with the job, for Python < 3.11 whose
+    ProcessPoolExecutor cannot replace its workers (no max_tasks_per_child). A killed
+    process only fails its own job.
+    """
+
+    def __init__(self):
+        self.context = multiprocessing.get_context()
+        self.watchers = []
+        self.processes = {}
+        self.lock = threading.Lock()
+
+    def submit(self, function, *arguments, **keywords):
+        future = Future()
+        future.set_running_or_notify_cancel() # the job starts at once, it cannot be cancelled any more
+        receiving, sending = self.context.Pipe(duplex=False)
+        process = self.context.Process(target=_run_job, args=(sending, function, arguments, keywords))
+        process.start()
+        sending.close()
+        watcher = threading.Thread(target=self._wait, args=(future, process, receiving), daemon=True)
+        with self.lock:
+            self.processes[future] = process
+            self.watchers = [thread for thread in self.watchers if thread.is_alive()] + [watcher]
+        watcher.start()
+        return future
+
+    def _wait(self, future, process, receiving):
+        try:
+            outcome = receiving.recv()
+        except EOFError: # the process died before it could send its result (e.g. out of memory)
+            outcome = None
+        receiving.close()
+        process.join()
+        with self.lock:
+            del self.processes[future]
+        if outcome is None:
+            future.set_exception(RuntimeError("the worker process exited with " + str(process.exitcode) + " before its job was done"))
+        elif outcome[0] == "result":
+            future.set_result(outcome[1])
+        else:
+            future.set_exception(outcome[1])
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        with self.lock:
+            watchers = list(self.watchers)
+        if wait:
+            for watcher in watchers:
+                watcher.join()
+
+
+class QueueExecutor(Executor):
+    """
+    Submits the jobs to a batch queue and completes their futures when the queue reports them done.
+
+    Inputs:
+        queue: object with submit(job_id, job), poll(job_id), result(job_id), cancel(job_id), close()
+        workers: list of subprocess.Popen of the workers started for this run (waited for at shutdown)
+    """
+
+    def __init__(self, queue, workers=()):
+        self.queue = queue
+        self.workers = list(workers)
+        self.futures = {}
+        self.n_submitted = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.poller = threading.Thread(target=self._poll, daemon=True)
+        self.poller.start()
+
+    def submit(self, function, *arguments, **keywords):
+        if keywords:
+            raise TypeError("jobs of the queue take positional arguments only")
+        future = Future()
+        with self.lock:
+            self.n_submitted += 1
+            job_id = str(self.n_submitted).zfill(6) # the workers take the jobs in this order
+            self.queue.submit(job_id, (function, arguments))
+            self.futures[job_id] = future
+        return future
+
+    def _poll(self):
+        while not self.stopped.wait(POLL_SECONDS):
+            with self.lock:
+                jobs = list(self.futures.items())
+            for job_id, future in jobs:
+                try:
+                    state = self.queue.poll(job_id)
+                    if state == "done":
+                        kind, value = self.queue.result(job_id)
+                        if kind == "result":
+                            future.set_result(value)
+                        else:
+                            future.set_exception(RuntimeError(value))
+                    elif state == "lost":
+                        self.queue.cancel(job_id)
+                        future.set_exception(RuntimeError("the job was lost (its worker stopped)"))
+                    else:
+                        continue
+                except Exception as error: # e.g. an unreadable result: the stage failed, the poller goes on
+                    future.set_exception(error)
+                with self.lock:
+                    del self.futures[job_id]
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.stopped.set()
+        self.poller.join()
+        with self.lock:
+            for job_id, future in self.futures.items():
+                self.queue.cancel(job_id)
+                future.cancel()
+            self.futures.clear()
+        self.queue.close()
+        if wait:
+            for worker in self.workers:
+                worker.wait()
+
+
+def start_queue_workers(configurations, queue_dir):
+    n_workers = int(configurations.get("queue_workers", "1") or 0)
+    command = [sys.executable, sys.path[0] + "/DTI_Pipeline.py", "--queue-worker", queue_dir]
+    launch = configurations.get("queue_worker_launch", "")
+    workers = []
+    for _ in range(n_workers):
+        if launch:
+            subprocess.call(launch.replace("{command}", " ".join(shlex.quote(argument) for argument in command)), shell=True, cwd=sys.path[0])
+        else:
+            workers.append(subprocess.Popen(command, cwd=sys.path[0]))
+    print(n_workers, "queue workers were started (" + ("with: " + launch if launch else "local processes") + "), jobs are queued in", queue_dir)
+    print("More workers can be started on any node with: ", " ".join(shlex.quote(argument) for argument in command))
+    return workers
+
+
+def make_executor(configurations, n_workers, worker_options):
+    """
+    Returns the executor of the config key "executor".
+
+    Inputs:
+        configurations: content of config_dti.json
+        n_workers: number of stages run at the same time (process pool)
+        worker_options: keyword arguments of the process pool
+    """
+    kind = executor_kind(configurations)
+    if kind == "inprocess":
+        return InProcessExecutor()
+    if kind == "pool":
+        if "max_tasks_per_child" in worker_options and sys.version_info < (3, 11):
+            return ProcessPerJobExecutor() # at most n_workers jobs are submitted at the same time by run_graph
+        return ProcessPoolExecutor(max_workers=n_workers, **worker_options)
+    queue_dir = configurations.get("queue_dir", "") or sys.path[0] + "/queue"
+    queue_dir += "/" + time.strftime("%Y%m%d_%H%M%S") + "_" + str(os.getpid()) # a queue per run: old jobs and workers do not interfere
+    queue = LocalFileQueue(queue_dir)
+    return QueueExecutor(queue, start_queue_workers(configurations, queue_dir))
@@ -6,7 +6,8 @@ Created on Fri 30 Sept 11:40:09 2022
 @author: anna speckert
 """
 import os
-import subprocess
+from pipe_helpers.command_executor import call
+from pipe_helpers.atomic_outputs import writing
 import ants
 
 def free_2_5tt_anat(base_dir, subj, free_ver): 
@@ -17,12 +18,12 @@ def free_2_5tt_anat(base_dir, subj, free_ver):
         print("5tt image in structural space already exists for subject ", subj)
     else:
         print("5tt image creating starts now for subject ", subj) 
-        subprocess.call(["mkdir", "-m777", base_dir + "/" + subj + "/processing/t2/Labels"])
-        subprocess.call(["5ttgen", "freesurfer", base_dir + "/" + subj + "/t2/aparc+aseg.mgz", base_dir + "/" + subj + "/processing/t2/Labels/5tt.mif", "-lut",  "/opt/freesurfer/freesurfer" + free_ver + "/FreeSurferColorLUT.txt"])
+        call(["mkdir", "-m777", base_dir + "/" + subj + "/processing/t2/Labels"])
+        call(["5ttgen", "freesurfer", base_dir + "/" + subj + "/t2/aparc+aseg.mgz", base_dir + "/" + subj + "/processing/t2/Labels/5tt.mif", "-lut",  "/opt/freesurfer/freesurfer" + free_ver + "/FreeSurferColorLUT.txt"])
         if os.path.exists(base_dir + "/" + subj + "/processing/t2/Labels/5tt.mif"):
             print("5tt image was created for subject ", subj, "within the anatomical space.")
         else:
-            subprocess.call(["5ttgen", "freesurfer", base_dir + "/" + subj + "/t2/aseg.mgz", base_dir + "/" + subj + "/processing/t2/Labels/5tt.mif", "-lut",  "/opt/freesurfer/freesurfer" + free_ver + "/FreeSurferColorLUT.txt"])
+            call(["5ttgen", "freesurfer", base_dir + "/" + subj + "/t2/aseg.mgz", base_dir + "/" + subj + "/processing/t2/Labels/5tt.mif", "-lut",  "/opt/freesurfer/freesurfer" + free_ver + "/FreeSurferColorLUT.txt"])
             if os.path.exists(base_dir + "/" + subj + "/processing/t2/Labels/5tt.mif"):
                 print("5tt image was created for subject ", subj, "within the anatomical space.")
             else: 
@@ -42,19 +43,20 @@ def fivett_2_dwi(base_dir, subj):
         tx = ants.registration(fixed = fixed, moving = moving, type_of_transform = "SyN")
         warped_moving = tx["warpedmovout"]
     # warped_moving.to_filename(base_dir + "/" + subj + "/processing/t2/Labels/t2_regtodwi.nii.gz")
-    # subprocess.call(["chmod", "a+rwx", base_dir + "/" + subj  + "/processing/t2/Labels/t2_regtodwi.nii.gz"])    
+    # call(["chmod", "a+rwx", base_dir + "/" + subj  + "/processing/t2/Labels/t2_regtodwi.nii.gz"])    
         print("Registration: Structural to diffusion space done.") # Until here it seemes to work
         
         #To apply this transformation matrix to other images: use ants.applytransform() command:
         
         print("Now the Tranformation on the 5tt image starts...") 
-        subprocess.call(["mrconvert", base_dir + "/" + subj + "/processing/t2/Labels/5tt.mif", base_dir + "/" + subj + "/processing/t2/Labels/5tt.nii.gz"])
+        call(["mrconvert", base_dir + "/" + subj + "/processing/t2/Labels/5tt.mif", base_dir + "/" + subj + "/processing/t2/Labels/5tt.nii.gz"])
         moving2 = ants.image_read(base_dir + "/" + subj  + "/processing/t2/Labels/5tt.nii.gz")
         mywarpedimage = ants.apply_transforms(fixed = fixed, moving = moving2, transformlist = tx["fwdtransforms"], interpolator = "nearestNeighbor", imagetype = 3) # nearestNeighbor before multiLabel  (3 stands for time series). 
         # interpolator "multiLabel": fast
         # interpolator "genericLabel": takes a long time. 
         
-        mywarpedimage.to_filename(base_dir + "/" + subj + "/processing/t2/Labels/5tt_reg_to_dwi.nii.gz")
-        subprocess.call(["chmod", "a+rwx", base_dir + "/" + subj  + "/processing/t2/Labels/5tt_reg_to_dwi.nii.gz"])    
+        with writing(base_dir + "/" + subj + "/processing/t2/Labels/5tt_reg_to_dwi.nii.gz") as partial:
+            mywarpedimage.to_filename(partial)
+        call(["chmod", "a+rwx", base_dir + "/" + subj  + "/processing/t2/Labels/5tt_reg_to_dwi.nii.gz"])    
         
         print("Transformation of 5tt image to diffusion space is done.")
\ No newline at end of file
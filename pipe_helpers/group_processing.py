@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Group steps of the DTI pipeline. They need the results of all subjects and are
+therefore run once for the whole cohort (group stages of the stage graph).
+
+@author: anna speckert
+"""
+import os
+import sys
+import time
+import subprocess
+
+from pipe_helpers.command_executor import call, output, is_dry_run
+from pipe_helpers.atomic_outputs import call_atomic
+from pipe_helpers.cohort_state import load_state, updating, file_signature, is_incremental, incremental_tolerance, rebuild_fraction
+from pipe_helpers.subject_processing import response_paths
+from pipe_helpers.resources import mrtrix_nthreads
+
+
+def normalise_to_template(base_dir, subj, norm_dir):
+    """
+    Does for one subject what dwinormalise group does for every subject, against the existing
+    FA template: FA map, registration to the template, template wm mask warped to the subject,
+    dwi scaled so that the median b0 intensity within the mask is 1000.
+
+    Output:
+        scale factor of the subject (None in a dry run)
+    """
+    dti_dir = base_dir + "/" + subj + "/processing/dti"
+    subj_dir = norm_dir + "/subjects/" + subj
+    call(["mkdir", "-p", "-m777", subj_dir])
+    call(["dwi2tensor", "-force", "-mask", dti_dir + "/hifi_nodif_brain_mask.mif", dti_dir + "/biascorr.mif", subj_dir + "/tensor.mif"] + mrtrix_nthreads(), check=True)
+    call(["tensor2metric", "-force", subj_dir + "/tensor.mif", "-fa", subj_dir + "/fa.mif"], check=True)
+    call(["mrregister", "-force", subj_dir + "/fa.mif", norm_dir + "/fa_template.mif", "-mask1", dti_dir + "/hifi_nodif_brain_mask.mif",
+          "-type", "rigid_affine_nonlinear", "-nl_warp_full", subj_dir + "/warp.mif"] + mrtrix_nthreads(), check=True)
+    call(["mrtransform", "-force", norm_dir + "/fa_template_wm_mask.mif", "-interp", "nearest", "-warp_full", subj_dir + "/warp.mif", "-from", "2",
+          "-template", subj_dir + "/fa.mif", subj_dir + "/wm_mask.mif"], check=True)
+    call(["dwiextract", "-force", "-bzero", dti_dir + "/biascorr.mif", subj_dir + "/b0.mif"], check=True)
+    call(["mrmath", "-force", subj_dir + "/b0.mif", "mean", "-axis", "3", subj_dir + "/b0_mean.mif"], check=True)
+    median = output(["mrstats", subj_dir + "/b0_mean.mif", "-mask", subj_dir + "/wm_mask.mif", "-output", "median"]).strip()
+    scale = 1000.0 / float(median) if median else None
+    call_atomic(["mrcalc", dti_dir + "/biascorr.mif", str(scale), "-mult", norm_dir + "/dwi_output/" + subj + ".mif"], [norm_dir + "/dwi_output/" + subj + ".mif"], check=True)
+    for name in ("tensor.mif", "b0.mif", "b0_mean.mif", "warp.mif"):
+        if os.path.exists(subj_dir + "/" + name):
+            os.remove(subj_dir + "/" + name)
+    return scale
+
+
+# This step is only neccessary when comparing groups: Global intensity normalisation across subjects
+     # input: (1) directory with all biascorrected images & (2) directory with brain masks (hard links to the subject folders)
+     # functionality: uses dwinormalise group to perform intenstiy normalisation
+     # output: GroupComparison folder, normalised images (dwi_output, linked to subj/processing/dti/bias_normcorr.mif)
+     # In the incremental cohort mode (see cohort_state.py) only new or changed subjects are normalised against the existing FA template.
+def group_intensity_normalisation(base_dir, subjects, configurations):
+    wor_dir = sys.path[0]
+    norm_dir = wor_dir + "/GroupComparison/dwinormalise"
+    if os.path.exists(norm_dir + "/"):
+        print("The GroupComparison/dwi_normalise folder already exists in the working directory.")
+    else:
+        print("Global intensity normalisation for group comparison starts now. Creating folders...")
+        # Create directories
+        call(["mkdir", "-p", "-m777", wor_dir + "/GroupComparison"])
+        call(["mkdir", "-p", "-m777", norm_dir])
+        call(["mkdir", "-p", "-m777", norm_dir + "/dwi_input"])
+        call(["mkdir", "-p", "-m777", norm_dir + "/mask_input"])
+
+    state = load_state(wor_dir).get("intensity normalisation", {})
+    template_subjects = state.get("template_subjects", [])
+    normalised = state.get("subjects", {})
+    signatures = {subj: file_signature(base_dir + "/" + subj + "/processing/dti/biascorr.mif") for subj in subjects}
+    outside_template = [subj for subj in subjects if subj not in template_subjects or normalised.get(subj, {}).get("input") != signatures[subj]]
+    tic_gin = time.time()
+    if is_incremental(configurations) and template_subjects and os.path.exists(norm_dir + "/fa_template_wm_mask.mif") \
+            and len(outside_template) <= rebuild_fraction(configurations) * len(template_subjects):
+        todo = [subj for subj in subjects if normalised.get(subj, {}).get("input") != signatures[subj] or not os.path.exists(norm_dir + "/dwi_output/" + subj + ".mif")]
+        print(len(todo), "new or changed subjects are normalised against the FA template of ", len(template_subjects), "subjects...")
+        for subj in todo:
+            try:
+                scale = normalise_to_template(base_dir, subj, norm_dir)
+            except (subprocess.CalledProcessError, ValueError) as error:
+                print("The intensity normalisation of ", subj, "against the FA template did not work: ", error)
+                return "group intensity normalisation"
+            normalised[subj] = {"input": signatures[subj], "scale": scale}
+    else:
+        if template_subjects:
+            print(len(outside_template), "of ", len(subjects), "subjects are not part of the FA template, it is built again from all subjects.")
+        # Link dwi and mask images into the input folders (hard links: no data is copied), subjects no longer in the cohort are taken out
+        for name in (os.listdir(norm_dir + "/dwi_input") if os.path.isdir(norm_dir + "/dwi_input") else []):
+            if name[:-len(".mif")] not in subjects:
+                call(["rm", norm_dir + "/dwi_input/" + name])
+        for name in (os.listdir(norm_dir + "/mask_input") if os.path.isdir(norm_dir + "/mask_input") else []):
+            if name[:-len("_mask.mif")] not in subjects:
+                call(["rm", norm_dir + "/mask_input/" + name])
+        for subj in subjects:
+            print("Global intensity normalisation starts for Subject ID: ", subj)
+            call(["ln", "-f", base_dir + "/" + subj + "/processing/dti/biascorr.mif", norm_dir + "/dwi_input/" + subj + ".mif"])
+            call(["ln", "-f", base_dir + "/" + subj + "/processing/dti/hifi_nodif_brain_mask.mif", norm_dir + "/mask_input/" + subj + "_mask.mif"])
+
+        # group normalisation
+        call(["dwinormalise", "group", "-force", norm_dir + "/dwi_input", norm_dir + "/mask_input", norm_dir + "/dwi_output/", norm_dir + "/fa_template.mif", norm_dir + "/fa_template_wm_mask.mif", "-fa_threshold", "0.15"] + mrtrix_nthreads())
+        if not os.path.exists(norm_dir + "/dwi_output") and not is_dry_run():
+            print("Global intensity normalisation did not work.")
+            return "group intensity normalisation"
+        template_subjects = list(subjects)
+        normalised = {subj: {"input": signatures[subj], "scale": None} for subj in subjects}
+        todo = subjects
+    # the normalised dwi of every subject also appears in its own folder, as processing/dti/bias_normcorr.mif
+    for subj in todo:
+        call(["ln", "-f", norm_dir + "/dwi_output/" + subj + ".mif", base_dir + "/" + subj + "/processing/dti/bias_normcorr.mif"])
+    toc_gin = time.time()
+    print("Global intensity normalisation took ", toc_gin-tic_gin, "seconds.")
+    if not is_dry_run():
+        with updating(wor_dir, "intensity normalisation") as stored:
+            stored.update(template_subjects=template_subjects, subjects=normalised)
+
+
+GROUP_RESPONSE_FILES = {"SSST": ["response_sing_wm_mean.txt"],
+                        "SS2T": ["response_twotiss_wm_mean.txt", "response_twotiss_csf_mean.txt"],
+                        "SS3T": ["response_threetiss_wm_mean.txt", "response_threetiss_gm_mean.txt", "response_threetiss_csf_mean.txt"]}
+
+
+def update_response_sums(state, subject_files):
+    """
+    Brings the running sums of the group response (see response_average.py) up to date.
+    Only subjects which are new, changed or no longer in the cohort are read resp. taken out.
+
+    Inputs:
+        state: "response" section of the cohort state: {"subjects": {subj: {"hashes", "responses"}}, "sums": [per tissue]} (changed in place)
+        subject_files: {subj: [response file per tissue]}
+
+    Output:
+        (added or changed subjects, removed subjects)
+    """
+    from pipe_helpers.response_average import read_response, ResponseSums # numpy is only imported when averaging
+    from pipe_helpers.stage_cache import file_hash
+    n_tissues = len(next(iter(subject_files.values())))
+    sums = [ResponseSums.from_dict(tissue_sums) for tissue_sums in state["sums"]] or [ResponseSums() for _ in range(n_tissues)]
+    stored = state["subjects"]
+    removed = [subj for subj in stored if subj not in subject_files]
+    changed = []
+    for subj, paths in subject_files.items():
+        hashes = [file_hash(path) for path in paths]
+        if subj in stored and stored[subj]["hashes"] == hashes:
+            continue
+        changed.append(subj)
+    for subj in removed + [subj for subj in changed if subj in stored]:
+        for tissue, response in enumerate(stored.pop(subj)["responses"]):
+            sums[tissue].remove(response)
+    for subj in changed:
+        responses = [read_response(path) for path in subject_files[subj]]
+        for tissue, response in enumerate(responses):
+            sums[tissue].add(response)
+        stored[subj] = {"hashes": [file_hash(path) for path in subject_files[subj]], "responses": [response.tolist() for response in responses]}
+    state["sums"] = [tissue_sums.to_dict() for tissue_sums in sums]
+    return changed, removed
+
+
+# Create an average response function over all subjects (single-, two- or three-tissue case).
+# The running sums of the average are kept in the cohort state (see cohort_state.py), so a cohort which grows
+# only adds its new subjects. The average is only rewritten if it moved by more than the tolerance of the cohort mode.
+def group_response_mean(base_dir, subjects, configurations):
+    from pipe_helpers.response_average import ResponseSums, write_response, relative_change
+    wor_dir = sys.path[0]
+    rfe = configurations["rfe"]
+    mean_dir = wor_dir + "/GroupComparison/responsemean"
+    if os.path.exists(mean_dir + "/"):
+        print("The Groupmean folder was already created.")
+    else:
+        call(["mkdir", "-p", "-m777", mean_dir])
+
+    if len(subjects) == 0:
+        print("There are no response functions to average.")
+        return "response function average"
+    mean_files = [mean_dir + "/" + name for name in GROUP_RESPONSE_FILES[rfe]]
+    if is_dry_run():
+        print("    average of the response functions of", len(subjects), "subjects (in-process) ->", " ".join(mean_files))
+        return
+    state = load_state(wor_dir).get("response", {})
+    if state.get("rfe") != rfe:
+        state = {"rfe": rfe, "subjects": {}, "sums": []}
+
+    print("Response functions of ", len(subjects), "subjects from ", rfe, "are averaged... ")
+    try:
+        changed, removed = update_response_sums(state, {subj: response_paths(base_dir, subj, rfe) for subj in subjects})
+        averages = [ResponseSums.from_dict(tissue_sums).average() for tissue_sums in state["sums"]]
+    except (OSError, ValueError) as error:
+        print("Response functions from ", rfe, "could not be averaged: ", error)
+        return "response function average"
+    print(len(changed), "subjects were added or updated,", len(removed), "taken out.")
+
+    change = None
+    if state.get("published") is not None and all(os.path.exists(mean_file) for mean_file in mean_files):
+        change = max(relative_change(average, published) for average, published in zip(averages, state["published"]))
+    if change is None or change > incremental_tolerance(configurations):
+        for average, mean_file in zip(averages, mean_files):
+            write_response(mean_file, average, "mean of " + str(len(subjects)) + " subjects (responsemean scaling)")
+            call(["chmod", "a+rwx", mean_file])
+        state["published"] = [average.tolist() for average in averages]
+        print("Response function from ", rfe, "was averaged under: ", mean_dir + "/")
+    else:
+        print("The group response function changed by ", round(100 * change, 3), "% (tolerance ", 100 * incremental_tolerance(configurations),
+              "%). The published average is kept, the FODs of the other subjects stay valid.")
+    with updating(wor_dir, "response") as stored:
+        stored.clear()
+        stored.update(state)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Writing of NIfTI images from the python helpers (segmentation, 5tt, denoising).
+
+    - .nii.gz is compressed in parallel: the image is cut into blocks of
+      BLOCK_BYTES which are compressed by a pool of threads (zlib releases the
+      GIL) and written as consecutive gzip members. A file of several members is
+      a valid gzip file: nibabel, MRtrix, FSL, ITK and gunzip read it as usual.
+    - save() writes atomically (see atomic_outputs.py) and sets the data type of
+      the header to the one of the array.
+    - saving() runs independent saves at the same time:
+
+          with saving() as saves:
+              for k in range(1, 9):
+                  saves.submit(image_writer.save, probabilities[k], path_k, affine, header)
+
+      The block ends when all images are written (and raises the first error).
+
+The number of threads is the one given to the stage (OMP_NUM_THREADS, see
+resources.py), otherwise the cores of the machine.
+
+@author: anna speckert
+"""
+import io
+import os
+import zlib
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from pipe_helpers.atomic_outputs import writing
+from pipe_helpers.resources import machine_threads
+
+
+BLOCK_BYTES = 16 * 1024**2
+COMPRESS_LEVEL = 1 # as nibabel: fast, the images are mostly background
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def n_threads():
+    return int(os.environ.get("OMP_NUM_THREADS", "") or machine_threads())
+
+
+def compression_pool():
+    # one pool per process (and per fork: a forked worker does not inherit the threads)
+    with _pools_lock:
+        pid = os.getpid()
+        if _pools.get("pid") != pid:
+            _pools.update(pid=pid, pool=ThreadPoolExecutor(max_workers=n_threads()))
+        return _pools["pool"]
+
+
+def gzip_member(block, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31) # 31: with gzip header and trailer
+    return compressor.compress(block) + compressor.flush()
+
+
+class ParallelGzipFile(io.RawIOBase):
+    """
+    Write-only file object compressing what is written to it in parallel, as one gzip member
+    per block. At most 2 blocks per thread are compressed at the same time, so the memory
+    used is bounded whatever the size of the image.
+    """
+
+    def __init__(self, path, level=COMPRESS_LEVEL):
+        super().__init__()
+        self.file = open(path, "wb")
+        self.level = level
+        self.pool = compression_pool()
+        self.pending = []
+        self.buffer = bytearray()
+        self.position = 0
+
+    def write(self, data):
+        view = memoryview(data).cast("B")
+        self.position += len(view)
+        start = 0
+        if self.buffer:
+            start = min(len(view), BLOCK_BYTES - len(self.buffer))
+            self.buffer += view[:start]
+            if len(self.buffer) < BLOCK_BYTES:
+                return len(view)
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while len(view) - start >= BLOCK_BYTES: # large writes (the image data) are cut without going through the buffer
+            self._submit(bytes(view[start:start + BLOCK_BYTES]))
+            start += BLOCK_BYTES
+        self.buffer += view[start:]
+        return len(view)
+
+    def _submit(self, block):
+        self.pending.append(self.pool.submit(gzip_member, block, self.level))
+        while len(self.pending) > 2 * n_threads():
+            self.file.write(self.pending.pop(0).result())
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=0):
+        # nibabel only seeks to where it already is resp. forward to the data offset
+        target = offset if whence == 0 else self.position + offset
+        if target < self.position:
+            raise OSError("a compressed image cannot be written backwards")
+        self.write(bytes(target - self.position))
+        return self.position
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffer or not self.pending:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            for compressed in self.pending:
+                self.file.write(compressed.result())
+            self.pending = []
+        finally:
+            self.file.close()
+            super().close()
+
+
+def save(data, path, affine=None, header=None):
+    """
+    Saves an array resp. a nibabel image as NIfTI (path ending with .nii or .nii.gz).
+
+    Inputs:
+        data: numpy array or nibabel image
+        affine, header: of the new image if data is an array (e.g. those of the image it was computed from)
+    """
+    import nibabel as nib
+    if isinstance(data, nib.spatialimages.SpatialImage):
+        image = data
+    else:
+        image = nib.Nifti1Image(data, affine, header)
+        image.header.set_data_dtype(data.dtype)
+    with writing(path) as partial:
+        if path.endswith(".gz"):
+            with ParallelGzipFile(partial) as compressed:
+                image.to_file_map({"image": nib.FileHolder(fileobj=compressed)})
+        else:
+            image.to_filename(partial)
+
+
+class Saves:
+    def __init__(self, pool):
+        self.pool = pool
+        self.futures = []
+
+    def submit(self, function, *arguments):
+        self.futures.append(self.pool.submit(function, *arguments))
+
+
+@contextmanager
+def saving(max_saves=None):
+    """Yields a Saves for saves which do not depend on each other, waits for all of them at the end."""
+    with ThreadPoolExecutor(max_workers=max_saves or min(8, n_threads())) as pool:
+        saves = Saves(pool)
+        yield saves
+    for future in saves.futures:
+        future.result()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A batch queue made of directories, the stand-in for a cluster queue (SLURM,
+SGE, ...) used by the "queue" executor (see execution_backends.py).
+
+The launching pipeline submits jobs, workers on any machine which sees the
+queue directory (shared file system) take them one after the other:
+
+    queue_dir/jobs/<id>.pkl      the pickled job (stage function and arguments)
+    queue_dir/pending/<id>       waiting; a worker takes it by renaming it to
+    queue_dir/running/<id>       host and pid of the worker, touched every HEARTBEAT seconds
+    queue_dir/done/<id>.pkl      ("result", value) resp. ("error", message)
+    queue_dir/closed             no more jobs will come, idle workers exit
+
+A worker is started with
+    python DTI_Pipeline.py --queue-worker <queue_dir>
+and runs every job in a fresh process, like the local process pool. A job
+whose worker stops sending heartbeats (node lost, worker killed) is reported
+as lost, the stage graph then retries it like a stage whose worker died.
+
+A real batch system only needs the same five methods as LocalFileQueue
+(submit, poll, result, cancel, close). take, job and finish are the worker side,
+for workers which run the jobs themselves (segmentation_server.py).
+
+@author: anna speckert
+"""
+import os
+import time
+import pickle
+import socket
+import multiprocessing
+
+from pipe_helpers.atomic_outputs import writing
+
+
+HEARTBEAT = 10 # seconds between two signs of life of a running job
+LOST_AFTER = 6 * HEARTBEAT
+
+
+class LocalFileQueue:
+    """Submit/poll interface of the queue in queue_dir."""
+
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+        for name in ("jobs", "pending", "running", "done"):
+            os.makedirs(queue_dir + "/" + name, exist_ok=True)
+        if os.path.exists(queue_dir + "/closed"):
+            os.remove(queue_dir + "/closed")
+
+    def submit(self, job_id, job):
+        with writing(self.queue_dir + "/jobs/" + job_id + ".pkl") as partial:
+            with open(partial, "wb") as job_file:
+                pickle.dump(job, job_file)
+        open(self.queue_dir + "/pending/" + job_id, "w").close()
+
+    def poll(self, job_id):
+        """Returns 'pending', 'running', 'done' or 'lost'."""
+        for _ in range(2): # a job moving on between two checks is found the second time
+            if os.path.exists(self.queue_dir + "/done/" + job_id + ".pkl"):
+                return "done"
+            try:
+                heartbeat = os.path.getmtime(self.queue_dir + "/running/" + job_id)
+                return "running" if time.time() - heartbeat < LOST_AFTER else "lost"
+            except OSError:
+                pass
+            if os.path.exists(self.queue_dir + "/pending/" + job_id):
+                return "pending"
+        return "lost"
+
+    def result(self, job_id):
+        with open(self.queue_dir + "/done/" + job_id + ".pkl", "rb") as result_file:
+            result = pickle.load(result_file)
+        for path in (self.queue_dir + "/done/" + job_id + ".pkl", self.queue_dir + "/jobs/" + job_id + ".pkl"):
+            os.remove(path)
+        return result
+
+    def cancel(self, job_id):
+        for path in (self.queue_dir + "/pending/" + job_id, self.queue_dir + "/running/" + job_id):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def close(self):
+        open(self.queue_dir + "/closed", "w").close()
+
+    def take(self):
+        """Claims the oldest pending job, returns its id (None if there is none). The caller keeps its heartbeat."""
+        return _claim(self.queue_dir)
+
+    def job(self, job_id):
+        with open(self.queue_dir + "/jobs/" + job_id + ".pkl", "rb") as job_file:
+            return pickle.load(job_file)
+
+    def finish(self, job_id, result):
+        """Stores ("result", value) resp. ("error", message) of a taken job."""
+        _write_result(self.queue_dir, job_id, result)
+        if os.path.exists(self.queue_dir + "/running/" + job_id):
+            os.remove(self.queue_dir + "/running/" + job_id)
+
+
+###############
+### WORKER ###
+###############
+
+def _run_job(queue_dir, job_id):
+    # runs in a fresh process
+    with open(queue_dir + "/jobs/" + job_id + ".pkl", "rb") as job_file:
+        function, arguments = pickle.load(job_file)
+    try:
+        result = ("result", function(*arguments))
+    except Exception as error:
+        result = ("error", type(error).__name__ + ": " + str(error))
+    _write_result(queue_dir, job_id, result)
+
+
+def _write_result(queue_dir, job_id, result):
+    with writing(queue_dir + "/done/" + job_id + ".pkl") as partial:
+        with open(partial, "wb") as result_file:
+            pickle.dump(result, result_file)
+
+
+def _claim(queue_dir):
+    # the rename succeeds for exactly one worker
+    for job_id in sorted(os.listdir(queue_dir + "/pending")):
+        try:
+            os.rename(queue_dir + "/pending/" + job_id, queue_dir + "/running/" + job_id)
+        except OSError:
+            continue
+        with open(queue_dir + "/running/" + job_id, "w") as running:
+            running.write(socket.gethostname() + " " + str(os.getpid()) + "\n")
+        return job_id
+    return None
+
+
+def run_worker(queue_dir, idle_exit=None):
+    """
+    Takes jobs from the queue until it is closed (resp. nothing came for idle_exit seconds).
+
+    Inputs:
+        queue_dir: directory of the queue
+        idle_exit: seconds without a job after which the worker exits (None = wait until closed)
+    """
+    context = multiprocessing.get_context("spawn")
+    if not os.path.isdir(queue_dir + "/pending"):
+        print(queue_dir, "is not the queue of a run: a run queues its jobs in a subdirectory <date>_<time>_<pid> of the queue_dir, which it prints at its start.")
+        return
+    print("Queue worker", socket.gethostname(), os.getpid(), "takes jobs from", queue_dir)
+    idle_since = time.time()
+    while os.path.isdir(queue_dir + "/pending"):
+        job_id = _claim(queue_dir)
+        if job_id is None:
+            if os.path.exists(queue_dir + "/closed") or (idle_exit is not None and time.time() - idle_since > idle_exit):
+                break
+            time.sleep(1)
+            continue
+        running = queue_dir + "/running/" + job_id
+        process = context.Process(target=_run_job, args=(queue_dir, job_id))
+        process.start()
+        while process.is_alive():
+            process.join(HEARTBEAT)
+            if os.path.exists(running):
+                os.utime(running)
+        if process.exitcode != 0 and not os.path.exists(queue_dir + "/done/" + job_id + ".pkl"):
+            _write_result(queue_dir, job_id, ("error", "worker died (exit code " + str(process.exitcode) + ")"))
+        if os.path.exists(running):
+            os.remove(running)
+        idle_since = time.time()
+    print("Queue worker", socket.gethostname(), os.getpid(), "stops.")
+
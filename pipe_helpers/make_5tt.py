@@ -6,113 +6,90 @@
 import nibabel as nib # nifti library
 import numpy as np
 import os 
-import subprocess
+from pipe_helpers.command_executor import call
+from pipe_helpers import image_writer
 
-def m_5tt(data_dir): # data_dir = base_dir + subj
-   
-    
-    # Creates 4D file, where the 8 label probabilities are concatenated along the 4th dimension
-    os.chdir(data_dir + "processing/t2/Labels/")
-    
-    os.system('fslmerge -t all_problabels.nii.gz label_prob_1.nii.gz label_prob_2.nii.gz label_prob_3.nii.gz label_prob_4.nii.gz label_prob_5.nii.gz label_prob_6.nii.gz label_prob_7.nii.gz label_prob_8.nii.gz')
-    subprocess.call(["chmod", "a+rwx", data_dir + "processing/t2/Labels/all_problabels.nii.gz"])
-    
-    print("The 4D label image 'all_problabels.nii.gz' was created. Now the creation of the 5tt/3tt image starts..") 
-    
-    # Loading the all label image
-    #nii = nib.load("all_labels_anna.nii.gz") # this is the nifti file which was created with the old labels. 
-    nii = nib.load("all_problabels.nii.gz") # see old_stuff: labels_all.nii.gz (this is the correct image to start from) 
-    nii_hdr = nii.header # header info
-    affine = nii.affine
-    nii_data = nii.get_fdata() # get the actual data 
-    
-    
-    sizex = nii_data.shape[0]
-    sizey = nii_data.shape[1]
-    sizez = nii_data.shape[2]
-    
-    # Creates 5 x 3D images per 5tt label. 
-    # The numbes in the end are all actual label number -1 because it starts at 0 
-    corGM = nii_data[:,:,:,1]
-    subcorGM = (nii_data[:,:,:,5]+nii_data[:,:,:,7])
-    WM = (nii_data[:,:,:,2] + nii_data[:,:,:,4] + nii_data[:,:,:,6])
-    CSF = (nii_data[:,:,:,0] + nii_data[:,:,:,3])
-    patho = np.zeros((sizex, sizey, sizez))
-    
-    
-    # Change Dimensions: Because we have 3D images now and no longer 4D 
-    newdim = [1, 400, 400, 400, 1, 1, 1, 1]
-    nii_hdr["dim"] = newdim # overwrite header
-    
-    # Before saving the image, one needs to apply the new header
-    x_corGM = nib.Nifti1Image(corGM, affine, nii_hdr)
-    x_subcorGM = nib.Nifti1Image(subcorGM, affine, nii_hdr)
-    x_WM = nib.Nifti1Image(WM, affine, nii_hdr)
-    x_CSF = nib.Nifti1Image(CSF, affine, nii_hdr)
-    x_patho = nib.Nifti1Image(patho, affine, nii_hdr)
-    
-    
-    #### ACTIVATE THIS PART TO REALLY CREATE THE 3D images
-    # Saving the actual nifti files to the label folder
-    nib.save(x_corGM, "corGM.nii.gz")
-    nib.save(x_subcorGM, "subcorGM.nii.gz")
-    nib.save(x_WM, "WM.nii.gz")
-    nib.save(x_CSF, "CSF.nii.gz")
-    nib.save(x_patho, "patho.nii.gz")
-    subprocess.call(["chmod", "a+rwx", data_dir + "processing/t2/Labels/corGM.nii.gz"])
-    subprocess.call(["chmod", "a+rwx", data_dir + "processing/t2/Labels/subcorGM.nii.gz"])
-    subprocess.call(["chmod", "a+rwx", data_dir + "processing/t2/Labels/WM.nii.gz"])
-    subprocess.call(["chmod", "a+rwx", data_dir + "processing/t2/Labels/CSF.nii.gz"])
-    subprocess.call(["chmod", "a+rwx", data_dir + "processing/t2/Labels/patho.nii.gz"])
-    
-    print('Five 3D images per label were created. Now they will be merged together along 4th dimension to a single 4D image...')
-    
-    # Merging the 3D files along the 4th axis with with FSL (maybe there exists a simple solution with python?)
-    os.system('fslmerge -t 5tt_draft.nii.gz corGM.nii.gz subcorGM.nii.gz WM.nii.gz CSF.nii.gz patho.nii.gz') 
-    subprocess.call(["chmod", "a+rwx", data_dir + "processing/t2/Labels/5tt_draft.nii.gz"])    
-    
-    print("A first draft of the 5tt image was created. Now it needs to be corrected so that it meets the MRtrix requirements...") 
-    
-    # Sum of voxels per label should always be 1 and the rest 0: 
-    # Take 5tt image which was created by running fslmerge on the 5 separate 3D files to create 4D file 
-    nii5 = nib.load("5tt_draft.nii.gz")
-    affine5 = nii5.affine
-    nii5_hdr = nii5.header
-    nii5_data = nii5.get_fdata()
-    
-    
+# tissue (volume of the 5tt image) of every UNet label: 0 cortical GM, 1 subcortical GM, 2 WM, 3 CSF (4 pathological tissue stays 0)
+LABEL_TISSUES = {1: 3, 2: 0, 3: 2, 4: 3, 5: 2, 6: 1, 7: 2, 8: 1}
+SLAB = 16 # z-slices corrected at once
+
+
+def threshold(value):
+    # the thresholds of correct_slab for one value
+    return 0.0 if value < 0.01 else 1.0 if value > 0.99 else float(value)
+
+
+def correct_slab(nii5_data, maxima):
+    """
+    Corrects (part of) a draft 5tt image (x, y, z, 5) in place so that it meets the MRtrix requirements.
+
+    Inputs:
+        nii5_data: draft 5tt image resp. a z-slab of it
+        maxima: maximum of the thresholded tissues 0-3 over the whole image
+
+    Output:
+        corrected 5tt image
+    """
     # outside of the brain it should be 0, and the sum within the brain 1 (of label dimension)
     nii5_data[nii5_data < 0.01] = 0
     nii5_data[nii5_data > 0.99] = 1
-    
+
     # Since the image values may or may not take values larger than 1, it does a normalisation to 3D maximum. This should not change anything if the maximum intensity is already 1. 
     for t in range(4):
-        nii5_data[:,:,:,t] = np.absolute(nii5_data[:,:,:,t]/np.amax(np.amax(np.amax(nii5_data[:,:,:,t]))))
-    
-    
-    difference = np.ones((sizex, sizey, sizez)) - np.sum(nii5_data, 3)
-    CSF_new = nii5_data[:,:,:,3] + (difference * (difference<0.2))
-    
-    nii5_data = np.stack((nii5_data[:,:,:,0], nii5_data[:,:,:,1], nii5_data[:,:,:,2], CSF_new, nii5_data[:,:,:,4]), axis = 3) # here might have happend a mistake np.stack creates a NEW dimension. Double check Anna! 
-    
-    summed = np.sum(nii5_data, 3) # shape: (400, 400, 400)
-    
-    selected = ((summed!=1) & (summed!=0)) # selected = boolean array (shape: 400, 400, 400)
-    
-    
-    selected4D = np.stack((selected, selected, selected, selected, selected), axis = 3)
-    nii5_data[selected4D] = 0 
-    
-    
-    x_nii5 = nib.Nifti1Image(nii5_data, affine5, nii5_hdr)
-    
-    nib.save(x_nii5, "5tt.nii.gz") 
-    subprocess.call(["chmod", "a+rwx", data_dir + "processing/t2/Labels/5tt.nii.gz"])    
+        nii5_data[:,:,:,t] = np.absolute(nii5_data[:,:,:,t]/maxima[t])
+
+    difference = 1 - np.sum(nii5_data, 3)
+    nii5_data[:,:,:,3] += difference * (difference<0.2) # CSF takes up what is missing to 1
+
+    summed = np.sum(nii5_data, 3)
+    selected = ((summed!=1) & (summed!=0)) # voxels which still do not sum up to 1 are set to 0
+    nii5_data[selected] = 0
+    return nii5_data
+
+
+def tissue_maxima(nii5_data):
+    # thresholding does not change the order of the values: the maximum of the thresholded tissue is the thresholded maximum
+    return [threshold(nii5_data[:,:,:,t].max()) for t in range(4)]
+
+
+def correct_slabs(fivett):
+    """Corrects a draft 5tt image (x, y, z, 5, float32) in place, SLAB z-slices at a time (in float64)."""
+    maxima = tissue_maxima(fivett)
+    for z in range(0, fivett.shape[2], SLAB):
+        fivett[:,:,z:z+SLAB] = correct_slab(fivett[:,:,z:z+SLAB].astype(np.float64), maxima)
+    return fivett
+
+
+def build_5tt(label_paths, fivett_path):
+    """
+    Creates the 5tt image from the 8 probability labels of the UNet in one pass: every label is
+    read once (float32) and added to its tissue, the tissues are corrected slab by slab in place
+    and written directly. Needs the 5tt image (float32) plus one label in memory, instead of
+    the 4D label image, the tissue images and the draft 5tt in float64.
+
+    Inputs:
+        label_paths: label_prob_1 ... label_prob_8
+        fivett_path: output (.nii.gz)
+    """
+    first = nib.load(label_paths[0])
+    shape = first.shape[:3]
+    fivett = np.zeros(shape + (5,), dtype=np.float32, order="F") # F order: every tissue is one contiguous block, as in the file
+    for label, path in enumerate(label_paths, start=1):
+        fivett[:,:,:,LABEL_TISSUES[label]] += nib.load(path).get_fdata(dtype=np.float32)
+    correct_slabs(fivett)
+    image_writer.save(fivett, fivett_path, first.affine, first.header)
+
+
+def m_5tt(data_dir): # data_dir = base_dir + subj
+    os.chdir(data_dir + "processing/t2/Labels/")
+    print("The 5tt image is created from the 8 label probabilities...")
+    build_5tt(["label_prob_" + str(k) + ".nii.gz" for k in range(1, 9)], "5tt.nii.gz") # 5tt.nii.gz only appears when it is complete
+    call(["chmod", "a+rwx", data_dir + "processing/t2/Labels/5tt.nii.gz"])
     print("The '5tt.nii.gz' was created in the labels folder.")
     
     
     print("Now the 5ttcheck command from Mrtrix checks if the 5tt meets the criteria..")
     
-    os.system('5ttcheck 5tt.nii.gz')
+    call('5ttcheck 5tt.nii.gz', shell=True)
     
     
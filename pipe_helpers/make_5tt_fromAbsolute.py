@@ -11,114 +11,80 @@ Created on Tue Apr 11 15:19:19 2023
 import nibabel as nib 
 import numpy as np
 import os 
-import subprocess
+from pipe_helpers.make_5tt import LABEL_TISSUES
+from pipe_helpers.command_executor import call
+from pipe_helpers import image_writer
 
-def m_5tt_fromAbs(data_dir): # data_dir = base_dir + subj
+
+# Label to tissue tables: label -> tissue of the 5tt image (0 cortical GM, 1 subcortical GM, 2 WM, 3 CSF, 4 pathological
+# tissue) resp. a list of 5 tissue fractions. Labels which are not in the table (background) get no tissue.
+# A label scheme is chosen by its name (scheme of m_5tt_fromAbs), other schemes are added here.
+LABEL_TABLES = {"unet": LABEL_TISSUES} # the 8 labels of the neonatal UNet (see make_5tt.py)
+
+
+def label_table(scheme):
+    """Returns the label to tissue table of a label scheme (one of LABEL_TABLES)."""
+    if scheme not in LABEL_TABLES:
+        raise ValueError("Unknown label scheme " + str(scheme) + ", choose one of " + ", ".join(LABEL_TABLES))
+    return LABEL_TABLES[scheme]
+
+
+def tissue_lut(table):
+    """Returns the lookup table (256 labels x 5 tissues, float32) of a label to tissue table."""
+    lut = np.zeros((256, 5), dtype=np.float32)
+    for label, tissue in table.items():
+        if isinstance(tissue, int):
+            lut[label, tissue] = 1
+        else:
+            lut[label] = tissue
+    return lut
+
+
+def labels_to_5tt(label_data, scheme="unet"):
+    """
+    Maps a label image with hard labels (absolute values) to the 5tt image in one lookup per tissue.
+    Only the 5tt image (x, y, z, 5, float32) and a uint8 copy of the labels are allocated.
+
+    Inputs:
+        label_data: 3D label image (any numeric type, the labels are rounded to integers 0-255)
+        scheme: label scheme of the image (see LABEL_TABLES)
+
+    Output:
+        5tt image. One-hot labels already meet the MRtrix requirements (values 0/1, sum 0 or 1), so
+        the correction of make_5tt is not needed.
+    """
+    if label_data.dtype != np.uint8:
+        label_data = np.rint(label_data)
+        label_data[(label_data < 0) | (label_data > 255)] = 0 # unknown labels: background
+        label_data = label_data.astype(np.uint8)
+    lut = tissue_lut(label_table(scheme))
+    fivett = np.empty(label_data.shape[:3] + (5,), dtype=np.float32, order="F") # as written to the file: one tissue after the other
+    for t in range(5):
+        np.take(lut[:, t], label_data, out=fivett[:,:,:,t], mode="clip")
+    return fivett
+
+
+def m_5tt_fromAbs(data_dir, scheme="unet"): # data_dir = base_dir + subj, scheme: label scheme of the labels (see LABEL_TABLES)
+    label_table(scheme) # an unknown scheme fails before anything is created
     
     # Loading the all label image
 
     os.chdir(data_dir + "processing/t2/")
-    os.system('mkdir Labels')
-    os.system('chmod a+rwx ./Labels')
+    call(["mkdir", "-m777", "Labels"])
     
     nii = nib.load("T2_SVRTK_reformatted_labels_kelly.nii.gz") # see old_stuff: labels_all.nii.gz (this is the correct image to start from) 
-    nii_hdr = nii.header # header info
-    affine = nii.affine
-    nii_data = nii.get_fdata() # get the actual data 
-    sizex = nii_data.shape[0]
-    sizey = nii_data.shape[1]
-    sizez = nii_data.shape[2]
-    
-    # make a 4D image 
-    labels = np.zeros((sizex, sizey, sizez, 8))
-
-    for i in range(1, 9):
-        labels[..., i-1] = (nii_data == i)
-    
-    
-    # Creates 5 x 3D images per 5tt label. 
-    # The numbes in the end are all actual label number -1 because it starts at 0 
-    corGM = labels[:,:,:,1]
-    subcorGM = (labels[:,:,:,5]+labels[:,:,:,7])
-    WM = labels[:,:,:,2] + labels[:,:,:,4] + labels[:,:,:,6]
-    CSF = (labels[:,:,:,0] + labels[:,:,:,3])
-    patho = np.zeros((sizex, sizey, sizez))
-    
-    
-    # Change Dimensions: Because we have 3D images now and no longer 4D 
-    newdim = [1, 400, 400, 400, 1, 1, 1, 1]
-    nii_hdr["dim"] = newdim # overwrite header
-    
-    # Before saving the image, one needs to apply the new header
-    x_corGM = nib.Nifti1Image(corGM, affine, nii_hdr)
-    x_subcorGM = nib.Nifti1Image(subcorGM, affine, nii_hdr)
-    x_WM = nib.Nifti1Image(WM, affine, nii_hdr)
-    x_CSF = nib.Nifti1Image(CSF, affine, nii_hdr)
-    x_patho = nib.Nifti1Image(patho, affine, nii_hdr)
-    
+    label_data = np.asanyarray(nii.dataobj) # in the type of the file, not as float64
     
-    #### ACTIVATE THIS PART TO REALLY CREATE THE 3D images
-    # Saving the actual nifti files to the label folder
+    # the labels are mapped to the 5tt image directly, nothing is written in between
+    fivett = labels_to_5tt(label_data, scheme)
+    del label_data
     
     os.chdir(data_dir + "processing/t2/Labels/")
-    nib.save(x_corGM, "corGM.nii.gz")
-    nib.save(x_subcorGM, "subcorGM.nii.gz")
-    nib.save(x_WM, "WM.nii.gz")
-    nib.save(x_CSF, "CSF.nii.gz")
-    nib.save(x_patho, "patho.nii.gz")
-    subprocess.call(["chmod", "a+rwx", data_dir + "processing/t2/Labels/corGM.nii.gz"])
-    subprocess.call(["chmod", "a+rwx", data_dir + "processing/t2/Labels/subcorGM.nii.gz"])
-    subprocess.call(["chmod", "a+rwx", data_dir + "processing/t2/Labels/WM.nii.gz"])
-    subprocess.call(["chmod", "a+rwx", data_dir + "processing/t2/Labels/CSF.nii.gz"])
-    subprocess.call(["chmod", "a+rwx", data_dir + "processing/t2/Labels/patho.nii.gz"])
-    
-    print('Five 3D images per label were created. Now they will be merged together along 4th dimension to a single 4D image...')
-    
-    # Merging the 3D files along the 4th axis with with FSL (maybe there exists a simple solution with python?)
-    os.system('fslmerge -t 5tt_draft.nii.gz corGM.nii.gz subcorGM.nii.gz WM.nii.gz CSF.nii.gz patho.nii.gz') 
-    subprocess.call(["chmod", "a+rwx", data_dir + "processing/t2/Labels/5tt_draft.nii.gz"])    
-    
-    print("A first draft of the 5tt image was created. Now it needs to be corrected so that it meets the MRtrix requirements...") 
-    
-    # Sum of voxels per label should always be 1 and the rest 0: 
-    # Take 5tt image which was created by running fslmerge on the 5 separate 3D files to create 4D file 
-    nii5 = nib.load("5tt_draft.nii.gz")
-    affine5 = nii5.affine
-    nii5_hdr = nii5.header
-    nii5_data = nii5.get_fdata()
-    
-    
-    # outside of the brain it should be 0, and the sum within the brain 1 (of label dimension)
-    nii5_data[nii5_data < 0.01] = 0
-    nii5_data[nii5_data > 0.99] = 1
-    
-    # Since the image values may or may not take values larger than 1, it does a normalisation to 3D maximum. This should not change anything if the maximum intensity is already 1. 
-    for t in range(4):
-        nii5_data[:,:,:,t] = np.absolute(nii5_data[:,:,:,t]/np.amax(np.amax(np.amax(nii5_data[:,:,:,t]))))
-    
-    
-    difference = np.ones((sizex, sizey, sizez)) - np.sum(nii5_data, 3)
-    CSF_new = nii5_data[:,:,:,3] + (difference * (difference<0.2))
-    
-    nii5_data = np.stack((nii5_data[:,:,:,0], nii5_data[:,:,:,1], nii5_data[:,:,:,2], CSF_new, nii5_data[:,:,:,4]), axis = 3) # here might have happend a mistake np.stack creates a NEW dimension. Double check Anna! 
-    
-    summed = np.sum(nii5_data, 3) # shape: (400, 400, 400)
-    
-    selected = ((summed!=1) & (summed!=0)) # selected = boolean array (shape: 400, 400, 400)
-    
-    
-    selected4D = np.stack((selected, selected, selected, selected, selected), axis = 3)
-    nii5_data[selected4D] = 0 
-    
-    
-    x_nii5 = nib.Nifti1Image(nii5_data, affine5, nii5_hdr)
-    
-    nib.save(x_nii5, "5tt.nii.gz") 
-    subprocess.call(["chmod", "a+rwx", data_dir + "processing/t2/Labels/5tt.nii.gz"])    
+    image_writer.save(fivett, "5tt.nii.gz", nii.affine, nii.header) 
+    call(["chmod", "a+rwx", "5tt.nii.gz"])
     print("The '5tt.nii.gz' was created in the labels folder.")
     
     
     print("Now the 5ttcheck command from Mrtrix checks if the 5tt meets the criteria..")
     
-    os.system('5ttcheck 5tt.nii.gz')
-    
+    call(["5ttcheck", "5tt.nii.gz"])
@@ -7,11 +7,25 @@ Created on Tue Aug 23 09:21:31 2022
 """
 import ants # pip install antspyx is neccessary1
 import time
-import subprocess
+from pipe_helpers.command_executor import call
+from pipe_helpers.atomic_outputs import writing
 import os
 import sys
 
 
+def remove_transforms(tx):
+    # Removes only the transform files ANTs wrote to /tmp for this registration.
+    # Deleting /tmp/*Warp.nii.gz would break registrations of other subjects running in parallel.
+    for transform in tx["fwdtransforms"] + tx["invtransforms"]:
+        if transform.startswith("/tmp/") and os.path.exists(transform):
+            os.remove(transform)
+
+
+def warp_labels(fixed, moving_labels, transformlist):
+    # label images are warped with "genericLabel" (smooth label boundaries, slow)
+    # interpolator "multiLabel": fast
+    return ants.apply_transforms(fixed = fixed, moving = moving_labels, transformlist = transformlist, interpolator = "genericLabel")
+
 
 def reg_2_parcellation_improved(data_dir, atlas_name, atlas_t2, atlas_label_image): 
     
@@ -37,29 +51,27 @@ def reg_2_parcellation_improved(data_dir, atlas_name, atlas_t2, atlas_label_imag
     tic=time.time()
     moving = ants.image_read(atlas_t2) # T2 image in atlas space 
     fixed = ants.image_read(data_dir + "/t2/T2_SVRTK.nii.gz") # T2 subject space 
-    subprocess.call(["fslmaths", data_dir + "/t2/T2_SVRTK.nii.gz", "-bin", data_dir + "/t2/T2_mask.nii.gz"]) 
+    call(["fslmaths", data_dir + "/t2/T2_SVRTK.nii.gz", "-bin", data_dir + "/t2/T2_mask.nii.gz"]) 
     print("Please check the just created T2 mask in your t2 directory")
-    subprocess.call(["chmod", "a+rwx", data_dir + "/t2/T2_mask.nii.gz"])
+    call(["chmod", "a+rwx", data_dir + "/t2/T2_mask.nii.gz"])
     mask = ants.image_read(data_dir + "/t2/T2_mask.nii.gz")
     tx = ants.registration(fixed = fixed, moving = moving, mask = mask, type_of_transform = "SyN")
     warped_moving = tx["warpedmovout"]
-    subprocess.call(["mkdir", "-m777", data_dir + "/processing/t2/Parcellation"])
-    subprocess.call(["mkdir", "-m777", data_dir + "/processing/t2/Parcellation/" + atlas_name])
+    call(["mkdir", "-m777", data_dir + "/processing/t2/Parcellation"])
+    call(["mkdir", "-m777", data_dir + "/processing/t2/Parcellation/" + atlas_name])
     # warped_moving.to_filename(data_dir + "/processing/t2/Parcellation/" + atlas_name + "/" + atlas_name +"_regSubj.nii.gz")
-    # subprocess.call(["chmod", "a+rwx", data_dir + "/processing/t2/Parcellation/" + atlas_name + "/" + atlas_name +"_regSubj.nii.gz"])    
+    # call(["chmod", "a+rwx", data_dir + "/processing/t2/Parcellation/" + atlas_name + "/" + atlas_name +"_regSubj.nii.gz"])    
     print("Registration: Atlas to SVRTK done.") 
         
     print("Now the Transformation starts: label image on T2... ") 
     moving2 = ants.image_read(atlas_label_image) # label image in the Atlas space
-    mywarpedimage = ants.apply_transforms(fixed = fixed, moving = moving2, transformlist = tx["fwdtransforms"], interpolator = "genericLabel")  
-    # interpolator "multiLabel": fast
-    # interpolator "genericLabel": takes a long time. 
+    mywarpedimage = warp_labels(fixed, moving2, tx["fwdtransforms"])
     
-    mywarpedimage.to_filename(data_dir + "/processing/t2/Parcellation/" + atlas_name + "/T2_parcellated_" + atlas_name +".nii.gz")
-    subprocess.call(["chmod", "a+rwx", data_dir + "/processing/t2/Parcellation/" + atlas_name + "/T2_parcellated_" + atlas_name +".nii.gz"])    
+    with writing(data_dir + "/processing/t2/Parcellation/" + atlas_name + "/T2_parcellated_" + atlas_name +".nii.gz") as partial:
+        mywarpedimage.to_filename(partial)
+    call(["chmod", "a+rwx", data_dir + "/processing/t2/Parcellation/" + atlas_name + "/T2_parcellated_" + atlas_name +".nii.gz"])    
     toc=time.time()
-    subprocess.call('rm /tmp/*Warp.nii.gz', shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    subprocess.call('rm /tmp/*Affine.mat', shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    remove_transforms(tx)
 
     print("Transformation to the parcellation completed in ", toc-tic, "seconds.")
 
@@ -82,18 +94,18 @@ def parcellation_2_dwi_improved(data_dir, T2_parcellated, atlas_name, age_group)
     tic=time.time()
     # create median of b0-image
     if age_group == "newborn": 
-        subprocess.call([sys.path[0] + "/pipe_helpers/medianB0.sh", data_dir]) # ./DTI_pipeline/pipe_helpers/
-        subprocess.call(["mrconvert", data_dir + "/processing/dti/median_bzero.mif", data_dir + "/processing/dti/median_bzero.nii.gz"])
+        call([sys.path[0] + "/pipe_helpers/medianB0.sh", data_dir]) # ./DTI_pipeline/pipe_helpers/
+        call(["mrconvert", data_dir + "/processing/dti/median_bzero.mif", data_dir + "/processing/dti/median_bzero.nii.gz"])
         moving = ants.image_read(data_dir + "/t2/T2_SVRTK.nii.gz") # T2 image in atlas space 
-        subprocess.call(["bet", data_dir + "/processing/dti/median_bzero.nii.gz", data_dir + "/processing/dti/median_bzero_bet.nii.gz", "-m", "-f", "0.3"])
+        call(["bet", data_dir + "/processing/dti/median_bzero.nii.gz", data_dir + "/processing/dti/median_bzero_bet.nii.gz", "-m", "-f", "0.3"])
         fixed = ants.image_read(data_dir + "/processing/dti/median_bzero_bet.nii.gz") # dwi subject space 
         mask = ants.image_read(data_dir + "/processing/dti/median_bzero_bet_mask.nii.gz") # we are having a too small voxel values problem
 
     else:
-        subprocess.call([sys.path[0] + "/pipe_helpers/median_nonB0.sh", data_dir]) # ./DTI_pipeline/pipe_helpers/
-        subprocess.call(["mrconvert", data_dir + "/processing/dti/median_nonbzero.mif", data_dir + "/processing/dti/median_nonbzero.nii.gz"])
+        call([sys.path[0] + "/pipe_helpers/median_nonB0.sh", data_dir]) # ./DTI_pipeline/pipe_helpers/
+        call(["mrconvert", data_dir + "/processing/dti/median_nonbzero.mif", data_dir + "/processing/dti/median_nonbzero.nii.gz"])
         moving = ants.image_read(data_dir + "/t2/T2_SVRTK.nii.gz") # T2 image in atlas space 
-        subprocess.call(["bet", data_dir + "/processing/dti/median_nonbzero.nii.gz", data_dir + "/processing/dti/median_nonbzero_bet.nii.gz", "-m", "-f", "0.3"])
+        call(["bet", data_dir + "/processing/dti/median_nonbzero.nii.gz", data_dir + "/processing/dti/median_nonbzero_bet.nii.gz", "-m", "-f", "0.3"])
         fixed = ants.image_read(data_dir + "/processing/dti/median_nonbzero_bet.nii.gz") # dwi subject space 
         mask = ants.image_read(data_dir + "/processing/dti/median_nonbzero_bet_mask.nii.gz") # we are having a too small voxel values problem
 
@@ -109,20 +121,16 @@ def parcellation_2_dwi_improved(data_dir, T2_parcellated, atlas_name, age_group)
         
     print("Now the Transformation starts: label image on T2... ") 
     moving2 = ants.image_read(T2_parcellated) # parcellated image in subject T2 space
-    mywarpedimage = ants.apply_transforms(fixed = fixed, moving = moving2, transformlist = tx, interpolator = "genericLabel") #imagetype = 3
-    # interpolator "multiLabel": fast
-    # interpolator "genericLabel": takes a long time. 
+    mywarpedimage = warp_labels(fixed, moving2, tx)
     
 
-    if os.path.exists(data_dir + "/processing/connectome/" + atlas_name):	
-    	mywarpedimage.to_filename(data_dir + "/processing/connectome/" + atlas_name +"/parcels_" + atlas_name +"_coreg.nii.gz")        
-    	subprocess.call(["chmod", "a+rwx", data_dir + "/processing/connectome/" + atlas_name + "/parcels_" + atlas_name +"_coreg.nii.gz"])    
-    else:
-        subprocess.call(["mkdir", "-m777", data_dir + "/processing/connectome/" + atlas_name])
-        mywarpedimage.to_filename(data_dir + "/processing/connectome/" + atlas_name +"/parcels_" + atlas_name +"_coreg.nii.gz") 
-        subprocess.call(["chmod", "a+rwx", data_dir + "/processing/connectome/" + atlas_name + "/parcels_" + atlas_name +"_coreg.nii.gz"]) 
+    if not os.path.exists(data_dir + "/processing/connectome/" + atlas_name):
+        call(["mkdir", "-m777", data_dir + "/processing/connectome/" + atlas_name])
+    with writing(data_dir + "/processing/connectome/" + atlas_name +"/parcels_" + atlas_name +"_coreg.nii.gz") as partial:
+        mywarpedimage.to_filename(partial)
+    call(["chmod", "a+rwx", data_dir + "/processing/connectome/" + atlas_name + "/parcels_" + atlas_name +"_coreg.nii.gz"])
     toc=time.time()
-    subprocess.call('rm /tmp/*Warp.nii.gz', shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    subprocess.call('rm /tmp/*Affine.mat', shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    remove_transforms(tx1)
+    remove_transforms(tx2)
     print("Transformation of the parcellated image to the diffusion space completed in ", toc-tic, "seconds.")
 
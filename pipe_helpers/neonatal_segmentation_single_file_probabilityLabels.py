@@ -14,38 +14,24 @@ script amended by Anna Speckert
 import time
 import os
 import sys
+import shutil
+import tempfile
+from contextlib import contextmanager
 
-from medpy.io import load, save
 import numpy as np
 
-from keras.models import Model
-
-from keras.layers import Input, Conv2D
-from keras.layers import BatchNormalization, Dropout, MaxPooling2D 
-from keras.layers import UpSampling2D, Concatenate
-from keras.optimizers import Adam
-from keras import regularizers
-from keras import backend as K
+# Keras/TensorFlow and medpy are imported in the functions using them: importing
+# this file (e.g. for the benchmarks) must not start TensorFlow.
 
 from subprocess import call
-import subprocess
+import subprocess # mrinfo in padimage
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # pipe_helpers, when run as a script
 
 
 cwd = os.getcwd()
 ckpt_path = cwd + '/neonate_seg_tf2_v4.h5'
 
-if len(sys.argv) == 1:
-	print( "Error:\nPlease specify file to be segmented: neonatal_segmentation.py [t2_file.nii.gz]")
-	print("File should have a resolution of 0.4x0.4x0.4mm, with a size of 400x400x400 voxels")
-	sys.exit()
-else:
-	file_t2 = sys.argv[1] # first argument you pass
-	print("Current model: " + ckpt_path)
-	print("\n")
-
-data_dir = file_t2[:(len(file_t2)-42)] # -42 last letters results in base_dir + subj
-t2_path = data_dir + "/t2/" # Anna added this
-
 def padimage(padinput, padoutput, targetsize):
 	#PADS files to targetsize 	
 	# padinput = input file
@@ -75,6 +61,7 @@ def gen_dice_coef(y_true, y_pred, smooth=1e-7):
     Dice coefficient for 8 categories. 
     Pass to model as metric during compile statement
     '''
+    from keras import backend as K
     y_true_f = K.flatten(y_true)
     y_pred_f = K.flatten(y_pred)
     weight = 1 / (K.sum(y_true_f))**2
@@ -91,8 +78,13 @@ def gen_dice_coef_loss(y_true, y_pred):
 
 ################ Create Model ######################
 def unet_architecture(input_img):
+	from keras.models import Model
+	from keras.layers import Conv2D
+	from keras.layers import BatchNormalization, Dropout, MaxPooling2D 
+	from keras.layers import UpSampling2D, Concatenate
+	from keras import regularizers
 	
-	conv1 = Conv2D(32, kernel_size=(3,3), activation='relu', padding='same', kernel_regularizer=regularizers.l2(0.01))(input_image)
+	conv1 = Conv2D(32, kernel_size=(3,3), activation='relu', padding='same', kernel_regularizer=regularizers.l2(0.01))(input_img)
 	conv1 = BatchNormalization()(conv1)
 	conv1 = Conv2D(32, kernel_size=(3,3), activation='relu', padding='same', kernel_regularizer=regularizers.l2(0.01))(conv1)
 	conv1 = BatchNormalization()(conv1)
@@ -158,14 +150,13 @@ def unet_architecture(input_img):
 	conv9 = Conv2D(32, kernel_size=(3,3), activation='relu', padding='same', kernel_regularizer=regularizers.l2(0.01), name='last_2')(conv9)
 	conv9 = BatchNormalization()(conv9)
 
-	pred = Conv2D(9, kernel_size=(1,1),  activation='softmax', padding='valid', name='last_1')(conv9)
-	final_model = Model(inputs=input_image, outputs=pred)
+	pred = Conv2D(9, kernel_size=(1,1),  activation='softmax', padding='valid', name='last_1', dtype='float32')(conv9) # float32 also in mixed precision
+	final_model = Model(inputs=input_img, outputs=pred)
 
 	return final_model
 
 
 ################ Network Parameters ###################
-K.clear_session()
 width = 400
 height = 400
 n_channels = 1
@@ -175,76 +166,318 @@ batch=16
 targetsize=400
 
 
-##############Train Model with Feta Data and save model###################
-
-input_image=Input(shape=(width,height,1))
-model = unet_architecture(input_image)
-adam = Adam(lr=0.00001)
-# load model
-print('loading trained model')
-model.load_weights(ckpt_path, by_name=True)
-print('loaded pre-trained model')
-
-model.compile(optimizer=adam, loss=[gen_dice_coef_loss], metrics=[gen_dice_coef])
-#print(model.summary())
-
-t=time.time()
+################ Precision ###################
+# float32:  as trained
+# bfloat16: Keras mixed precision, the convolutions compute in bfloat16 (fast on CPUs with AVX512-BF16/AMX), the softmax in float32
+# int8:     TensorFlow Lite with int8 weights (post-training dynamic range quantization of neonate_seg_tf2_v4.h5)
+# Compare them on own data with benchmarks/bench_precision.py (Dice of every label against float32).
+PRECISIONS = ("float32", "bfloat16", "int8")
+
+
+def set_precision_policy(name):
+	import tensorflow as tf
+	if hasattr(tf.keras.mixed_precision, "set_global_policy"): # TensorFlow >= 2.4
+		tf.keras.mixed_precision.set_global_policy(name)
+	else:
+		tf.keras.mixed_precision.experimental.set_policy(name)
+
+
+def quantized_model(model, ckpt_path):
+	"""
+	The UNet converted to TensorFlow Lite with int8 weights. Dynamic range quantization needs no calibration
+	images: the activations are quantized on the fly. The conversion is kept next to the weights (.tflite).
+	"""
+	import tensorflow as tf
+	from pipe_helpers.atomic_outputs import writing
+	cached = None if ckpt_path is None else os.path.splitext(ckpt_path)[0] + "_int8.tflite"
+	if cached is not None and os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(ckpt_path):
+		with open(cached, "rb") as tflite_file:
+			return tflite_file.read()
+	converter = tf.lite.TFLiteConverter.from_keras_model(model)
+	converter.optimizations = [tf.lite.Optimize.DEFAULT]
+	content = converter.convert()
+	if cached is not None:
+		try:
+			with writing(cached) as partial:
+				with open(partial, "wb") as tflite_file:
+					tflite_file.write(content)
+		except OSError: # read-only model folder: converted again next time
+			pass
+	return content
+
+
+class TFLiteModel:
+	"""predict_on_batch of a TensorFlow Lite model, for slices of any size."""
+
+	def __init__(self, content):
+		import tensorflow as tf
+		threads = int(os.environ.get("TF_NUM_INTRAOP_THREADS", "") or os.cpu_count() or 1)
+		try:
+			self.interpreter = tf.lite.Interpreter(model_content=content, num_threads=threads)
+		except TypeError: # TensorFlow < 2.3
+			self.interpreter = tf.lite.Interpreter(model_content=content)
+		self.input = self.interpreter.get_input_details()[0]["index"]
+		self.output = self.interpreter.get_output_details()[0]["index"]
+		self.shape = None
+
+	def predict_on_batch(self, inputs):
+		if inputs.shape != self.shape:
+			self.interpreter.resize_tensor_input(self.input, list(inputs.shape))
+			self.interpreter.allocate_tensors()
+			self.shape = inputs.shape
+		self.interpreter.set_tensor(self.input, np.asarray(inputs, dtype=np.float32))
+		self.interpreter.invoke()
+		return self.interpreter.get_tensor(self.output)
+
+
+def load_model(ckpt_path, precision="float32"):
+	"""
+	Builds the UNet and loads the trained weights (ckpt_path None: random weights, e.g. for benchmarks).
+	precision: one of PRECISIONS (see above).
+	The UNet is fully convolutional: it takes slices of any size whose sides are multiples of 16 (see crop_box).
+	"""
+	from keras.layers import Input
+	from keras.optimizers import Adam
+	from keras import backend as K
+	if precision not in PRECISIONS:
+		raise ValueError("Unknown segmentation precision " + str(precision) + ", choose one of " + ", ".join(PRECISIONS))
+	K.clear_session()
+	set_precision_policy("mixed_bfloat16" if precision == "bfloat16" else "float32")
+	input_image=Input(shape=(None,None,1)) # trained on width x height slices, the weights do not depend on the size
+	model = unet_architecture(input_image)
+	adam = Adam(lr=0.00001)
+	if ckpt_path is not None:
+		# load model
+		print('loading trained model')
+		model.load_weights(ckpt_path, by_name=True)
+		print('loaded pre-trained model')
+
+	model.compile(optimizer=adam, loss=[gen_dice_coef_loss], metrics=[gen_dice_coef])
+	#print(model.summary())
+	if precision == "int8":
+		return TFLiteModel(quantized_model(model, ckpt_path))
+	return model
+
+
+################ Cropped Inference ###################
+# Only the slices containing brain and a box around it are segmented. The box starts and ends on multiples of
+# POOLING, so the 4 poolings see the same grid as on the whole slice, and keeps CROP_MARGIN voxels of background
+# around the brain: the receptive field of the UNet reaches ~115 voxels, so inside the brain the probabilities are
+# the ones of the whole slice. Outside the box (and in empty slices) the UNet sees only zeros there as well and
+# its output for an empty slice is used.
+POOLING = 16
+CROP_MARGIN = 128
+
+
+def crop_margin(text):
+	"""Margin as given in the config resp. on the command line ("none" or empty: the whole slices are segmented)."""
+	return None if text.strip().lower() in ("", "none") else int(text)
+
+
+def prepare_slices(image_data, z, box, maxima):
+	"""
+	Input of the UNet: the slices z of a T2 image (along the 3rd axis), cut to box and normalised to their maximum.
+
+	Inputs:
+		z: indices of the slices
+		box: (x0, x1, y0, y1) see crop_box
+		maxima: maximum of every slice (slice_maxima)
+
+	Output:
+		array of shape (slices, x, y, 1), float32
+	"""
+	x0, x1, y0, y1 = box
+	image_data = np.asarray(image_data[x0:x1, y0:y1, z], dtype=float) / maxima[z]
+	image_data = np.moveaxis(image_data.astype(np.float32), -1, 0) # Bring the last dim to the first; the UNet computes in float32
+
+	return image_data[..., np.newaxis] # Add one axis to the end
+
+
+def slice_maxima(image_data):
+	maxima = np.asarray(image_data).max(axis=(0, 1)).astype(float)
+	return np.where(maxima != 0, maxima, 1) # empty slices stay as they are
+
+
+def crop_box(image_data, margin=CROP_MARGIN):
+	"""
+	Part of a T2 image (x, y, z) to segment.
+
+	Output:
+		indices of the slices which are not empty, (x0, x1, y0, y1) of the box around the brain in them
+	"""
+	shape = np.shape(image_data)
+	if margin is None:
+		return np.arange(shape[2]), (0, shape[0], 0, shape[1])
+	brain = np.asarray(image_data) != 0
+	occupied = np.flatnonzero(brain.any(axis=(0, 1)))
+	if len(occupied) == 0:
+		return occupied, (0, shape[0], 0, shape[1])
+	in_plane = brain.any(axis=2)
+	del brain
+	box = []
+	for axis, size in ((1, shape[0]), (0, shape[1])):
+		indices = np.flatnonzero(in_plane.any(axis=axis))
+		box.append(int(max(0, (indices[0] - margin) // POOLING * POOLING)))
+		box.append(int(min(size, -(-(indices[-1] + 1 + margin) // POOLING) * POOLING)))
+	return occupied, tuple(box)
+
+
+class SegmentationOutputs:
+	"""
+	Label image (uint8) and probabilities of the labels 1 to 8 (float32) of one T2 image, as volumes (x, y, z)
+	filled batch of slices by batch of slices (see predict_batch). With a scratch_dir they are memory-mapped
+	files there, so the whole probabilities never have to fit into memory; otherwise arrays.
+	"""
+
+	def __init__(self, shape, scratch_dir=None):
+		def volume(name, dtype):
+			if scratch_dir is None:
+				return np.empty(shape, dtype=dtype, order='F')
+			return np.memmap(scratch_dir + "/" + name, dtype=dtype, mode="w+", shape=shape, order='F') # one slice is contiguous
+
+		self.labels = volume("labels", np.uint8)
+		self.probabilities = [volume("label_prob_" + str(k), np.float32) for k in range(1, n_classes)]
+
+	def put(self, z, probabilities):
+		"""Stores the UNet output (slices, x, y, n_classes) of the slices z."""
+		self.labels[:, :, z] = np.moveaxis(np.argmax(probabilities, axis=3), 0, -1) # Find mask
+		for k, volume in enumerate(self.probabilities, 1):
+			volume[:, :, z] = np.moveaxis(probabilities[..., k], 0, -1)
+
+
+def predict_probabilities(model, image_data, outputs=None, batch_slices=32, margin=CROP_MARGIN):
+	"""
+	Slice-wise segmentation of a T2 image (400x400 slices along the 3rd axis), see predict_batch.
+
+	Output:
+		SegmentationOutputs (in memory if outputs is None)
+	"""
+	if outputs is None:
+		outputs = SegmentationOutputs(np.shape(image_data)[:3])
+	predict_batch(model, [image_data], [outputs], batch_slices, margin)
+	return outputs
+
+
+def predict_batch(model, images, outputs, batch_slices=32, margin=CROP_MARGIN):
+	"""
+	Segments several T2 images together: their slices go through the UNet in batches of batch_slices,
+	across the borders between the images (segmentation_server.py). Only the slices with brain and the box
+	around it are segmented (margin None: all slices as a whole). Each batch is stored in the SegmentationOutputs
+	of its image right away, so the memory needed depends on batch_slices and not on the size of the images.
+	"""
+	if len(set(np.shape(image_data)[:2] for image_data in images)) > 1: # slices of different sizes are not batched
+		for image_data, image_outputs in zip(images, outputs):
+			predict_batch(model, [image_data], [image_outputs], batch_slices, margin)
+		return
+	shape = np.shape(images[0])[:2]
+	crops = [crop_box(image_data, margin) for image_data in images]
+	boxes = np.array([crop[1] for crop in crops if len(crop[0])] or [(0, 0, 0, 0)])
+	box = (boxes[:, 0].min(), boxes[:, 1].max(), boxes[:, 2].min(), boxes[:, 3].max()) # one box for the batch
+	x0, x1, y0, y1 = box
+	empty = None
+	if any(len(crop[0]) < np.shape(image_data)[2] for image_data, crop in zip(images, crops)) or (x1 - x0, y1 - y0) != shape:
+		empty = np.asarray(model.predict_on_batch(np.zeros((1,) + shape + (1,), dtype=np.float32)))[0]
+
+	def full_slices(predictions):
+		# output of the whole slices from the output in the box
+		if (x1 - x0, y1 - y0) == shape:
+			return predictions
+		whole = np.empty((len(predictions),) + shape + (n_classes,), dtype=np.float32)
+		whole[:] = empty
+		whole[:, x0:x1, y0:y1] = predictions
+		return whole
+
+	maxima = [slice_maxima(image_data) for image_data in images]
+	segmented = [(k, z) for k, crop in enumerate(crops) for z in crop[0]]
+	for start in range(0, len(segmented), batch_slices):
+		batch = segmented[start:start+batch_slices]
+		parts = [(k, np.array([z for image, z in batch if image == k])) for k in sorted(set(image for image, z in batch))]
+		predictions = np.asarray(model.predict_on_batch(np.concatenate([prepare_slices(images[k], z, box, maxima[k]) for k, z in parts])))
+		first = 0
+		for k, z in parts:
+			outputs[k].put(z, full_slices(predictions[first:first+len(z)]))
+			first += len(z)
+	for image_data, crop, image_outputs in zip(images, crops, outputs):
+		skipped = np.setdiff1d(np.arange(np.shape(image_data)[2]), crop[0])
+		for start in range(0, len(skipped), batch_slices):
+			z = skipped[start:start+batch_slices]
+			image_outputs.put(z, np.broadcast_to(empty, (len(z),) + empty.shape))
+
+
+def write_outputs(file_t2, outputs):
+	"""Writes the label image and the 8 label probabilities of a segmented T2 image (file_t2 as given to main)."""
+	import nibabel as nib
+	from pipe_helpers import image_writer
+	data_dir = file_t2[:(len(file_t2)-42)] # -42 last letters results in base_dir + subj
+
+	filename = file_t2[:-7]
+
+	#### Here Anna's adaptations start to get separate labels from the total label file: ####
+	label_path = data_dir + '/processing/t2/Labels'
+	os.makedirs(label_path, exist_ok=True) # runs as its own script, without the pipeline's command executor
+	os.chmod(label_path, 0o777)
+
+	print("The 'Labels' folder was created under: ", label_path)
+
+	# The 9 outputs are written at the same time, each compressed in parallel, with the geometry of the input (see image_writer.py).
+	# nibabel writes the volumes slice by slice, a memory-mapped volume is not loaded as a whole.
+	reference = nib.load(file_t2)
+	with image_writer.saving() as saves:
+		#### ACTIVATE THIS LINE IN ORDER TO CREATE THE REGULAR KELLY SEGMENTATION 
+		saves.submit(image_writer.save, outputs.labels, filename + '_labels.nii.gz', reference.affine, reference.header) # Save the mask
+
+		# Creates 1 3D image for every label (probability labels without the arg_max)
+		for k in range(1,9):
+			saves.submit(image_writer.save, outputs.probabilities[k-1], label_path +"/label_prob_"+str(k)+".nii.gz", reference.affine, reference.header)
+	os.chmod(filename + '_labels.nii.gz', 0o777)
+	for k in range(1,9):
+		os.chmod(label_path +'/label_prob_'+str(k)+'.nii.gz', 0o777)
+
+	if os.path.isfile(filename + '_labels.nii.gz'):
+		print("Labels created: " + filename + '_labels.nii.gz')
+	else:
+		print("labels were unable to be created")
+
+
+@contextmanager
+def scratch_outputs(file_t2, shape):
+	"""Yields memory-mapped SegmentationOutputs in a scratch folder next to the outputs (not /tmp, which may be in memory)."""
+	scratch_dir = tempfile.mkdtemp(prefix=".segmentation_", dir=os.path.dirname(file_t2))
+	try:
+		yield SegmentationOutputs(shape, scratch_dir)
+	finally:
+		shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def main(file_t2, margin=CROP_MARGIN, precision="float32"):
+	from medpy.io import load
+
+	##############Train Model with Feta Data and save model###################
+	model = load_model(ckpt_path, precision)
+
+	t=time.time()
 				   
-image_data, image_header = load(file_t2) # Load data
-
-image_data = image_data.astype('float')
-image_data_new = image_data
-
-for i in range (image_data_new.shape[2]):
-	if image_data_new[:,:,i].max() != 0:
-		image_data_new[:,:,i] = image_data_new[:,:,i]/(image_data_new[:,:,i].max()) 
-
-imageDim = np.shape(image_data_new)   
-image_data_new = np.moveaxis(image_data_new, -1, 0) # Bring the last dim to the first
-
-input_data1 = image_data_new[..., np.newaxis] # Add one axis to the end
-
-out = model.predict(input_data1)
- 
-_out = np.reshape(out, (imageDim[2], imageDim[1], imageDim[0], n_classes)) # Reshape to input shape
-			
-# 			print(_out[10:20, 10:20, 10:20,3])
-#			Uncomment for one-hot encoding
-
-labels = np.argmax(np.asarray(_out), axis=3).astype(float) # Find mask
-labels = np.moveaxis(labels, 0, -1) # Bring the first dim to the last
-			
-filename = file_t2[:-7]
-
-#### Here Anna's adaptations start to get separate labels from the total label file: ####
-os.chdir(data_dir + "/processing/t2")
-os.system('mkdir Labels')
-os.system('chmod a+rwx ./Labels')
-
-#### ACTIVATE THIS LINE IN ORDER TO CREATE THE REGULAR KELLY SEGMENTATION 
-save(labels, filename + '_labels.nii.gz', image_header) # Save the mask
-subprocess.call(['chmod', 'a+rwx', filename + '_labels.nii.gz'])
-
-### Here probability labels are created without the arg_max
-labels_p = np.asarray(_out).astype(float) # Find mask (from original script)
-labels_p = np.moveaxis(labels_p, 0, -2) # Bring the first dim to the SECOND last (TRICK)
-
+	image_data, image_header = load(file_t2) # Load data
 
+	with scratch_outputs(file_t2, image_data.shape[:3]) as outputs:
+		predict_probabilities(model, image_data, outputs, margin=margin)
 
-label_path = data_dir + '/processing/t2/Labels'
-print("The 'Labels' folder was created under: ", label_path)
-os.chdir(label_path)
+		write_outputs(file_t2, outputs)
 
-# Creates 1 3D image for every label
-for k in range(1,9):
-    save(labels_p[:,:,:,k], label_path +"/label_prob_"+str(k)+".nii.gz", image_header)
-    subprocess.call(['chmod', 'a+rwx', label_path +'/label_prob_'+str(k)+'.nii.gz'])
+	elapsed = time.time() - t
 
-elapsed = time.time() - t
+	print('time elapsed: ' + str(elapsed) + 's')
 
-print('time elapsed: ' + str(elapsed) + 's')
 
-if os.path.isfile(filename + '_labels.nii.gz'):
-	print("Labels created: " + filename + '_labels.nii.gz')
-else:
-    print("labels were unable to be created")
+if __name__ == "__main__":
+	if len(sys.argv) == 1:
+		print( "Error:\nPlease specify file to be segmented: neonatal_segmentation.py [t2_file.nii.gz] [crop margin, default " + str(CROP_MARGIN) + ", none: whole slices] [precision: " + ", ".join(PRECISIONS) + "]")
+		print("File should have a resolution of 0.4x0.4x0.4mm, with a size of 400x400x400 voxels")
+		sys.exit()
+	else:
+		file_t2 = sys.argv[1] # first argument you pass
+		margin = crop_margin(sys.argv[2]) if len(sys.argv) > 2 else CROP_MARGIN
+		precision = sys.argv[3] if len(sys.argv) > 3 else "float32"
+		print("Current model: " + ckpt_path + " (" + precision + ")")
+		print("\n")
+	main(file_t2, margin, precision)
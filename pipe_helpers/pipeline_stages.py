@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Declares the stages of the DTI pipeline for the options chosen in config_dti.json.
+
+build_stages() returns the list of Stage objects (see stage_graph.py) with the
+files every step reads and writes. The order of the steps is not given by the
+list but by these files: e.g. the parcellation of a subject only needs its
+bias corrected dwi and can therefore run while the tractography of the same
+subject is still going on.
+
+@author: anna speckert
+"""
+import os
+import sys
+from functools import partial
+
+from pipe_helpers import subject_processing as sp
+from pipe_helpers.stage_graph import Stage, PipelineStopped
+from pipe_helpers.group_processing import group_intensity_normalisation, group_response_mean, GROUP_RESPONSE_FILES
+from pipe_helpers.cohort_state import is_incremental
+from pipe_helpers.qc_gates import run_gate
+from pipe_helpers import qc_render
+
+
+########################
+### PATH TEMPLATES   ###
+########################
+# {subject_dir} = base_dir/subj, {wor_dir} = directory of DTI_Pipeline.py
+
+DTI_DIR = "{subject_dir}/processing/dti"
+T2_DIR = "{subject_dir}/processing/t2"
+LABELS_DIR = T2_DIR + "/Labels"
+TRACT_DIR = "{subject_dir}/processing/tractography/"
+NORM_DIR = "{wor_dir}/GroupComparison/dwinormalise"
+MEAN_DIR = "{wor_dir}/GroupComparison/responsemean"
+
+# Intermediates of the dwi preprocessing are uncompressed NIfTI, which mrdegibbs, eddy and
+# dwibiascorrect all read directly: no conversion and no gzip pass between the steps.
+DENOISED = DTI_DIR + "/denoising/denoised_patch2self.nii"
+DEGIBBS = DTI_DIR + "/degibbs.nii"
+EDDY = DTI_DIR + "/eddy_images.nii"
+B0_BRAIN = DTI_DIR + "/hifi_nodif_brain.nii.gz"
+BRAIN_MASK = DTI_DIR + "/hifi_nodif_brain_mask.mif"
+BIASCORR = DTI_DIR + "/biascorr.mif"
+NORMCORR = DTI_DIR + "/bias_normcorr.mif"
+DWI_MASK = DTI_DIR + "/mask.mif"
+FA_TEMPLATE_MASK = NORM_DIR + "/fa_template_wm_mask.mif"
+
+T2_REFORMATTED = T2_DIR + "/T2_SVRTK_reformatted.nii.gz"
+T2_LABELS = T2_DIR + "/T2_SVRTK_reformatted_labels.nii.gz"
+LABEL_PROBS = [LABELS_DIR + "/label_prob_" + str(k) + ".nii.gz" for k in range(1, 9)]
+FIVETT = LABELS_DIR + "/5tt.nii.gz"
+FIVETT_MIF = LABELS_DIR + "/5tt.mif"
+FIVETT_DWI = LABELS_DIR + "/5tt_reg_to_dwi.nii.gz"
+
+
+RESPONSE_PARAMS = ["rfe", "pipe_kind"]
+SIFT_PARAMS = ["rfe", "SIFTmeth", "streamlinesSIFT", "streamlinesACT"]
+
+
+def tract_dir(configurations):
+    return TRACT_DIR + sp.TISSUE_DIRS[configurations["rfe"]]
+
+
+def response_templates(configurations):
+    return [path.replace("{base_dir}/{subj}", "{subject_dir}") for path in sp.response_paths("{base_dir}", "{subj}", configurations["rfe"])]
+
+
+def mean_response_templates(configurations):
+    return [MEAN_DIR + "/" + name for name in GROUP_RESPONSE_FILES[configurations["rfe"]]]
+
+
+def tracks_template(configurations):
+    return tract_dir(configurations) + "/tracks_" + str(int(configurations["streamlinesACT"])//1000000) + "mio.tck"
+
+
+def streamlines_gb(configurations):
+    # rough size of the tractogram in memory: ~0.5 GB per million streamlines
+    return 0.5 * int(configurations["streamlinesACT"]) / 1000000
+
+
+def connectome_dir(configurations):
+    return "{subject_dir}/processing/connectome/" + sp.connectome_name(configurations)
+
+
+####################
+### CHECK POINTS ###
+####################
+
+def write_not_working(not_working_subj, stage):
+    # Creating text file with subjects who did not run through the pipeline
+    if len(not_working_subj) > 0:
+        textfile = open(sys.path[0] + "/notWorking_subj.txt", "w")
+        for subj, step in not_working_subj:
+            textfile.write(subj + " " + step + "\n")
+        textfile.close()
+        print("The subjects for which the", stage, "did not run through were the following: ", not_working_subj)
+
+
+def ask_to_continue(question, answer_yes, stage, not_working_subj, base_dir, subjects, configurations):
+    # group stage of an interactive check point, runs in the main process
+    write_not_working(not_working_subj, stage)
+    sheet = qc_render.flush() # the figures of the phase are done before the question
+    if sheet is not None:
+        print("QC figures of all subjects:", sheet)
+    user_answer = input(question)
+    if user_answer != "y":
+        raise PipelineStopped(stage)
+    print(answer_yes)
+
+
+def check_point(name, guards, question, answer_yes, stage, not_working_subj):
+    return Stage(name, partial(ask_to_continue, question, answer_yes, stage, not_working_subj),
+                 group=True, after=guards, guards=guards, interactive=True)
+
+
+def automated_check_point(name, gate, phase):
+    # per-subject gate (see qc_gates.py): a failing subject does not hold up the others
+    guards = [stage.name for stage in phase]
+    outputs = [output for stage in phase for output in stage.outputs]
+    return Stage(name, partial(run_gate, gate, outputs), after=guards, guards=guards, memory_gb=3, threads=1)
+
+
+##############
+### STAGES ###
+##############
+
+def dwi_stages(configurations):
+    rfe = configurations["rfe"]
+    pipe_kind = configurations["pipe_kind"]
+    stages = [Stage("denoising", sp.denoise, inputs=["{subject_dir}/dti/dti.nii.gz", "{subject_dir}/dti/bvals"], outputs=[DENOISED], params=["denoising_mask"], tools=["python:dipy"], memory_gb=3, threads=8),
+              Stage("unringing", sp.unring, inputs=[DENOISED], outputs=[DEGIBBS], tools=["mrdegibbs"], memory_gb=3, threads=4),
+              Stage("eddy", sp.eddy_correct, inputs=[DEGIBBS], outputs=[EDDY, B0_BRAIN, BRAIN_MASK], params=["ageGroup"], tools=["fsl"], memory_gb=6, threads=1),
+              Stage("biascorrection", sp.bias_correct, inputs=[EDDY, "{subject_dir}/dti/bvecs", "{subject_dir}/dti/bvals"], outputs=[BIASCORR], tools=["dwibiascorrect", "python:antspyx"], memory_gb=4, threads=4)]
+    if pipe_kind == "single_subject_alone" and rfe == "SSST":
+        stages.append(Stage("intensity normalisation", sp.normalise_individual, inputs=[BIASCORR, BRAIN_MASK], outputs=[NORMCORR], tools=["dwinormalise"], memory_gb=3, threads=2))
+    # This step is only neccessary when comparing groups: Global intensity normalisation across subjects
+    # for SS3T and SS2T mtnormalise will be run on FODs. Therefore, this step is not neccessary.
+    if pipe_kind != "single_subject_alone" and rfe == "SSST":
+        stages.append(Stage("group intensity normalisation", group_intensity_normalisation, inputs=[BIASCORR, BRAIN_MASK], outputs=[FA_TEMPLATE_MASK], group=True, tools=["dwinormalise"], memory_gb=8, threads=8))
+    return stages
+
+
+def structural_stages(configurations):
+    """Returns the 5tt stages which fit to '5tt_provided' and 'ageGroup' of the config file."""
+    if configurations["5tt_provided"] == "no":
+        if configurations["ageGroup"] == "newborn":
+            return [Stage("reformatting", sp.reformat_t2, inputs=["{subject_dir}/t2/T2_SVRTK.nii.gz"], outputs=[T2_REFORMATTED], params=["seg_atlas_path"], memory_gb=2, threads=1),
+                    Stage("segmentation", sp.segment_t2, inputs=[T2_REFORMATTED], outputs=[T2_LABELS] + LABEL_PROBS, params=["segmentation_precision", "segmentation_crop_margin"], tools=["python:tensorflow"], memory_gb=6, threads=4),
+                    Stage("5tt creation", sp.create_5tt, inputs=LABEL_PROBS, outputs=[FIVETT], tools=["python:nibabel"], memory_gb=3, threads=1),
+                    Stage("5tt registration", sp.register_5tt, inputs=[FIVETT, T2_REFORMATTED, B0_BRAIN], outputs=[FIVETT_DWI], tools=["python:antspyx"], memory_gb=4, threads=4)]
+        elif configurations["ageGroup"] in ("child", "adolescent"):
+            return [Stage("5tt creation", sp.create_5tt_child_ado, inputs=["{subject_dir}/t2/T2_SVRTK.nii.gz"], outputs=[FIVETT_MIF], params=["structural_type"], tools=["recon-all", "5ttgen"], memory_gb=4, threads=1),
+                    Stage("5tt registration", sp.register_5tt_freesurfer, inputs=[FIVETT_MIF, B0_BRAIN], outputs=[FIVETT_DWI], tools=["python:antspyx"], memory_gb=4, threads=4)]
+        return []
+    elif configurations["5tt_provided"] == "yes":
+        return [Stage("5tt provided", sp.check_provided_5tt, outputs=[FIVETT_DWI])]
+    elif configurations["5tt_provided"] == "genFSL":
+        return [Stage("5tt creation", sp.create_5tt_fsl, inputs=["{subject_dir}/t2/orig_T1.nii.gz", B0_BRAIN], outputs=[FIVETT_DWI], tools=["5ttgen", "fsl"], memory_gb=4, threads=1)]
+    elif configurations["5tt_provided"] == "freesurfer":
+        return [Stage("5tt creation", sp.create_5tt_freesurfer, inputs=[B0_BRAIN], outputs=[FIVETT_DWI], params=["freesurfer_version"], tools=["5ttgen"], memory_gb=4, threads=1)]
+    return []
+
+
+def tractography_stages(configurations):
+    rfe = configurations["rfe"]
+    pipe_kind = configurations["pipe_kind"]
+    stages = []
+    dwi = NORMCORR if pipe_kind == "single_subject_alone" and rfe == "SSST" else BIASCORR
+
+    # 0) MASK of the CSD, needed by every subject, also when the Groupmean already exists
+    stages.append(Stage("dwi mask creation", sp.create_dwi_mask, inputs=[BIASCORR], outputs=[DWI_MASK], tools=["dwi2mask"], memory_gb=2, threads=2))
+
+    # 1) RESPONSE FUNCTION ESTIMATION
+    if pipe_kind == "single_subject_alone":
+        stages.append(Stage("response function estimation", sp.estimate_response, inputs=[dwi], outputs=response_templates(configurations), params=RESPONSE_PARAMS, tools=["dwi2response"], memory_gb=3, threads=4))
+        responses = response_templates(configurations)
+    else:
+        responses = mean_response_templates(configurations)
+    if pipe_kind == "group_create_average":
+        # incremental cohort mode: new subjects go into the Groupmean, which is only rewritten if it moved (see cohort_state.py)
+        if os.path.exists(responses[-1].format(wor_dir=sys.path[0])) and not is_incremental(configurations):
+            print("The Groupmean was already created. Will skip the response function estimation of the single subjects.")
+        else:
+            # for SSST the response is estimated from the group normalised dwi (GroupComparison/dwinormalise/dwi_output)
+            after = ["group intensity normalisation"] if rfe == "SSST" else []
+            normalised = [NORM_DIR + "/dwi_output/{subj}.mif"] if rfe == "SSST" else []
+            stages.append(Stage("response function estimation", sp.estimate_response, inputs=[dwi] + normalised, outputs=response_templates(configurations), after=after, params=RESPONSE_PARAMS, tools=["dwi2response"], memory_gb=3, threads=4))
+            stages.append(Stage("response function average", group_response_mean, inputs=response_templates(configurations), outputs=responses, group=True, params=["rfe"], tools=["python:numpy"]))
+    if pipe_kind == "group_take_average":
+        print("Make sure that the averaged response function is provided under the working directory $PWD/GroupComparison/responsemean/response_sing_wm_mean.txt or /response_threetiss_wm_mean.txt")
+    if pipe_kind == "single_subject_alone":
+        print("This is a single subject pipeline and its output is not comparable to other subjects.")
+
+    # 2) CSD computation, 3) FOD normalisation, tractogram creation and SIFT(2) filtering
+    tracks_gb = streamlines_gb(configurations)
+    fod = tract_dir(configurations) + ("/wm_tournier_fod.mif" if rfe == "SSST" else "/wm_fod.mif")
+    stages.append(Stage("FOD creation", sp.compute_fod, inputs=[BIASCORR, DWI_MASK] + responses, outputs=[fod], params=RESPONSE_PARAMS, tools=["dwi2fod", "ss3t_csd_beta1"], memory_gb=4, threads=8))
+    stages.append(Stage("tractogram creation", sp.generate_tracks, inputs=[fod, FIVETT_DWI], outputs=[tracks_template(configurations)], params=["rfe", "streamlinesACT", "seeding"], tools=["tckgen", "mtnormalise"], memory_gb=4 + tracks_gb, threads=8))
+    if configurations["SIFTmeth"] == "sift1":
+        sift = tract_dir(configurations) + "/sift_" + str(int(configurations["streamlinesSIFT"])//1000000) + "mio.tck"
+        stages.append(Stage("SIFT filtering", sp.filter_tracks, inputs=[tracks_template(configurations)], outputs=[sift], params=SIFT_PARAMS, tools=["tcksift"], memory_gb=4 + 2 * tracks_gb, threads=8))
+    elif configurations["SIFTmeth"] == "sift2":
+        stages.append(Stage("SIFT2 filtering", sp.filter_tracks, inputs=[tracks_template(configurations)], outputs=[tract_dir(configurations) + "/tck2_weights.txt"], params=SIFT_PARAMS, tools=["tcksift2"], memory_gb=4 + 2 * tracks_gb, threads=8))
+    return stages
+
+
+def parcellation_stages(configurations):
+    atlas_name = configurations["parcellationMethod"]
+    nodes = connectome_dir(configurations) + "/nodes.mif"
+    if atlas_name == "none":
+        return [Stage("parcellation provided", sp.provide_parcellation_dir, outputs=[nodes])]
+    T2_parcellated = T2_DIR + "/Parcellation/" + atlas_name + "/T2_parcellated_" + atlas_name + ".nii.gz"
+    # the atlas images are inputs as well, a new atlas version reruns the parcellation
+    return [Stage("parcellation", sp.parcellate_t2, inputs=["{subject_dir}/t2/T2_SVRTK.nii.gz", configurations["parcellation_t2"], configurations["parcellation_labels"]], outputs=[T2_parcellated],
+                  params=["parcellationMethod", "parcellation_t2", "parcellation_labels"], tools=["python:antspyx"], memory_gb=4, threads=4),
+            Stage("parcellation registration", sp.parcellation_to_dwi, inputs=[T2_parcellated, BIASCORR], outputs=[nodes], params=["parcellationMethod", "ageGroup"], tools=["python:antspyx", "mrconvert"], memory_gb=4, threads=4)]
+
+
+def connectome_stages(configurations):
+    tracks_gb = streamlines_gb(configurations)
+    inputs = [tracks_template(configurations), tract_dir(configurations) + "/tck2_weights.txt", connectome_dir(configurations) + "/nodes.mif"]
+    return [Stage("connectome creation", sp.build_connectome, inputs=inputs, outputs=[connectome_dir(configurations) + "/connectome.csv"], params=["streamlinesACT"], tools=["tck2connectome"], memory_gb=2 + tracks_gb, threads=4)]
+
+
+def build_stages(configurations, not_working_subj):
+    """
+    Returns the list of stages for the options of the config file.
+
+    Inputs:
+        configurations: content of config_dti.json
+        not_working_subj: list of failed subjects, written to notWorking_subj.txt at the check points
+
+    Output:
+        list of Stage
+    """
+    qc_gates = configurations.get("qc_gates", "interactive")
+    stages = []
+
+    def add_phase(phase, check=None):
+        stages.extend(phase)
+        if check is None or len(phase) == 0:
+            return
+        gate, question, answer_yes, stage = check
+        if qc_gates == "interactive":
+            stages.append(check_point(gate + " check", [stage.name for stage in phase], question, answer_yes, stage, not_working_subj))
+        elif qc_gates == "automated":
+            stages.append(automated_check_point(gate + " check", gate, phase))
+
+    if configurations["start"] != "skipDP":
+        add_phase(dwi_stages(configurations),
+                  ("preprocessing", "\n\n\nBefore continuing with the pipeline, please check the diffusion preprocessed results and \nhave a look at the 'notWorking_subj_preprocessing.txt' which is outputtet in the current working directory. \nIf everything is fine and you want to continue the execution of the pipline press 'y', else press 'n'. \n",
+                   "The preprocessed diffusion results seem to be fine. The pipeline goes on..", "preprocessing"))
+    if configurations["5tt_provided"] != "yes":
+        add_phase(structural_stages(configurations),
+                  ("5tt", "\n\n\nPlease check the created 5tt_reg_to_dwi.nii.gz. \nIf they look fine and you want to continue the pipeline press 'y', otherwise 'n'.\n",
+                   "Pipeline will continue..", "5tt creation"))
+    else:
+        add_phase(structural_stages(configurations))
+    add_phase(tractography_stages(configurations),
+              ("tractography", "\n\n\nBefore continuing with the pipeline, please check the tractography results. \nIf everything is fine and you want to continue the execution of the pipline with the \nparcellation according to the Atlas you have defined in the config file, press 'y', else press 'n'. \n",
+               "The tractography results seem to be fine. The pipeline goes on..", "processing"))
+    add_phase(parcellation_stages(configurations),
+              ("parcellation", "\n\n\nBefore continuing with the pipeline, please check the parcellation results. \nIf everything is fine and you want to continue the execution of the pipline with the \nconnectome creation based on the weighted sum of streamlines, press 'y', else press 'n'. \n",
+               "The parcellation results seem to be fine. The pipeline goes on..", "parcellation"))
+    add_phase(connectome_stages(configurations))
+    return stages
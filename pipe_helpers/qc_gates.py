@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Automated quality control gates for unattended runs (config "qc_gates": "automated").
+
+Instead of asking the user after preprocessing, 5tt creation, tractography and
+parcellation, a gate stage per subject checks the results of the phase:
+    pass:       the subject continues
+    fail:       outputs are missing or broken, the subject drops out
+    quarantine: the outputs exist but look implausible (e.g. brain mask too
+                small, too few streamlines), the subject drops out and should be
+                looked at before it is put back into the cohort
+The other subjects are not held up by a failing subject. The result of every
+gate is written to base_dir/subj/processing/QC/<gate>.json.
+
+Thresholds (config keys, strings like all config values; empty = default):
+    qc_mask_volume_ml:          "min,max" volume of the dwi brain mask in ml
+    qc_5tt_max_bad_fraction:    fraction of brain voxels whose 5tt volumes may not sum to 1
+    qc_min_streamline_fraction: fraction of streamlinesACT the tractogram must contain
+    qc_min_parcel_coverage:     fraction of the parcel labels which must be present in nodes.mif
+
+@author: anna speckert
+"""
+import os
+import sys
+import gzip
+import json
+import time
+
+from pipe_helpers.command_executor import is_dry_run
+
+
+GATES = ("preprocessing", "5tt", "tractography", "parcellation") # results in base_dir/subj/processing/QC/<gate>.json
+
+# brain mask volume in ml (min, max) per age group
+MASK_VOLUME_ML = {"fetus": (50, 700), "newborn": (150, 900), "child": (700, 2000), "adolescent": (800, 2200)}
+
+MIF_DATATYPES = {"Int8": "i1", "UInt8": "u1", "Int16": "i2", "UInt16": "u2", "Int32": "i4", "UInt32": "u4",
+                 "Int64": "i8", "UInt64": "u8", "Float32": "f4", "Float64": "f8"}
+
+
+###################
+### IMAGE INPUT ###
+###################
+
+def read_mif_header(path):
+    """
+    Reads the header of a MRtrix .mif (or .mif.gz) image.
+
+    Output:
+        dictionary of the header keys (values as strings, 'dim' and 'vox' as lists)
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    header = {}
+    with opener(path, "rb") as stream:
+        if stream.readline().strip() != b"mrtrix image":
+            raise ValueError(path + " is not a MRtrix image")
+        for line in stream:
+            line = line.decode("latin-1").strip()
+            if line == "END":
+                break
+            key, _, value = line.partition(":")
+            header.setdefault(key.strip(), []).append(value.strip())
+    header = {key: values[0] if len(values) == 1 else values for key, values in header.items()}
+    header["dim"] = [int(size) for size in header["dim"].split(",")]
+    header["vox"] = [float(size) if size.lower() != "nan" else 1.0 for size in header["vox"].split(",")]
+    return header
+
+
+def read_mif(path):
+    """
+    Reads the voxel values of a single-file MRtrix image (file: . offset).
+
+    Output:
+        (flat numpy array of the voxel values in file order, header)
+    """
+    import numpy as np
+    header = read_mif_header(path)
+    name, offset = header["file"].split()
+    if name != ".":
+        raise ValueError(path + ": images with separate data files are not supported")
+    n_voxels = int(np.prod(header["dim"]))
+    datatype = header["datatype"]
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as stream:
+        stream.seek(int(offset))
+        raw = stream.read()
+    if datatype == "Bit":
+        values = np.unpackbits(np.frombuffer(raw, dtype=np.uint8), bitorder="little")[:n_voxels]
+    else:
+        base = datatype[:-2] if datatype.endswith(("LE", "BE")) else datatype
+        order = ">" if datatype.endswith("BE") else "<"
+        values = np.frombuffer(raw, dtype=order + MIF_DATATYPES[base], count=n_voxels)
+    return values, header
+
+
+def image_values(path):
+    """Returns (voxel values, voxel volume in ml) of a .mif or NIfTI image."""
+    import numpy as np
+    if path.endswith((".mif", ".mif.gz")):
+        values, header = read_mif(path)
+        return values, float(np.prod(header["vox"][:3])) / 1000
+    import nibabel as nib # nifti library
+    nii = nib.load(path)
+    return np.asanyarray(nii.dataobj), float(np.prod(nii.header.get_zooms()[:3])) / 1000
+
+
+def tck_count(path):
+    """Returns the number of streamlines noted in the header of a .tck file (count: field)."""
+    with open(path, "rb") as stream:
+        for line in stream:
+            line = line.decode("latin-1").strip()
+            if line == "END":
+                break
+            if line.startswith("count:"):
+                return int(line.split(":", 1)[1])
+    return None
+
+
+##############
+### CHECKS ###
+##############
+# Every check returns (status, message) with status "pass", "fail" or "quarantine".
+
+def threshold(configurations, key, default):
+    value = configurations.get(key, "")
+    return float(value) if value not in ("", None) else default
+
+
+def check_outputs(paths):
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        return "fail", "missing outputs: " + ", ".join(missing)
+    empty = [path for path in paths if os.path.getsize(path) == 0]
+    if empty:
+        return "fail", "empty outputs: " + ", ".join(empty)
+    return "pass", str(len(paths)) + " outputs present"
+
+
+def check_mask_volume(mask_path, configurations):
+    if configurations.get("qc_mask_volume_ml", ""):
+        low, high = [float(bound) for bound in configurations["qc_mask_volume_ml"].split(",")]
+    else:
+        low, high = MASK_VOLUME_ML.get(configurations["ageGroup"], (50, 2500))
+    values, voxel_ml = image_values(mask_path)
+    volume = float((values > 0).sum()) * voxel_ml
+    message = "brain mask volume " + str(round(volume, 1)) + " ml (allowed " + str(low) + "-" + str(high) + " ml)"
+    return ("pass" if low <= volume <= high else "quarantine"), message
+
+
+def check_5tt(fivett_path, configurations):
+    # the same criteria as MRtrix 5ttcheck: 4D with 5 volumes, partial volumes in [0, 1] which sum to 1 in the brain
+    import numpy as np
+    values, _ = image_values(fivett_path)
+    if values.ndim != 4 or values.shape[3] != 5:
+        return "fail", "5tt image has shape " + str(values.shape) + " instead of (x, y, z, 5)"
+    values = np.asarray(values, dtype=np.float32)
+    if values.min() < 0 or values.max() > 1:
+        return "fail", "5tt values outside [0, 1]"
+    sums = values.sum(axis=3)
+    brain = sums > 0
+    if not brain.any():
+        return "fail", "5tt image is empty"
+    bad_fraction = float((np.abs(sums[brain] - 1) > 1e-3).sum()) / float(brain.sum())
+    allowed = threshold(configurations, "qc_5tt_max_bad_fraction", 0.001)
+    message = str(round(100 * bad_fraction, 3)) + " % of the brain voxels do not sum to 1"
+    return ("pass" if bad_fraction <= allowed else "quarantine"), message
+
+
+def check_streamlines(tracks_path, configurations):
+    count = tck_count(tracks_path)
+    if count is None:
+        return "fail", "no streamline count in the header of " + tracks_path
+    expected = int(configurations["streamlinesACT"])
+    minimum = threshold(configurations, "qc_min_streamline_fraction", 0.9) * expected
+    message = str(count) + " of " + str(expected) + " streamlines"
+    return ("pass" if count >= minimum else "quarantine"), message
+
+
+def check_sift2_weights(weights_path, tracks_path):
+    count = tck_count(tracks_path)
+    with open(weights_path) as weights_file:
+        n_weights = sum(len(line.split()) for line in weights_file if not line.startswith("#"))
+    if count is not None and n_weights != count:
+        return "fail", str(n_weights) + " SIFT2 weights for " + str(count) + " streamlines"
+    return "pass", str(n_weights) + " SIFT2 weights"
+
+
+def check_parcel_coverage(nodes_path, configurations):
+    import numpy as np
+    values, _ = image_values(nodes_path)
+    labels = np.unique(np.asarray(values, dtype=np.int64))
+    labels = labels[labels > 0]
+    if len(labels) == 0:
+        return "fail", "nodes image contains no parcels"
+    coverage = float(len(labels)) / float(labels.max())
+    minimum = threshold(configurations, "qc_min_parcel_coverage", 0.95)
+    message = str(len(labels)) + " of " + str(int(labels.max())) + " parcels present"
+    return ("pass" if coverage >= minimum else "quarantine"), message
+
+
+#############
+### GATES ###
+#############
+
+def gate_checks(gate, paths, configurations):
+    """Returns the list of (check name, check function) of a gate for the outputs 'paths' of the phase."""
+    checks = [("outputs", lambda: check_outputs(paths))]
+    by_name = {os.path.basename(path): path for path in paths}
+    if gate == "preprocessing":
+        if "hifi_nodif_brain_mask.mif" in by_name:
+            checks.append(("brain mask volume", lambda: check_mask_volume(by_name["hifi_nodif_brain_mask.mif"], configurations)))
+    elif gate == "5tt":
+        if "5tt_reg_to_dwi.nii.gz" in by_name:
+            checks.append(("5ttcheck", lambda: check_5tt(by_name["5tt_reg_to_dwi.nii.gz"], configurations)))
+    elif gate == "tractography":
+        tracks = [path for path in paths if os.path.basename(path).startswith("tracks_") and path.endswith(".tck")]
+        if tracks:
+            checks.append(("streamline count", lambda: check_streamlines(tracks[0], configurations)))
+            if "tck2_weights.txt" in by_name:
+                checks.append(("SIFT2 weights", lambda: check_sift2_weights(by_name["tck2_weights.txt"], tracks[0])))
+    elif gate == "parcellation":
+        if "nodes.mif" in by_name:
+            checks.append(("parcel coverage", lambda: check_parcel_coverage(by_name["nodes.mif"], configurations)))
+    return checks
+
+
+def run_gate(gate, output_templates, base_dir, subj, configurations):
+    """
+    Per-subject stage function of an automated gate.
+
+    Inputs:
+        gate: preprocessing, 5tt, tractography or parcellation
+        output_templates: outputs of the stages of the phase (path templates of stage_graph)
+        base_dir, subj, configurations: as for every stage
+
+    Output:
+        None if the subject passed, otherwise the reason (ends up in notWorking_subj.txt)
+    """
+    data_dir = base_dir + "/" + subj
+    paths = [template.format(subject_dir=data_dir, subj=subj, wor_dir=sys.path[0]) for template in output_templates]
+    if is_dry_run():
+        print("    QC " + gate + ":", ", ".join(name for name, _ in gate_checks(gate, paths, configurations)))
+        return None
+    results = []
+    status = "pass"
+    for name, check in gate_checks(gate, paths, configurations):
+        try:
+            result, message = check()
+        except Exception as error: # an unreadable image is a failed check, not a crashed pipeline
+            result, message = "fail", type(error).__name__ + ": " + str(error)
+        results.append({"check": name, "result": result, "message": message})
+        print(subj, ": QC", gate, "-", name, ":", result, "(" + message + ")")
+        if result == "fail":
+            status = "fail"
+            break # later checks need the outputs
+        if result == "quarantine":
+            status = "quarantine"
+
+    qc_dir = data_dir + "/processing/QC"
+    os.makedirs(qc_dir, exist_ok=True)
+    with open(qc_dir + "/" + gate + ".json", "w") as jsonfile:
+        json.dump({"gate": gate, "status": status, "time": time.strftime("%Y-%m-%d %H:%M:%S"), "checks": results}, jsonfile, indent=1)
+
+    if status == "pass":
+        return None
+    failed = [result["check"] + " (" + result["message"] + ")" for result in results if result["result"] != "pass"]
+    return "QC_" + gate + "_" + ("failed" if status == "fail" else "quarantined") + ": " + "; ".join(failed)
@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Quality control images rendered in the background (config "qc_render": "yes").
+
+A step does not draw its QC figure itself, it only requests it: request()
+writes a small JSON file with the kind of figure and the images to show to
+wor_dir/QC/pending/ and returns. The pipeline process picks the requests up
+while the steps go on and renders them in a pool of "qc_render_workers"
+processes with the headless Agg backend. So neither matplotlib nor the images
+of a figure are loaded in a worker which is denoising, registering or tracking.
+
+Kinds of figures (KINDS):
+    denoising     original, denoised and residuals of the middle slice of a diffusion weighted volume
+    5tt           tissue types over the reformatted T2 (T2 space)
+    t2_dwi        T2 registered to the diffusion space over the b0
+    5tt_dwi       tissue types in the diffusion space over the b0
+    parcels_dwi   parcels in the diffusion space over the b0
+
+The figures are written to base_dir/subj/processing/QC/figures/<kind>.png,
+beside the results of the automated gates (see qc_gates.py). Whenever figures
+are done, wor_dir/QC/contact_sheet.html is rewritten: one page for the cohort with a row
+per subject, its figures and its gate results. The interactive check points
+wait for the requested figures and point to this page. Requests which were not
+rendered when a run stopped are rendered by the next run.
+
+A render process reads the shown slices and one 3D volume of the overlay at a
+time (RENDER_MEMORY_GB, taken off the memory budget of the stages, see
+stage_graph.py); the images are never loaded as a whole. If a render process
+dies (e.g. out of memory), the pool is started again and the figures it was
+rendering are tried once more; a figure failing again is reported on the
+contact sheet. The run itself never fails because of a QC figure.
+
+@author: anna speckert
+"""
+import os
+import sys
+import json
+import html
+import time
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from pipe_helpers.atomic_outputs import writing
+from pipe_helpers.command_executor import is_dry_run
+from pipe_helpers.qc_gates import GATES
+
+
+POLL = 2 # seconds between two looks of the renderer at the pending requests
+B0_THRESHOLD = 50 # as in Denoising_DWI.py
+DPI = 80
+RENDER_MEMORY_GB = 0.5 # per render process
+RENDER_ATTEMPTS = 2 # a request whose render process died is tried once more
+
+KINDS = {"denoising": "Denoising (original, denoised, residuals)",
+         "5tt": "5tt on the reformatted T2",
+         "t2_dwi": "T2 registered to the b0",
+         "5tt_dwi": "5tt registered to the b0",
+         "parcels_dwi": "Parcels registered to the b0"}
+
+# colours of the 5tt volumes: cortical gm, subcortical gm, wm, csf, pathological tissue
+TISSUE_COLOURS = ["#e6a000", "#d03030", "#f0f0f0", "#3070e0", "#30c030"]
+
+_renderer = None
+
+
+def is_enabled(configurations):
+    return configurations.get("qc_render", "yes") == "yes"
+
+
+def render_workers(configurations):
+    return int(configurations.get("qc_render_workers", "2") or 2)
+
+
+def reserved_memory_gb(configurations):
+    """Memory of the render processes, which run beside the stages (0 without QC figures)."""
+    return RENDER_MEMORY_GB * render_workers(configurations) if is_enabled(configurations) else 0.0
+
+
+def qc_dir(wor_dir):
+    return wor_dir + "/QC"
+
+
+def pending_dir(wor_dir):
+    return qc_dir(wor_dir) + "/pending"
+
+
+def sheet_path(wor_dir):
+    return qc_dir(wor_dir) + "/contact_sheet.html"
+
+
+def figure_path(subject_dir, kind):
+    return subject_dir + "/processing/QC/figures/" + kind + ".png"
+
+
+################
+### REQUESTS ###
+################
+
+def request(configurations, subject_dir, kind, images):
+    """
+    Requests a QC figure and returns at once (the figure is rendered by the pipeline process).
+
+    Inputs:
+        configurations: config of the run ("qc_render")
+        subject_dir: base_dir/subj
+        kind: one of KINDS
+        images: paths of the images shown, in the order of the render function of the kind
+    """
+    if not is_enabled(configurations):
+        return
+    if is_dry_run():
+        print("    QC figure " + kind + ": " + ", ".join(images))
+        return
+    subject_dir = os.path.normpath(subject_dir)
+    directory = pending_dir(sys.path[0])
+    os.makedirs(directory, exist_ok=True)
+    with writing(directory + "/" + os.path.basename(subject_dir) + "__" + kind + ".json") as partial:
+        with open(partial, "w") as jsonfile:
+            json.dump({"subject_dir": subject_dir, "kind": kind, "images": images, "output": figure_path(subject_dir, kind)}, jsonfile)
+
+
+#################
+### RENDERING ###
+#################
+# runs in the processes of the render pool only
+
+def axial_layout(image):
+    """
+    Voxel axes of the image pointing left-right, posterior-anterior and inferior-superior,
+    and whether they run backwards: all slices are shown in the same orientation
+    without reorienting (and reading) the whole image.
+    """
+    from nibabel.orientations import io_orientation
+    axes = [0, 0, 0]
+    flips = [False, False, False]
+    for voxel_axis, (world_axis, direction) in enumerate(io_orientation(image.affine)[:3]):
+        axes[int(world_axis)] = voxel_axis
+        flips[int(world_axis)] = direction < 0
+    return axes, flips
+
+
+def axial_slice(image, layout, z, volume=None):
+    """Reads axial slice z of the image (x: right, y: anterior), all volumes of a 4D image unless volume is given."""
+    import numpy as np
+    axes, flips = layout
+    index = [slice(None)] * 3
+    index[axes[2]] = z
+    if len(image.shape) > 3:
+        index.append(slice(None) if volume is None else volume)
+    data = np.asarray(image.dataobj[tuple(index)], dtype=np.float32)
+    if axes[0] > axes[1]: # the remaining voxel axes keep their order
+        data = np.swapaxes(data, 0, 1)
+    for axis in (0, 1):
+        if flips[axis]:
+            data = np.flip(data, axis)
+    return data
+
+
+def occupied_slices(image, layout):
+    """Axial slice numbers (along the inferior-superior voxel axis) in which the image is not 0, one 3D volume at a time."""
+    import numpy as np
+    axes, _ = layout
+    other = tuple(axis for axis in range(3) if axis != axes[2])
+    occupied = np.zeros(image.shape[axes[2]], dtype=bool)
+    for volume in range(image.shape[3] if len(image.shape) > 3 else 1):
+        data = image.dataobj[..., volume] if len(image.shape) > 3 else image.dataobj
+        occupied |= (np.asarray(data) != 0).any(axis=other)
+    return np.flatnonzero(occupied)
+
+
+def show(axis, data, title, **kwargs):
+    axis.imshow(data.T, origin="lower", interpolation="none", **kwargs)
+    axis.set_title(title, fontsize=9)
+    axis.set_xticks([])
+    axis.set_yticks([])
+
+
+def render_denoising(figure, images):
+    import numpy as np
+    import nibabel as nib
+    original_path, denoised_path, bvals_path = images
+    original = nib.load(original_path) # same grid, only the shown slices are read
+    denoised = nib.load(denoised_path)
+    bvals = np.atleast_1d(np.loadtxt(bvals_path))
+    n_volumes = min(original.shape[3], denoised.shape[3], len(bvals))
+    weighted = [index for index in range(n_volumes) if bvals[index] > B0_THRESHOLD] or list(range(n_volumes))
+    index = weighted[len(weighted) // 2] # the middle diffusion weighted volume, always one which exists
+    z = original.shape[2] // 2
+    orig = np.asarray(original.dataobj[:, :, z, index], dtype=np.float32)
+    den = np.asarray(denoised.dataobj[:, :, z, index], dtype=np.float32)
+    axes = figure.subplots(1, 3)
+    show(axes[0], orig, "Original", cmap="gray")
+    show(axes[1], den, "Denoised Output", cmap="gray")
+    show(axes[2], np.abs(orig - den), "Residuals", cmap="gray")
+    return "volume " + str(index) + " (b=" + str(int(bvals[index])) + "), slice " + str(z)
+
+
+def overlay_slices(occupied, n_slices, n_slices_total):
+    # axial slices through the overlay (at 30, 50 and 70 % of its extent)
+    import numpy as np
+    if len(occupied) == 0:
+        return [n_slices_total // 2]
+    return sorted(set(int(occupied[0] + fraction * (occupied[-1] - occupied[0])) for fraction in np.linspace(0.3, 0.7, n_slices)))
+
+
+def render_overlay(figure, images, mode):
+    # mode: tissues (5tt image), labels (parcellation) or image (a registered image)
+    import numpy as np
+    import nibabel as nib
+    from matplotlib.colors import ListedColormap
+    background_path, overlay_path = images
+    background_image = nib.load(background_path)
+    overlay_image = nib.load(overlay_path)
+    if overlay_image.shape[:3] != background_image.shape[:3]:
+        raise ValueError(os.path.basename(overlay_path) + " " + str(overlay_image.shape[:3]) + " is not on the grid of " + os.path.basename(background_path) + " " + str(background_image.shape[:3]))
+    layout = axial_layout(background_image) # the same grid: the same layout for both
+    slices = overlay_slices(occupied_slices(overlay_image, layout), 3, background_image.shape[layout[0][2]])
+    backgrounds = [axial_slice(background_image, layout, z, 0) for z in slices]
+    shown = np.concatenate([background.ravel() for background in backgrounds])
+    high = np.percentile(shown[shown > 0], 99) if (shown > 0).any() else 1
+    if mode == "tissues":
+        options = {"cmap": ListedColormap(TISSUE_COLOURS), "vmin": 1, "vmax": len(TISSUE_COLOURS), "alpha": 0.45}
+    elif mode == "labels":
+        options = {"cmap": "tab20", "vmin": 1, "vmax": 20, "alpha": 0.5}
+    else:
+        options = {"cmap": "magma", "alpha": 0.4}
+    axes = figure.subplots(1, len(slices), squeeze=False)[0]
+    for axis, z, background in zip(axes, slices, backgrounds):
+        show(axis, background, "slice " + str(z), cmap="gray", vmin=0, vmax=high)
+        if mode == "tissues":
+            fractions = axial_slice(overlay_image, layout, z) # (x, y, 5)
+            overlay = np.where(fractions.sum(axis=2) > 0, fractions.argmax(axis=2) + 1, 0)
+        elif mode == "labels":
+            labels = np.rint(axial_slice(overlay_image, layout, z, 0)).astype(np.int32)
+            overlay = np.where(labels > 0, (labels - 1) % 20 + 1, 0) # the same colour for a label in every slice
+        else:
+            overlay = axial_slice(overlay_image, layout, z, 0)
+        axis.imshow(np.ma.masked_equal(overlay, 0).T, origin="lower", interpolation="none", **options)
+    return "over " + os.path.basename(background_path)
+
+
+RENDERS = {"denoising": render_denoising,
+           "5tt": lambda figure, images: render_overlay(figure, images, "tissues"),
+           "t2_dwi": lambda figure, images: render_overlay(figure, images, "image"),
+           "5tt_dwi": lambda figure, images: render_overlay(figure, images, "tissues"),
+           "parcels_dwi": lambda figure, images: render_overlay(figure, images, "labels")}
+
+
+def render(request):
+    """Renders one request (in a process of the render pool), returns the caption of the figure."""
+    import matplotlib
+    matplotlib.use("Agg") # headless, no display needed on the nodes
+    from matplotlib.figure import Figure
+    figure = Figure(figsize=(12, 4.5))
+    caption = RENDERS[request["kind"]](figure, request["images"])
+    figure.suptitle(os.path.basename(request["subject_dir"]) + ": " + KINDS[request["kind"]] + " (" + caption + ")", fontsize=10)
+    os.makedirs(os.path.dirname(request["output"]), exist_ok=True)
+    with writing(request["output"]) as partial:
+        figure.savefig(partial, format="png", dpi=DPI)
+    return caption
+
+
+#####################
+### CONTACT SHEET ###
+#####################
+
+def write_sheet(wor_dir, base_dir, subjects, errors):
+    """Writes the contact sheet of the cohort (figures and gate results of every subject)."""
+    kinds = [kind for kind in KINDS if any(os.path.exists(figure_path(base_dir + "/" + subj, kind)) or (subj, kind) in errors for subj in subjects)]
+    directory = qc_dir(wor_dir)
+    rows = []
+    for subj in subjects:
+        subject_dir = base_dir + "/" + subj
+        cells = ["<td><b>" + html.escape(subj) + "</b>" + gate_results(subject_dir) + "</td>"]
+        for kind in kinds:
+            path = figure_path(subject_dir, kind)
+            if (subj, kind) in errors:
+                cells.append('<td class="error">' + html.escape(errors[(subj, kind)]) + "</td>")
+            elif os.path.exists(path):
+                link = html.escape(os.path.relpath(path, directory)) + "?" + str(int(os.path.getmtime(path))) # a rewritten figure is not taken from the browser cache
+                cells.append('<td><a href="' + link + '"><img src="' + link + '"></a></td>')
+            else:
+                cells.append("<td></td>")
+        rows.append("<tr>" + "".join(cells) + "</tr>")
+    page = ["<!DOCTYPE html>", "<html><head><meta charset=\"utf-8\"><title>QC " + html.escape(base_dir) + "</title>",
+            "<style>body{font-family:sans-serif;font-size:13px} td{vertical-align:top;padding:4px;border-bottom:1px solid #ccc} "
+            "img{width:420px} .fail,.error{color:#c00} .quarantine{color:#c60} .pass{color:#080}</style></head><body>",
+            "<h2>QC of " + html.escape(base_dir) + "</h2><p>" + str(len(subjects)) + " subjects, written " + time.strftime("%Y-%m-%d %H:%M:%S") + "</p>",
+            "<table><tr><th>subject</th>" + "".join("<th>" + html.escape(KINDS[kind]) + "</th>" for kind in kinds) + "</tr>"]
+    page += rows + ["</table></body></html>"]
+    os.makedirs(directory, exist_ok=True)
+    with writing(sheet_path(wor_dir)) as partial:
+        with open(partial, "w") as htmlfile:
+            htmlfile.write("\n".join(page))
+
+
+def gate_results(subject_dir):
+    # results of the automated gates (see qc_gates.py), if there are any
+    lines = []
+    for gate in GATES:
+        path = subject_dir + "/processing/QC/" + gate + ".json"
+        if os.path.exists(path):
+            with open(path) as jsonfile:
+                result = json.load(jsonfile)
+            details = "; ".join(check["check"] + ": " + check["message"] for check in result["checks"] if check["result"] != "pass")
+            lines.append('<br><span class="' + result["status"] + '" title="' + html.escape(details) + '">' + gate + ": " + result["status"] + "</span>")
+    return "".join(lines)
+
+
+################
+### RENDERER ###
+################
+
+class Renderer:
+    """Takes the pending requests of wor_dir/QC/pending and renders them in a pool of processes."""
+
+    def __init__(self, wor_dir, base_dir, subjects, workers):
+        self.wor_dir = wor_dir
+        self.base_dir = base_dir
+        self.subjects = subjects
+        self.workers = workers
+        self.pool = self.new_pool()
+        self.running = {} # name of the request: (future, request, modification time of the request file)
+        self.attempts = {} # name of the request: renders whose process died
+        self.errors = {} # (subj, kind): message
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.watch, daemon=True)
+        self.thread.start()
+
+    def new_pool(self):
+        # spawned, not forked: the renderers do not inherit the memory and threads of the pipeline process
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"), initializer=os.nice, initargs=(10,))
+
+    def watch(self):
+        while not self.stop.wait(POLL):
+            try:
+                self.collect()
+            except Exception as error: # the QC figures must never stop the pipeline
+                print("The QC renderer failed (", type(error).__name__, error, "), it tries again.")
+
+    def fail(self, key, message):
+        self.errors[key] = message
+        print(key[0], ": QC figure", key[1], "could not be rendered (", message, ")")
+
+    def collect(self):
+        """Submits the new requests and handles the finished ones. Returns the number of renders still running."""
+        with self.lock:
+            directory = pending_dir(self.wor_dir)
+            names = sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+            broken = False
+            for name in names:
+                if name.startswith(".") or not name.endswith(".json") or name in self.running:
+                    continue
+                path = directory + "/" + name
+                try:
+                    modified = os.stat(path).st_mtime_ns
+                    with open(path) as jsonfile:
+                        request = json.load(jsonfile)
+                except (OSError, ValueError):
+                    continue # replaced in the meantime, taken at the next look
+                try:
+                    future = self.pool.submit(render, request)
+                except BrokenProcessPool:
+                    broken = True # the running renders fail below, the pool is started again
+                    break
+                self.running[name] = (future, request, modified)
+            finished = [name for name, (future, _, _) in self.running.items() if future.done()]
+            for name in finished:
+                future, request, modified = self.running.pop(name)
+                key = (os.path.basename(request["subject_dir"]), request["kind"])
+                error = future.exception()
+                if isinstance(error, BrokenProcessPool):
+                    # a render process died (e.g. out of memory): all renders of the pool fail, each is tried once more
+                    broken = True
+                    self.attempts[name] = self.attempts.get(name, 0) + 1
+                    if self.attempts[name] < RENDER_ATTEMPTS:
+                        continue # the request stays pending
+                    self.fail(key, "the render process died (out of memory?)")
+                elif error is not None:
+                    self.fail(key, type(error).__name__ + ": " + str(error))
+                else:
+                    self.errors.pop(key, None)
+                self.attempts.pop(name, None)
+                path = directory + "/" + name
+                try:
+                    if os.stat(path).st_mtime_ns == modified: # a newer request of the same figure is rendered again
+                        os.remove(path)
+                except OSError:
+                    pass
+            if broken:
+                self.pool.shutdown(wait=False)
+                self.pool = self.new_pool()
+            if finished:
+                write_sheet(self.wor_dir, self.base_dir, self.subjects, self.errors)
+            return len(self.running)
+
+    def flush(self):
+        """Waits until all requests made so far are rendered."""
+        while self.collect() > 0:
+            time.sleep(0.2)
+        self.collect() # requests which came in while the last ones were rendered
+
+    def close(self, wait=True):
+        """Stops the renderer. Never raises: a failing QC figure must not take the run down."""
+        self.stop.set()
+        self.thread.join()
+        try:
+            if wait:
+                self.flush()
+            self.pool.shutdown(wait=wait)
+            write_sheet(self.wor_dir, self.base_dir, self.subjects, self.errors)
+        except Exception as error:
+            print("The QC figures could not be completed (", type(error).__name__, error, "), the pending ones are rendered by the next run.")
+
+
+@contextmanager
+def rendering(wor_dir, base_dir, subjects, configurations):
+    """
+    Renders the QC requests of the steps in the background while the block runs (in the pipeline process).
+
+    Inputs:
+        wor_dir: working directory (wor_dir/QC)
+        base_dir, subjects: of the cohort (rows of the contact sheet)
+        configurations: "qc_render", "qc_render_workers"
+    """
+    global _renderer
+    if not is_enabled(configurations) or is_dry_run():
+        yield
+        return
+    _renderer = Renderer(wor_dir, base_dir, subjects, render_workers(configurations))
+    try:
+        yield
+    except BaseException:
+        _renderer.close(wait=False) # the pending requests stay for the next run
+        _renderer = None
+        raise
+    _renderer.close()
+    _renderer = None
+    print("QC figures of the cohort:", sheet_path(wor_dir))
+
+
+def flush():
+    """Waits for the QC figures requested so far (no-op without renderer). Output: path of the contact sheet or None."""
+    if _renderer is None:
+        return None
+    _renderer.flush()
+    return sheet_path(_renderer.wor_dir)
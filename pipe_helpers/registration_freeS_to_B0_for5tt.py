@@ -8,7 +8,8 @@ Created on Wed Aug 10 15:51:38 2022
 # Registration of freesurfer based 5tt to diffusion 
 
 import ants # pip install antspyx is neccessary1
-import subprocess
+from pipe_helpers.command_executor import call
+from pipe_helpers.atomic_outputs import writing
 
 
 def reg_5ttsurfer_tDWI(data_dir): # data_dir = base_dir + subj
@@ -20,7 +21,7 @@ def reg_5ttsurfer_tDWI(data_dir): # data_dir = base_dir + subj
     tx = ants.registration(fixed = fixed, moving = moving, type_of_transform = "SyN")
     warped_moving = tx["warpedmovout"]
     warped_moving.to_filename(data_dir + "processing/t2/Labels/t2_regtodwi.nii.gz")
-    subprocess.call(["chmod", "a+rwx", data_dir + "processing/t2/Labels/t2_regtodwi.nii.gz"])    
+    call(["chmod", "a+rwx", data_dir + "processing/t2/Labels/t2_regtodwi.nii.gz"])    
     print("Registration: SVRTK to B0 done.") # Until here it seemes to work
     
     #To apply this transformation matrix to other images: use ants.applytransform() command:
@@ -31,8 +32,9 @@ def reg_5ttsurfer_tDWI(data_dir): # data_dir = base_dir + subj
     # interpolator "multiLabel": fast
     # interpolator "genericLabel": takes a long time. 
     
-    mywarpedimage.to_filename(data_dir + "processing/t2/Labels/5tt_reg_to_dwi.nii.gz")
-    subprocess.call(["chmod", "a+rwx", data_dir + "processing/t2/Labels/5tt_reg_to_dwi_linear.nii.gz"])    
+    with writing(data_dir + "processing/t2/Labels/5tt_reg_to_dwi.nii.gz") as partial:
+        mywarpedimage.to_filename(partial)
+    call(["chmod", "a+rwx", data_dir + "processing/t2/Labels/5tt_reg_to_dwi_linear.nii.gz"])    
     
     print("Transformation of 5tt image to diffusion space is done.")
     
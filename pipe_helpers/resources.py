@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Memory and CPU budget of the machine the pipeline runs on.
+
+Every stage declares its estimated peak memory (Stage.memory_gb) and the number
+of threads it uses (Stage.threads). run_graph only starts a stage if it fits
+into what is left of the budget, so e.g. two SIFT2 runs are not started next
+to a UNet segmentation on a machine which cannot hold all three. A stage which
+is larger than the whole budget still runs, but alone.
+
+Each job gets its thread count through the usual environment variables
+(OpenMP/BLAS, ITK, TensorFlow, MRtrix), which the tools started with
+subprocess inherit. In-process numpy code is limited with threadpoolctl
+(requirements_venv1.txt); without it a warning is printed, as BLAS libraries
+loaded before the job keep all their threads.
+
+Config keys (empty = use the whole machine):
+    max_memory_gb: memory the pipeline may use
+    max_threads:   cores the pipeline may use
+
+@author: anna speckert
+"""
+import os
+from contextlib import contextmanager
+
+
+THREAD_VARIABLES = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+                    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS", "MRTRIX_NTHREADS",
+                    "TF_NUM_INTRAOP_THREADS", "TF_NUM_INTEROP_THREADS"]
+
+_threadpoolctl_warned = False # the warning is printed once per process
+
+
+def machine_memory_gb():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024.0**3
+    except (ValueError, OSError, AttributeError): # not available on every system
+        return 16.0
+
+
+def machine_threads():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0)) # respects the cores given to a cluster job
+    return os.cpu_count() or 1
+
+
+def thread_environment(threads):
+    environment = {variable: str(threads) for variable in THREAD_VARIABLES}
+    environment["TF_NUM_INTEROP_THREADS"] = "1" if threads < 4 else "2" # TensorFlow: threads between operations
+    return environment
+
+
+@contextmanager
+def limit_threads(threads):
+    """Sets the thread variables for the tools started within the block and limits in-process thread pools."""
+    global _threadpoolctl_warned
+    previous = {variable: os.environ.get(variable) for variable in THREAD_VARIABLES}
+    os.environ.update(thread_environment(threads))
+    try:
+        try:
+            from threadpoolctl import threadpool_limits # optional, limits numpy/BLAS already loaded in this process
+        except ImportError:
+            if not _threadpoolctl_warned:
+                print("Warning: threadpoolctl is not installed (see requirements_venv1.txt), numpy/BLAS already loaded are not limited to", threads, "threads.")
+                _threadpoolctl_warned = True
+            yield
+        else:
+            with threadpool_limits(limits=threads):
+                yield
+    finally:
+        for variable, value in previous.items():
+            if value is None:
+                os.environ.pop(variable, None)
+            else:
+                os.environ[variable] = value
+
+
+def mrtrix_nthreads():
+    """Returns the -nthreads option for a direct MRtrix call (empty outside of a limited job)."""
+    if "MRTRIX_NTHREADS" in os.environ:
+        return ["-nthreads", os.environ["MRTRIX_NTHREADS"]]
+    return []
+
+
+class ResourceBudget:
+    """Keeps track of the memory and threads used by the running stages."""
+
+    def __init__(self, configurations):
+        self.memory_gb = float(configurations.get("max_memory_gb", "") or machine_memory_gb())
+        self.threads = int(configurations.get("max_threads", "") or machine_threads())
+        self.used_memory_gb = 0.0
+        self.used_threads = 0
+        self.n_running = 0
+
+    def reserve(self, memory_gb):
+        """Takes memory used beside the stages (e.g. by background processes) off the budget."""
+        self.memory_gb = max(0.0, self.memory_gb - memory_gb)
+
+    def job_threads(self, stage):
+        return max(1, min(stage.threads, self.threads))
+
+    def admit(self, stage):
+        """Reserves the resources of the stage and returns True if it may start now."""
+        threads = self.job_threads(stage)
+        fits = (self.used_memory_gb + stage.memory_gb <= self.memory_gb and self.used_threads + threads <= self.threads)
+        if not fits and self.n_running > 0:
+            return False
+        if not fits:
+            print(stage.name, "needs more than the resource budget (", stage.memory_gb, "GB,", stage.threads, "threads ) and runs alone.")
+        self.used_memory_gb += stage.memory_gb
+        self.used_threads += threads
+        self.n_running += 1
+        return True
+
+    def release(self, stage):
+        self.used_memory_gb -= stage.memory_gb
+        self.used_threads -= self.job_threads(stage)
+        self.n_running -= 1
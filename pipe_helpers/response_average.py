@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Group average of the response functions, in-process instead of one responsemean
+call per tissue.
+
+The scaling is the one of MRtrix' responsemean: every subject's response is
+multiplied by exp(mean over shells of log(mean l=0 term / l=0 term of the
+subject)) before the responses are averaged, so subjects with a different
+overall intensity count with the same weight. Since this multiplier is
+    geometric mean(mean l=0 terms) / geometric mean(l=0 terms of the subject),
+the average is
+    G(sum of l=0 terms / n) / n * sum over subjects of (response / G(l=0 terms))
+and only needs two running sums per tissue (ResponseSums). A new subject is
+added (resp. a re-estimated one replaced) in O(1), the other subjects are not
+averaged again.
+
+Response files are the text matrices of MRtrix: one row per shell, one column
+per even harmonic degree (l = 0, 2, 4, ...), lines starting with # are comments.
+
+@author: anna speckert
+"""
+import numpy as np
+
+from pipe_helpers.atomic_outputs import writing
+
+
+def read_response(path):
+    """Returns the response as 2D array (shells x coefficients)."""
+    rows = []
+    with open(path) as response_file:
+        for line in response_file:
+            line = line.split("#")[0].strip()
+            if line:
+                rows.append([float(value) for value in line.replace(",", " ").split()])
+    if not rows or any(len(row) != len(rows[0]) for row in rows):
+        raise ValueError("The response function " + path + " is empty or not a matrix.")
+    return np.array(rows)
+
+
+def write_response(path, response, comment=""):
+    with writing(path) as partial:
+        with open(partial, "w") as response_file:
+            if comment:
+                response_file.write("# " + comment + "\n")
+            for row in np.atleast_2d(response):
+                response_file.write(" ".join("{:.10g}".format(value) for value in row) + "\n")
+
+
+def log_geometric_l0(l0):
+    """Mean over the shells of log(l=0 term), for one subject (1D) or for many at once (2D, subjects x shells)."""
+    if np.any(l0 <= 0):
+        raise ValueError("Response functions need a positive l=0 term in every shell.")
+    return np.log(l0).mean(axis=-1)
+
+
+def average_responses(responses):
+    """
+    Averages the responses of one tissue over all subjects in one vectorised pass.
+
+    Inputs:
+        responses: list of 2D arrays (shells x coefficients) of the same shape, one per subject
+
+    Output:
+        average response (shells x coefficients)
+    """
+    sums = ResponseSums()
+    sums.add(responses)
+    return sums.average()
+
+
+def relative_change(response, reference):
+    """Frobenius norm of the change relative to the norm of the reference."""
+    reference = np.asarray(reference, dtype=float)
+    return float(np.linalg.norm(np.asarray(response) - reference) / np.linalg.norm(reference))
+
+
+class ResponseSums:
+    """Running sums of one tissue from which the group average is computed (see above)."""
+
+    def __init__(self, n=0, l0_sum=None, scaled_sum=None):
+        self.n = n
+        self.l0_sum = None if l0_sum is None else np.asarray(l0_sum, dtype=float)
+        self.scaled_sum = None if scaled_sum is None else np.asarray(scaled_sum, dtype=float)
+
+    def add(self, responses, sign=1):
+        """Adds one response (shells x coefficients) or many at once (subjects x shells x coefficients)."""
+        stack = np.asarray(responses, dtype=float)
+        if stack.ndim == 2:
+            stack = stack[np.newaxis]
+        if self.scaled_sum is None:
+            self.l0_sum = np.zeros(stack.shape[1])
+            self.scaled_sum = np.zeros(stack.shape[1:])
+        if stack.shape[1:] != self.scaled_sum.shape:
+            raise ValueError("Response functions of shape " + str(stack.shape[1:]) + " and " + str(self.scaled_sum.shape) + " cannot be averaged.")
+        self.n += sign * len(stack)
+        self.l0_sum += sign * stack[:, :, 0].sum(axis=0)
+        scale = np.exp(-log_geometric_l0(stack[:, :, 0]))
+        self.scaled_sum += sign * np.tensordot(scale, stack, axes=1)
+
+    def remove(self, responses):
+        self.add(responses, sign=-1)
+
+    def average(self):
+        if self.n < 1:
+            raise ValueError("No response functions to average.")
+        return np.exp(log_geometric_l0(self.l0_sum / self.n)) * self.scaled_sum / self.n
+
+    def to_dict(self):
+        return {"n": self.n, "l0_sum": self.l0_sum.tolist(), "scaled_sum": self.scaled_sum.tolist()}
+
+    @staticmethod
+    def from_dict(sums):
+        return ResponseSums(sums["n"], sums["l0_sum"], sums["scaled_sum"])
@@ -11,10 +11,7 @@ pipe=$3 # single_subject_alone, group_create_average
 subj=$4
 script_dir=$5
 
-## Create Mask: works for SSST, SS3T, SS2T
-cd $data_directory/processing/dti
-dwi2mask -force ./biascorr.mif ./mask.mif #-fslgrad ../dti/bvecs ../dti/bvals 
-chmod a+rwx ./mask.mif
+## The mask (processing/dti/mask.mif) is created before by its own step (create_dwi_mask in subject_processing.py)
 
 # SSST RF estimation. 
 if [[ "$tissue" == "SSST" ]]; then
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Segmentation server: one long-lived process per machine which loads the UNet of
+the neonatal segmentation once and segments the T2 images of all subjects,
+instead of starting TensorFlow, building the UNet and loading
+neonate_seg_tf2_v4.h5 again for every subject (config "segmentation_server": "yes").
+
+The segmentation steps of the subjects submit their T2 image as a job to a queue
+in wor_dir/segmentation_server/<host>/<settings> (see local_queue.py) and wait for
+it. The settings of the output (precision and crop margin) are part of the
+directory, so a server only gets the images of the settings it was started with.
+The first step starts the server if none is running for its settings:
+
+    server.lock      held by the running server
+    server.ready     written by the server once its UNet is loaded
+    server.log       output of the server
+
+A step waits until the server it started is ready. If the server exits before
+(e.g. TensorFlow or the model cannot be loaded), or a step has found no server
+running for its image SERVER_STARTS times, the step fails with the end of
+server.log instead of starting servers again and again.
+
+The server takes up to "segmentation_server_subjects" waiting images at once,
+reads them in parallel and runs their slices through the UNet together, in
+batches of "segmentation_batch_slices" slices which cross the borders between the
+subjects. It uses the threads reserved by the segmentation step which started
+it (OMP_NUM_THREADS of the step, see resources.py), so it stays within the
+budget of the run. It writes the labels and label probabilities as the script
+does (neonatal_segmentation_single_file_probabilityLabels.py). It stops after
+"segmentation_server_idle_seconds" without images; the next segmentation step
+starts a new one.
+
+@author: anna speckert
+"""
+import os
+import sys
+import time
+import uuid
+import fcntl
+import socket
+import argparse
+import threading
+import subprocess
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor
+
+from pipe_helpers.local_queue import LocalFileQueue, HEARTBEAT
+from pipe_helpers.resources import machine_threads, thread_environment
+from pipe_helpers.command_executor import is_dry_run
+
+
+POLL = 2 # seconds between two looks of a waiting segmentation step at its job
+START_TIMEOUT = 600 # seconds a new server may take until its UNet is loaded
+SERVER_STARTS = 3 # times a step finds no server for its image and starts one before it fails
+LOG_LINES = 20 # lines of server.log shown when the server failed
+
+
+def server_settings(configurations):
+    # precision and crop margin change the labels, the server of other settings must not take the image
+    precision = configurations.get("segmentation_precision", "float32") or "float32"
+    margin = configurations.get("segmentation_crop_margin", "128") or "none"
+    return precision, margin
+
+
+def server_dir(wor_dir, configurations):
+    precision, margin = server_settings(configurations)
+    return wor_dir + "/segmentation_server/" + socket.gethostname() + "/" + precision + "_margin-" + margin
+
+
+def server_alive(directory):
+    """True if a server holds the lock of the directory."""
+    if not os.path.exists(directory + "/server.lock"):
+        return False
+    with open(directory + "/server.lock", "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return True
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        return False
+
+
+def log_tail(directory):
+    try:
+        with open(directory + "/server.log", errors="replace") as log:
+            lines = log.readlines()[-LOG_LINES:]
+    except OSError:
+        return ""
+    return "\nEnd of " + directory + "/server.log:\n" + "".join(lines)
+
+
+def ensure_server(directory, configurations):
+    """
+    Starts a server in the directory unless one is running (only one of several waiting steps starts it)
+    and waits until its UNet is loaded.
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(directory + "/start.lock", "w") as start_lock:
+        fcntl.flock(start_lock, fcntl.LOCK_EX)
+        if server_alive(directory):
+            return
+        if os.path.exists(directory + "/server.ready"): # left by a server which was killed
+            os.remove(directory + "/server.ready")
+        # the threads reserved by the calling step: the server works for the steps waiting for it
+        threads = int(os.environ.get("OMP_NUM_THREADS", "") or configurations.get("max_threads", "") or machine_threads())
+        precision, margin = server_settings(configurations)
+        command = [sys.executable, "-u", "-m", "pipe_helpers.segmentation_server", directory,
+                   "--batch-slices", configurations.get("segmentation_batch_slices", "32") or "32",
+                   "--subjects", configurations.get("segmentation_server_subjects", "2") or "2",
+                   "--idle-exit", configurations.get("segmentation_server_idle_seconds", "600") or "600",
+                   "--crop-margin", margin,
+                   "--precision", precision]
+        with open(directory + "/server.log", "a") as log:
+            server = subprocess.Popen(command, cwd=sys.path[0], env=dict(os.environ, **thread_environment(threads)),
+                                      stdout=log, stderr=subprocess.STDOUT, start_new_session=True) # outlives the step which started it
+        print("Segmentation server started on", socket.gethostname(), "( pid", server.pid, ", log", directory + "/server.log )")
+        tic = time.time()
+        while not os.path.exists(directory + "/server.ready"):
+            if server.poll() is not None:
+                raise RuntimeError("The segmentation server exited with " + str(server.returncode) + " before its model was loaded." + log_tail(directory))
+            if time.time() - tic > START_TIMEOUT:
+                server.kill()
+                raise RuntimeError("The segmentation server did not load its model within " + str(START_TIMEOUT) + " s." + log_tail(directory))
+            time.sleep(0.5)
+
+
+def segment(file_t2, configurations):
+    """
+    Segments a T2 image with the server of this machine (started if needed) and waits for the result.
+
+    Inputs:
+        file_t2: T2_SVRTK_reformatted.nii.gz of the subject
+        configurations: config of the run (server settings, max_threads)
+    """
+    directory = server_dir(sys.path[0], configurations)
+    if is_dry_run():
+        print("    (segmentation server " + directory + ") " + file_t2)
+        return
+    queue = LocalFileQueue(directory)
+    job_id = time.strftime("%Y%m%d%H%M%S") + "_" + uuid.uuid4().hex[:8] # the server takes the oldest job first
+    queue.submit(job_id, (file_t2,))
+    starts = 0
+    try:
+        while True:
+            state = queue.poll(job_id)
+            if state == "done":
+                break
+            if state == "lost":
+                raise RuntimeError("The segmentation server stopped while segmenting " + file_t2 + ", see " + directory + "/server.log")
+            if state == "pending" and not server_alive(directory):
+                if starts == SERVER_STARTS:
+                    raise RuntimeError("No segmentation server kept running for " + file_t2 + " after " + str(starts) + " starts." + log_tail(directory))
+                starts += 1
+                ensure_server(directory, configurations)
+            time.sleep(POLL)
+    except BaseException:
+        queue.cancel(job_id)
+        raise
+    kind, value = queue.result(job_id)
+    if kind == "error":
+        raise RuntimeError("Segmentation of " + file_t2 + " failed: " + value)
+    return value
+
+
+##############
+### SERVER ###
+##############
+
+@contextmanager
+def heartbeat(queue, job_ids):
+    # the server runs the jobs itself, so it keeps them alive for the waiting steps (see LOST_AFTER in local_queue.py)
+    stop = threading.Event()
+
+    def touch():
+        while not stop.wait(HEARTBEAT):
+            for job_id in job_ids:
+                if os.path.exists(queue.queue_dir + "/running/" + job_id):
+                    os.utime(queue.queue_dir + "/running/" + job_id)
+
+    beating = threading.Thread(target=touch, daemon=True)
+    beating.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        beating.join()
+
+
+def serve(directory, batch_slices=32, max_subjects=2, idle_exit=600, margin=128, precision="float32"):
+    """
+    Runs the server until no image came for idle_exit seconds.
+
+    Inputs:
+        directory: server directory (see server_dir)
+        batch_slices: slices per UNet batch
+        max_subjects: images segmented together
+        idle_exit: seconds without images after which the server stops
+        margin: background kept around the brain (None: whole slices, see crop_box in the segmentation script)
+        precision: of the UNet (see PRECISIONS in the segmentation script)
+    """
+    lock = open(directory + "/server.lock", "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        print("A segmentation server is already running in", directory)
+        return
+    from medpy.io import load
+    from pipe_helpers import neonatal_segmentation_single_file_probabilityLabels as segmentation
+
+    queue = LocalFileQueue(directory)
+    print("Segmentation server", socket.gethostname(), os.getpid(), "loads", segmentation.ckpt_path, "(" + precision + ")")
+    tic = time.time()
+    model = segmentation.load_model(segmentation.ckpt_path, precision)
+    print("Model loaded in", round(time.time() - tic, 1), "s, threads:", os.environ.get("OMP_NUM_THREADS", "all"))
+    with open(directory + "/server.ready", "w") as ready:
+        ready.write(str(os.getpid()))
+
+    idle_since = time.time()
+    with ThreadPoolExecutor(max_workers=max_subjects) as readers:
+        while True:
+            job_ids = []
+            while len(job_ids) < max_subjects:
+                job_id = queue.take()
+                if job_id is None:
+                    break
+                job_ids.append(job_id)
+            if not job_ids:
+                if time.time() - idle_since > idle_exit:
+                    break
+                time.sleep(1)
+                continue
+
+            with heartbeat(queue, job_ids):
+                tic = time.time()
+                files = {}
+                for job_id in job_ids:
+                    try:
+                        files[job_id] = queue.job(job_id)[0]
+                    except Exception as error:
+                        queue.finish(job_id, ("error", type(error).__name__ + ": " + str(error)))
+                reading = {job_id: readers.submit(load, file_t2) for job_id, file_t2 in files.items()}
+                images = {}
+                for job_id, future in reading.items():
+                    try:
+                        images[job_id] = future.result()[0]
+                    except Exception as error:
+                        queue.finish(job_id, ("error", type(error).__name__ + ": " + str(error)))
+                with ExitStack() as scratch: # memory-mapped outputs, removed when written
+                    outputs = {job_id: scratch.enter_context(segmentation.scratch_outputs(files[job_id], image_data.shape[:3]))
+                               for job_id, image_data in images.items()}
+                    try:
+                        segmentation.predict_batch(model, list(images.values()), list(outputs.values()), batch_slices, margin)
+                    except Exception as error:
+                        for job_id in images:
+                            queue.finish(job_id, ("error", type(error).__name__ + ": " + str(error)))
+                        outputs = {}
+                    images.clear()
+                    for job_id, image_outputs in outputs.items():
+                        try:
+                            segmentation.write_outputs(files[job_id], image_outputs)
+                            queue.finish(job_id, ("result", None))
+                        except Exception as error:
+                            queue.finish(job_id, ("error", type(error).__name__ + ": " + str(error)))
+                print("Segmented", len(files), "image(s) in", round(time.time() - tic, 1), "s:", ", ".join(files.values()))
+            idle_since = time.time()
+    print("Segmentation server", socket.gethostname(), os.getpid(), "stops after", idle_exit, "s without images.")
+    if os.path.exists(directory + "/server.ready"):
+        os.remove(directory + "/server.ready")
+    lock.close() # the next segmentation step starts a new server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Segmentation server (started by the segmentation steps of DTI_Pipeline.py).")
+    parser.add_argument("directory", help="server directory")
+    parser.add_argument("--batch-slices", type=int, default=32, help="slices per UNet batch")
+    parser.add_argument("--subjects", type=int, default=2, help="images segmented together")
+    parser.add_argument("--idle-exit", type=float, default=600, help="seconds without images after which the server stops")
+    parser.add_argument("--crop-margin", default="128", help="voxels of background segmented around the brain (none: whole slices)")
+    parser.add_argument("--precision", default="float32", help="float32, bfloat16 or int8")
+    args = parser.parse_args()
+    from pipe_helpers.neonatal_segmentation_single_file_probabilityLabels import crop_margin
+    serve(args.directory, args.batch_slices, args.subjects, args.idle_exit, crop_margin(args.crop_margin), args.precision)
@@ -21,11 +21,11 @@ tissue=$4
 # Filtering for the multi_tissue data
 if [ "$tissue" = "SS3T" ]; then
 cd $data_directory/processing/tractography/three_tissue
-tcksift2 -force -act 5tt_regtodwi.mif tracks_$((orig_num_mio))mio.tck wmfod_norm.mif tck2_weights.txt -out_mu SIFT2_mu.txt -out_coeffs tck2_coeffs.txt -csv sift2_stats.csv 
+tcksift2 -force -act 5tt_regtodwi.mif tracks_$((orig_num_mio))mio.tck wmfod_norm.mif .partial_$$_tck2_weights.txt -out_mu SIFT2_mu.txt -out_coeffs tck2_coeffs.txt -csv sift2_stats.csv && mv .partial_$$_tck2_weights.txt tck2_weights.txt || rm -f .partial_$$_tck2_weights.txt
 
 elif [ "$tissue" = "SS2T" ]; then
 cd $data_directory/processing/tractography/two_tissue
-tcksift2 -force -act 5tt_regtodwi.mif tracks_$((orig_num_mio))mio.tck wmfod_norm.mif tck2_weights.txt -out_mu SIFT2_mu.txt -out_coeffs tck2_coeffs.txt -csv sift2_stats.csv 
+tcksift2 -force -act 5tt_regtodwi.mif tracks_$((orig_num_mio))mio.tck wmfod_norm.mif .partial_$$_tck2_weights.txt -out_mu SIFT2_mu.txt -out_coeffs tck2_coeffs.txt -csv sift2_stats.csv && mv .partial_$$_tck2_weights.txt tck2_weights.txt || rm -f .partial_$$_tck2_weights.txt
 
 fi
 
@@ -20,7 +20,7 @@ orig_num_tr=$3 # number of tracts of the input tractogram
 ### B) FILTERING: 
 # Filtering with SIFT2 for the single_tissue data
 cd $data_directory/processing/tractography/single_tissue
-tcksift2 -force -act 5tt_regtodwi.mif tracks_$((orig_num_mio))mio.tck wm_tournier_fod.mif tck2_weights.txt -out_mu SIFT2_mu.txt -out_coeffs tck2_coeffs.txt -csv sift2_stats.csv 
+tcksift2 -force -act 5tt_regtodwi.mif tracks_$((orig_num_mio))mio.tck wm_tournier_fod.mif .partial_$$_tck2_weights.txt -out_mu SIFT2_mu.txt -out_coeffs tck2_coeffs.txt -csv sift2_stats.csv && mv .partial_$$_tck2_weights.txt tck2_weights.txt || rm -f .partial_$$_tck2_weights.txt
 
 
 
@@ -22,13 +22,13 @@ tissue=$4
 if [ "$tissue" = "SS3T" ]; then
 cd $data_directory/processing/tractography/three_tissue
 
-tcksift -force -act 5tt_regtodwi.mif -term_number $new_num_tr tracks_$((orig_num_mio))mio.tck wmfod_norm.mif sift_$((new_num_mio))mio.tck -out_mu SIFT_mu.txt
+tcksift -force -act 5tt_regtodwi.mif -term_number $new_num_tr tracks_$((orig_num_mio))mio.tck wmfod_norm.mif .partial_$$_sift_$((new_num_mio))mio.tck -out_mu SIFT_mu.txt && mv .partial_$$_sift_$((new_num_mio))mio.tck sift_$((new_num_mio))mio.tck || rm -f .partial_$$_sift_$((new_num_mio))mio.tck
 chmod a+rwx ./sift_$((new_num_mio))mio.tck
 
 elif [ "$tissue" = "SS2T" ]; then
 cd $data_directory/processing/tractography/two_tissue
 
-tcksift -force -act 5tt_regtodwi.mif -term_number $new_num_tr tracks_$((orig_num_mio))mio.tck wmfod_norm.mif sift_$((new_num_mio))mio.tck -out_mu SIFT_mu.txt
+tcksift -force -act 5tt_regtodwi.mif -term_number $new_num_tr tracks_$((orig_num_mio))mio.tck wmfod_norm.mif .partial_$$_sift_$((new_num_mio))mio.tck -out_mu SIFT_mu.txt && mv .partial_$$_sift_$((new_num_mio))mio.tck sift_$((new_num_mio))mio.tck || rm -f .partial_$$_sift_$((new_num_mio))mio.tck
 chmod a+rwx ./sift_$((new_num_mio))mio.tck
 fi
 
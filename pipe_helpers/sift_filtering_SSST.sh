@@ -20,7 +20,7 @@ orig_num_tr=$3 # number of tracts of the input tractogram
 ### B) FILTERING: 
 # Filtering for the single_tissue data
 cd $data_directory/processing/tractography/single_tissue
-tcksift -force -act 5tt_regtodwi.mif -term_number $new_num_tr tracks_$((orig_num_mio))mio.tck wmtournier_fod_norm.mif sift_$((new_num_mio))mio.tck -out_mu SIFT_mu.txt
+tcksift -force -act 5tt_regtodwi.mif -term_number $new_num_tr tracks_$((orig_num_mio))mio.tck wmtournier_fod_norm.mif .partial_$$_sift_$((new_num_mio))mio.tck -out_mu SIFT_mu.txt && mv .partial_$$_sift_$((new_num_mio))mio.tck sift_$((new_num_mio))mio.tck || rm -f .partial_$$_sift_$((new_num_mio))mio.tck
 chmod a+rwx ./sift_$((new_num_mio))mio.tck
 
 
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Provenance manifests deciding if the result of a stage can be reused.
+
+For every stage which ran through, the manifest of the subject
+(base_dir/subj/processing/stage_manifest.json, for group stages
+wor_dir/GroupComparison/stage_manifest.json) records a key hashed from
+    - the content of the input files of the stage,
+    - the config values the stage depends on (Stage.params),
+    - the versions of the tools it calls (Stage.tools),
+and the content hashes of the outputs. A stage is only skipped if its key is
+unchanged and its outputs are still the ones it wrote. A changed parameter
+therefore only reruns the stages using it and, through the changed input
+hashes, the stages downstream. Outputs of a killed run were never recorded and
+are recomputed.
+
+Before a stage starts it is marked as running in the manifest, the mark is
+removed when it ran through. Outputs of a stage which is still marked when the
+next run starts (the run was killed, the node preempted, or the stage failed)
+may be incomplete and are deleted before the stage runs again, in every mode.
+
+Files are hashed once: the hash is stored together with size and modification
+time and only recomputed when one of them changed.
+
+Config key "stage_cache":
+    manifest: as described above (default)
+    adopt:    like manifest, but existing outputs without a manifest entry (e.g.
+              from a run with an older pipeline version) are recorded and reused
+    exists:   former behaviour, a stage is skipped if all its outputs exist
+
+@author: anna speckert
+"""
+import os
+import time
+import json
+import hashlib
+import subprocess
+
+
+MANIFEST_VERSION = 1
+_tool_versions = {}
+
+
+def file_hash(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as stream:
+        for block in iter(lambda: stream.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def tool_version(tool):
+    """
+    Returns the version of a tool used by a stage (cached for the whole run).
+
+    Inputs:
+        tool: "python:<distribution>" for python packages (e.g. "python:dipy"),
+              "fsl" for the FSL installation, otherwise a command which
+              understands --version (MRtrix3, ANTs, ...)
+    """
+    if tool in _tool_versions:
+        return _tool_versions[tool]
+    if tool.startswith("python:"):
+        from importlib import metadata # slow to import, only needed once a version is asked for
+        try:
+            version = metadata.version(tool[len("python:"):])
+        except metadata.PackageNotFoundError:
+            version = "not installed"
+    elif tool == "fsl":
+        version_file = os.path.join(os.environ.get("FSLDIR", ""), "etc", "fslversion")
+        version = open(version_file).read().strip() if os.path.exists(version_file) else "unknown"
+    else:
+        try:
+            result = subprocess.run([tool, "--version"], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=30)
+            lines = [line.strip() for line in result.stdout.decode(errors="replace").splitlines() if line.strip()]
+            version = lines[0] if lines else "unknown"
+        except (OSError, subprocess.TimeoutExpired):
+            version = "not found"
+    _tool_versions[tool] = version
+    return version
+
+
+class StageCache:
+    """
+    Keeps the manifests of all subjects of a run. Only used from the main
+    process of run_graph, the workers never write to a manifest.
+    """
+
+    def __init__(self, configurations, wor_dir):
+        self.configurations = configurations
+        self.base_dir = configurations["base_dir"]
+        self.wor_dir = wor_dir
+        self.mode = configurations.get("stage_cache", "manifest") or "manifest"
+        self.manifests = {}
+
+    def manifest_path(self, subj):
+        if subj is None:
+            return self.wor_dir + "/GroupComparison/stage_manifest.json"
+        return self.base_dir + "/" + subj + "/processing/stage_manifest.json"
+
+    def manifest(self, subj):
+        if subj not in self.manifests:
+            manifest = {"version": MANIFEST_VERSION, "stages": {}, "files": {}}
+            path = self.manifest_path(subj)
+            if os.path.exists(path):
+                try:
+                    with open(path) as jsonfile:
+                        loaded = json.load(jsonfile)
+                    if loaded.get("version") == MANIFEST_VERSION:
+                        manifest = loaded
+                except ValueError:
+                    print("The stage manifest ", path, "is corrupt and will be rewritten.")
+            self.manifests[subj] = manifest
+        return self.manifests[subj]
+
+    def save(self, subj):
+        path = self.manifest_path(subj)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as jsonfile:
+            json.dump(self.manifest(subj), jsonfile, indent=1, sort_keys=True)
+        os.replace(path + ".tmp", path) # a killed run never leaves half a manifest
+
+    def hash_of(self, subj, path):
+        # content hash of a file, recomputed only if size or modification time changed
+        if not os.path.exists(path):
+            return "missing"
+        info = os.stat(path)
+        files = self.manifest(subj)["files"]
+        known = files.get(path)
+        if known is not None and known[0] == info.st_size and known[1] == info.st_mtime_ns:
+            return known[2]
+        digest = file_hash(path)
+        files[path] = [info.st_size, info.st_mtime_ns, digest]
+        return digest
+
+    def input_paths(self, stage, subj, subjects):
+        if subj is not None:
+            return stage.paths(stage.inputs, self.base_dir, subj, self.wor_dir)
+        paths = []
+        for template in stage.inputs:
+            if "{subject_dir}" in template or "{subj}" in template:
+                paths.extend(stage.paths([template], self.base_dir, other, self.wor_dir)[0] for other in subjects)
+            else:
+                paths.extend(stage.paths([template], self.base_dir, None, self.wor_dir))
+        return paths
+
+    def stage_key(self, stage, subj, subjects):
+        """Returns the hash over inputs, parameters and tool versions of a stage."""
+        if self.mode == "exists":
+            return None
+        function = getattr(stage.function, "func", stage.function)
+        description = {"stage": stage.name,
+                       "function": function.__module__ + "." + function.__qualname__,
+                       "params": {key: self.configurations.get(key) for key in stage.params},
+                       "tools": {tool: tool_version(tool) for tool in stage.tools},
+                       "inputs": {path: self.hash_of(subj, path) for path in self.input_paths(stage, subj, subjects)}}
+        if subj is None:
+            description["subjects"] = sorted(subjects)
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def outputs_exist(self, stage, subj):
+        return len(stage.outputs) > 0 and all(os.path.exists(path) for path in stage.paths(stage.outputs, self.base_dir, subj, self.wor_dir))
+
+    def start(self, stage, subj):
+        """Marks the stage as running, its outputs are incomplete until record() is called."""
+        self.manifest(subj).setdefault("running", {})[stage.name] = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.save(subj)
+
+    def discard_outputs(self, stage, subj):
+        for path in stage.paths(stage.outputs, self.base_dir, subj, self.wor_dir):
+            if os.path.isfile(path) or os.path.islink(path):
+                os.remove(path)
+
+    def is_up_to_date(self, stage, subj, subjects, key):
+        """True if the outputs of the stage can be reused."""
+        if stage.name in self.manifest(subj).get("running", {}):
+            print(subj if subj is not None else "Group", ":", stage.name, "did not run through last time, its outputs are discarded.")
+            self.discard_outputs(stage, subj)
+            return False
+        if not self.outputs_exist(stage, subj):
+            return False
+        if self.mode == "exists":
+            return True
+        entry = self.manifest(subj)["stages"].get(stage.name)
+        if entry is None:
+            if self.mode == "adopt":
+                print(subj if subj is not None else "Group", ":", stage.name, "has no manifest entry, the existing outputs are adopted.")
+                self.record(stage, subj, key)
+                return True
+            return False
+        if entry["key"] != key:
+            print(subj if subj is not None else "Group", ":", stage.name, "inputs, parameters or tool versions changed since the last run.")
+            return False
+        for path, digest in entry["outputs"].items():
+            if self.hash_of(subj, path) != digest:
+                print(subj if subj is not None else "Group", ":", stage.name, "output ", path, "was changed since the last run.")
+                return False
+        return True
+
+    def record(self, stage, subj, key):
+        """Writes the key and the output hashes of a stage which ran through to the manifest."""
+        self.manifest(subj).get("running", {}).pop(stage.name, None)
+        if self.mode != "exists":
+            outputs = stage.paths(stage.outputs, self.base_dir, subj, self.wor_dir)
+            self.manifest(subj)["stages"][stage.name] = {"key": key, "outputs": {path: self.hash_of(subj, path) for path in outputs}}
+        self.save(subj)
+
+    def forget(self, stage, subj):
+        # the stage is rerun: its old entry must not survive a crash of the new run
+        if self.mode != "exists" and self.manifest(subj)["stages"].pop(stage.name, None) is not None:
+            self.save(subj)
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dependency graph of the pipeline stages and the executor running it.
+
+Every processing step is declared as a Stage with the files it reads (inputs)
+and the files it writes (outputs). A stage depends on the stage producing one
+of its inputs, so the executor can start a step of one subject as soon as the
+steps it needs are done for that subject: subject A can already track while
+subject B is still being denoised. The only barriers left are group stages
+(responsemean, dwinormalise group), which wait for all subjects, and the
+optional interactive check points (config key "qc_gates").
+
+Whether a stage has to run at all is decided by the provenance manifests of
+stage_cache.py (config key "stage_cache"), when it may start also by the memory
+and thread budget of resources.py. Where it runs (in-process, local worker
+processes or jobs of a batch queue) is chosen with the config key "executor"
+(see execution_backends.py). Every run is traced (see tracing.py), the
+output of the external commands of a stage goes to its log file (see
+command_executor.py).
+
+A stage which failed for a reason that may go away on its own (an exception,
+a killed worker e.g. out of memory, or an external command which did not
+write its outputs) is started again after a pause, up to "stage_retries"
+times. The pause starts with "retry_backoff_seconds" and doubles with every
+attempt. Failures reported by the stage itself (missing provided files, QC
+gates) are not retried.
+
+Path templates may contain {subject_dir} (= base_dir/subj), {subj} and {wor_dir}
+(= the directory of DTI_Pipeline.py).
+
+@author: anna speckert
+"""
+import os
+import sys
+import json
+import time
+import traceback
+from concurrent.futures import wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from pipe_helpers.stage_cache import StageCache
+from pipe_helpers.resources import ResourceBudget, limit_threads
+from pipe_helpers.execution_backends import make_executor, uses_local_resources
+from pipe_helpers import tracing
+from pipe_helpers import command_executor
+from pipe_helpers import qc_render
+from pipe_helpers.qc_gates import GATES
+
+
+class Stage:
+    """
+    One node of the pipeline graph.
+
+    Inputs:
+        name: unique stage name
+        function: per-subject stages are called as function(base_dir, subj, configurations),
+                  group stages as function(base_dir, subjects, configurations)
+        inputs, outputs: lists of path templates
+        group: True if the stage runs once for all subjects
+        after: names of stages which must be finished although no file links them
+        guards: names of the stages a check point (gate) stands behind. Every stage
+                using the results of a guarded stage waits for the gate.
+        interactive: the stage asks the user and therefore runs in the main process
+        params: config keys the result depends on (see stage_cache.py)
+        tools: external tools resp. python packages whose version the result depends on
+        memory_gb: estimated peak memory of one job of the stage (see resources.py)
+        threads: number of threads one job of the stage uses
+    """
+
+    def __init__(self, name, function, inputs=(), outputs=(), group=False, after=(), guards=(), interactive=False, params=(), tools=(),
+                 memory_gb=1.0, threads=1):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.group = group
+        self.after = list(after)
+        self.guards = list(guards)
+        self.interactive = interactive
+        self.params = list(params)
+        self.tools = list(tools)
+        self.memory_gb = memory_gb
+        self.threads = threads
+
+    def paths(self, templates, base_dir, subj, wor_dir):
+        return [template.format(subject_dir=base_dir + "/" + str(subj), subj=subj, wor_dir=wor_dir) for template in templates]
+
+    def __repr__(self):
+        return "Stage(" + self.name + ")"
+
+
+class PipelineStopped(Exception):
+    """Raised by an interactive check point when the user does not want to continue."""
+
+
+def max_parallel_subjects(configurations):
+    return max(1, int(configurations.get("max_parallel_subjects", "1") or 1))
+
+
+def retry_settings(configurations):
+    """Returns (number of retries, pause before the first retry in seconds)."""
+    retries = int(configurations.get("stage_retries", "1") or 0)
+    backoff = float(configurations.get("retry_backoff_seconds", "30") or 0)
+    return max(0, retries), max(0.0, backoff)
+
+
+TRANSIENT_RESULTS = ("crashed", "worker died")
+
+
+def _worker_options():
+    # A fresh process per job: thread settings read once at import (ITK, TensorFlow, BLAS)
+    # must not leak from one stage into the next one run by the same worker. Before
+    # Python 3.11 make_executor starts a process per job instead (see execution_backends.py).
+    return {"max_tasks_per_child": 1}
+
+
+def _call_stage(function, base_dir, subject_or_subjects, configurations, threads=None, trace=None, log=None):
+    # Runs in the worker process. An exception must not take the rest of the cohort down with it.
+    token = tracing.begin_stage(*trace) if trace is not None else None
+    if log is not None:
+        command_executor.begin_stage(log)
+    try:
+        if threads is None:
+            result = function(base_dir, subject_or_subjects, configurations)
+        else:
+            with limit_threads(threads):
+                result = function(base_dir, subject_or_subjects, configurations)
+    except PipelineStopped:
+        raise
+    except Exception:
+        traceback.print_exc()
+        result = "crashed"
+    if log is not None:
+        command_executor.end_stage()
+    if token is not None:
+        tracing.end_stage(token, result)
+    return result
+
+
+def stage_dependencies(stages):
+    """
+    Returns {stage name: [(producer stage, same_subject)]} where same_subject tells
+    if a per-subject stage only waits for the producer of the same subject.
+    """
+    by_name = {stage.name: stage for stage in stages}
+    producers = {}
+    for stage in stages:
+        for output in stage.outputs:
+            producers[output] = stage
+    guarded_by = {}
+    for stage in stages:
+        for name in stage.guards:
+            guarded_by.setdefault(name, []).append(stage)
+
+    dependencies = {}
+    for stage in stages:
+        direct = [producers[template] for template in stage.inputs if template in producers and producers[template] is not stage]
+        direct += [by_name[name] for name in stage.after if name in by_name]
+        for producer in list(direct):
+            for gate in guarded_by.get(producer.name, []):
+                if stage.name not in gate.guards and gate is not stage:
+                    direct.append(gate)
+        unique = []
+        for producer in direct:
+            if producer not in unique:
+                unique.append(producer)
+        dependencies[stage.name] = [(producer, not stage.group and not producer.group) for producer in unique]
+    return dependencies
+
+
+def _check_acyclic(stages, dependencies):
+    visiting, done = set(), set()
+
+    def visit(stage):
+        if stage.name in done:
+            return
+        if stage.name in visiting:
+            raise ValueError("The stage graph has a cycle at stage " + stage.name)
+        visiting.add(stage.name)
+        for producer, _ in dependencies[stage.name]:
+            visit(producer)
+        visiting.discard(stage.name)
+        done.add(stage.name)
+
+    for stage in stages:
+        visit(stage)
+
+
+def print_status(stages, subjects, configurations):
+    """
+    Prints how far every subject got (python DTI_Pipeline.py --status). Only looks at
+    the outputs, the stage manifests and the QC results: nothing is run or hashed.
+    """
+    cache = StageCache(configurations, sys.path[0])
+
+    def state(stage, subj):
+        manifest = cache.manifest(subj)
+        if stage.name in manifest.get("running", {}):
+            return "interrupted"
+        if not cache.outputs_exist(stage, subj):
+            return "open"
+        if cache.mode != "exists" and stage.name not in manifest["stages"]:
+            return "not recorded"
+        return "done"
+
+    def line(name, states, extra=""):
+        done = [stage for stage, current in states if current == "done"]
+        todo = [stage.name + ("" if current == "open" else " (" + current + ")") for stage, current in states if current != "done"]
+        print(name, ":", len(done), "of", len(states), "steps done" + (", next: " + ", ".join(todo[:2]) if todo else "") + extra)
+
+    with_outputs = [stage for stage in stages if len(stage.outputs) > 0]
+    for subj in subjects:
+        qc = []
+        qc_dir = cache.base_dir + "/" + subj + "/processing/QC"
+        for gate in GATES: # only the gate results, the folder also holds the QC figures (qc_render.py)
+            if os.path.exists(qc_dir + "/" + gate + ".json"):
+                with open(qc_dir + "/" + gate + ".json") as jsonfile:
+                    result = json.load(jsonfile)
+                if result["status"] != "pass":
+                    qc.append("QC " + result["gate"] + " " + result["status"])
+        line(subj, [(stage, state(stage, subj)) for stage in with_outputs if not stage.group], "; " + ", ".join(qc) if qc else "")
+    group = [(stage, state(stage, None)) for stage in with_outputs if stage.group]
+    if group:
+        line("Group", group)
+
+
+def stage_order(stages):
+    """Returns the stages in an order in which every stage comes after the stages it depends on."""
+    dependencies = stage_dependencies(stages)
+    _check_acyclic(stages, dependencies)
+    ordered = []
+
+    def visit(stage):
+        if stage in ordered:
+            return
+        for producer, _ in dependencies[stage.name]:
+            visit(producer)
+        ordered.append(stage)
+
+    for stage in stages:
+        visit(stage)
+    return ordered
+
+
+def print_plan(stages, subjects, configurations):
+    """
+    Prints the commands every stage would run for every subject (python DTI_Pipeline.py --dry-run).
+    The stage functions are called with the command executor in dry-run mode, so nothing is
+    run, written or recorded in the manifests. Check points are only listed.
+    """
+    base_dir = configurations["base_dir"]
+    command_executor.set_dry_run(True)
+    for stage in stage_order(stages):
+        print("#####", stage.name, "#####")
+        if stage.interactive:
+            print("    check point: asks whether to continue with all subjects")
+            continue
+        for subj in ([None] if stage.group else subjects):
+            print("  " + (subj if subj is not None else "Group (" + str(len(subjects)) + " subjects)") + ":")
+            stage.function(base_dir, subj if subj is not None else subjects, configurations)
+
+
+def run_graph(stages, subjects, configurations, not_working_subj):
+    """
+    Runs all stages for all subjects as soon as their dependencies are fulfilled.
+
+    Inputs:
+        stages: list of Stage
+        subjects: list of subject ids
+        configurations: content of config_dti.json
+        not_working_subj: list to which [subj, failed stage] is appended for every failed subject
+
+    Output:
+        list of the subjects which ran through all stages. PipelineStopped is raised
+        (after the running stages are done) if the user stopped at a check point.
+    """
+    base_dir = configurations["base_dir"]
+    wor_dir = sys.path[0]
+    dependencies = stage_dependencies(stages)
+    _check_acyclic(stages, dependencies)
+    cache = StageCache(configurations, wor_dir)
+    budget = ResourceBudget(configurations)
+    budget.reserve(qc_render.reserved_memory_gb(configurations)) # the QC figures are rendered beside the stages
+    local = uses_local_resources(configurations) # jobs of a queue run on other machines and are not budgeted here
+    run_dir = tracing.new_run_dir(wor_dir)
+
+    # one node per (stage, subject), group stages have a single node (stage, None)
+    nodes = []
+    for stage in stages:
+        if stage.group:
+            nodes.append((stage, None))
+        else:
+            nodes.extend((stage, subj) for subj in subjects)
+    status = {(stage.name, subj): "pending" for stage, subj in nodes}
+    cache_keys = {} # provenance key of the nodes which are ready to run
+    failed_subjects = {}
+    running = {}
+    retries, backoff = retry_settings(configurations)
+    attempts = {} # number of retries per node
+    retry_at = {} # earliest start of a node waiting for its retry
+
+    def fail(subj, reason):
+        if subj not in failed_subjects:
+            failed_subjects[subj] = reason
+            not_working_subj.append([subj, reason])
+            print(subj, ": ", reason, "did not work. Image processing will continue with the other subjects.")
+
+    def node_state(stage, subj):
+        # 'ready', 'wait' or 'blocked' (a dependency failed for this subject)
+        for producer, same_subject in dependencies[stage.name]:
+            if producer.group:
+                keys = [(producer.name, None)]
+            elif same_subject:
+                keys = [(producer.name, subj)]
+            else:
+                keys = [(producer.name, other) for other in subjects if other not in failed_subjects]
+            for key in keys:
+                if status[key] == "failed":
+                    return "blocked"
+                if status[key] != "done":
+                    return "wait"
+        return "ready"
+
+    def finish(stage, subj, result, tic, cache_key):
+        key = (stage.name, subj)
+        outputs_missing = len(stage.outputs) > 0 and not cache.outputs_exist(stage, subj)
+        if result is None and not outputs_missing:
+            status[key] = "done"
+            if len(stage.outputs) > 0:
+                cache.record(stage, subj, cache_key)
+            print(subj if subj is not None else "Group", ":", stage.name, "took ", time.time() - tic, "seconds.")
+        elif (result in TRANSIENT_RESULTS or result is None) and not stage.interactive and attempts.get(key, 0) < retries:
+            attempts[key] = attempts.get(key, 0) + 1
+            pause = backoff * 2 ** (attempts[key] - 1)
+            print(subj if subj is not None else "Group", ":", stage.name, "failed (", result or "outputs missing", "). Retry", attempts[key], "of", retries, "in", pause, "seconds.")
+            cache.discard_outputs(stage, subj) # outputs of the failed attempt must not be taken for results
+            status[key] = "ready"
+            retry_at[key] = time.time() + pause
+        else:
+            status[key] = "failed"
+            if subj is not None:
+                fail(subj, stage.name)
+            else:
+                print("The group stage ", stage.name, "did not work.")
+
+    n_workers = max_parallel_subjects(configurations)
+    print("Running ", len(stages), "stages for ", len(subjects), "subjects with up to ", n_workers, "jobs in parallel" +
+          (" (budget: " + str(round(budget.memory_gb, 1)) + " GB memory, " + str(budget.threads) + " threads)." if local else " in the queue."))
+    pool = make_executor(configurations, n_workers, _worker_options())
+    pool_broken = False
+    try:
+        while True:
+            if pool_broken and not running:
+                pool.shutdown(wait=True) # no job is left, only the processes of the old pool are joined
+                pool = make_executor(configurations, n_workers, _worker_options())
+                pool_broken = False
+            started = False
+            for stage, subj in nodes:
+                key = (stage.name, subj)
+                if status[key] not in ("pending", "ready"):
+                    continue
+                if subj is not None and subj in failed_subjects:
+                    status[key] = "dropped"
+                    continue
+                if retry_at.get(key, 0) > time.time():
+                    continue
+                argument = subj if subj is not None else [other for other in subjects if other not in failed_subjects]
+                if status[key] == "pending":
+                    state = node_state(stage, subj)
+                    if state == "blocked":
+                        status[key] = "failed"
+                        if subj is not None:
+                            fail(subj, stage.name + " (dependency failed)")
+                        continue
+                    if state == "wait":
+                        continue
+                    cache_key = cache.stage_key(stage, subj, argument) if len(stage.outputs) > 0 else None
+                    if cache.is_up_to_date(stage, subj, argument, cache_key):
+                        print(subj if subj is not None else "Group", ":", stage.name, "output already exists. Will skip to next step.")
+                        status[key] = "done"
+                        started = True
+                        continue
+                    if cache_key is not None:
+                        cache.forget(stage, subj)
+                    status[key] = "ready"
+                    cache_keys[key] = cache_key
+                cache_key = cache_keys[key]
+                if stage.interactive:
+                    tic = time.time()
+                    try:
+                        result = _call_stage(stage.function, base_dir, argument, configurations)
+                    except PipelineStopped:
+                        print("The execution of the pipeline was stopped.")
+                        for future in running:
+                            future.cancel()
+                        raise
+                    finish(stage, subj, result, tic, cache_key)
+                else:
+                    if pool_broken:
+                        continue # waits until the jobs of the broken pool are collected and a new pool is started
+                    if len(running) >= n_workers or (local and not budget.admit(stage)):
+                        continue # waits until running stages have freed enough memory and cores
+                    print(subj if subj is not None else "Group", ":", stage.name, "starts now...")
+                    if len(stage.outputs) > 0:
+                        cache.start(stage, subj)
+                    try:
+                        future = pool.submit(_call_stage, stage.function, base_dir, argument, configurations, budget.job_threads(stage), (run_dir, subj, stage.name),
+                                             command_executor.log_path(base_dir, subj, stage.name))
+                    except BrokenProcessPool: # a worker died since the last collection, the stage stays ready for the new pool
+                        print("The worker pool broke before ", stage.name, "for ", subj, "was started, it is started again in a new pool.")
+                        if local:
+                            budget.release(stage)
+                        pool_broken = True
+                        started = True
+                        continue
+                    retry_at.pop(key, None)
+                    running[future] = (stage, subj, time.time(), cache_key)
+                    status[key] = "running"
+                started = True
+
+            if started:
+                continue # new nodes may have become ready (skipped outputs, interactive stages)
+            waiting = [retry_at[key] for key in retry_at if status[key] == "ready" and retry_at[key] > time.time()]
+            if not running and not waiting:
+                break
+            if not running:
+                time.sleep(max(0.0, min(waiting) - time.time()))
+                continue
+            timeout = max(0.0, min(waiting) - time.time()) if waiting else None
+            done, _ = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, subj, tic, cache_key = running.pop(future)
+                if local:
+                    budget.release(stage)
+                try:
+                    result = future.result()
+                except Exception as error: # e.g. the worker process was killed (out of memory)
+                    print("The worker running ", stage.name, "for ", subj, "died: ", error)
+                    result = "worker died"
+                    if isinstance(error, BrokenProcessPool) and not pool_broken:
+                        # all jobs of a broken pool fail, new ones need a new pool
+                        pool_broken = True
+                finish(stage, subj, result, tic, cache_key)
+    finally:
+        pool.shutdown(wait=True)
+        tracing.export_traces(run_dir, base_dir, subjects)
+
+    return [subj for subj in subjects if subj not in failed_subjects]
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-subject processing steps of the DTI pipeline.
+
+Every step takes the same three arguments (base_dir, subj, configurations) and
+does the work of one node of the stage graph (see pipeline_stages.py, where the
+inputs and outputs of each step are declared). Skipping steps whose outputs
+already exist and checking that the outputs were created is done by the
+executor in stage_graph.py. A step may return a short description of what went
+wrong, None means that it ran through.
+
+The python backends of the steps (dipy, nibabel, antspyx, ...) are listed in
+BACKENDS and only imported when a step using them runs, so starting the
+pipeline, a status query or a worker process stays fast.
+
+@author: anna speckert
+"""
+import os
+import sys
+import importlib
+
+from pipe_helpers.command_executor import call, is_dry_run # mkdir/chmod/cp in-process, tools logged and traced (see command_executor.py)
+from pipe_helpers.resources import mrtrix_nthreads # -nthreads of the job (see resources.py)
+from pipe_helpers.atomic_outputs import call_atomic # outputs only appear under their final name when complete
+from pipe_helpers import qc_render # QC figures are only requested here, the pipeline process renders them (see qc_render.py)
+
+
+TISSUE_DIRS = {"SSST": "single_tissue", "SS2T": "two_tissue", "SS3T": "three_tissue"}
+
+# name: (module, function)
+BACKENDS = {"denoising": ("pipe_helpers.Denoising_DWI", "denoising"), # Denoising functin from Dipy (autoencoder)
+            "5tt": ("pipe_helpers.make_5tt", "m_5tt"), # creates 5tt image from segmenttion output
+            "5tt registration": ("pipe_helpers.registration_reformatted_to_B0_for5tt", "reg_5tt_tDWI"), # regisration of segmented 5tt to dMRI space
+            "freesurfer 5tt registration": ("pipe_helpers.registration_freeS_to_B0_for5tt", "reg_5ttsurfer_tDWI"), # registration of freesurfer segmented 5tt to dMRI space
+            "freesurfer 5tt": ("pipe_helpers.freesurf_to_5tt", "free_2_5tt_anat"), # creating 5tt from freesurfer in anatomical space
+            "5tt to dwi": ("pipe_helpers.freesurf_to_5tt", "fivett_2_dwi"), # transforming 5tt from anatomical space to dwi space
+            "atlas registration": ("pipe_helpers.neonatal_parcellation", "reg_2_parcellation_improved"), # registration from atlas t2 to subject t2
+            "parcellation to dwi": ("pipe_helpers.neonatal_parcellation", "parcellation_2_dwi_improved")} # transforming label image from atlas to subject space
+
+
+def backend(name):
+    """Imports the python backend of a step (see BACKENDS) when it is needed. In a dry run it only prints the call."""
+    module, function = BACKENDS[name]
+    if is_dry_run():
+        return lambda *arguments: print("    python:", module + "." + function + "(" + ", ".join(repr(argument) for argument in arguments) + ")")
+    return getattr(importlib.import_module(module), function)
+
+
+def subject_dir(base_dir, subj):
+    return base_dir + "/" + subj
+
+
+def make_processing_dirs(base_dir, subj):
+    process_dir = base_dir + "/" + subj + "/processing"
+    call(["mkdir", "-m777", process_dir]) # -m777 option makes write permisson for all users
+    call(["mkdir", "-m777", process_dir + "/t2"])
+    call(["mkdir", "-m777", process_dir + "/dti"])
+    call(["mkdir", "-m777", process_dir + "/tractography"])
+
+
+#################################
+### DTI PREPROCESSING STEPS ###
+#################################
+
+# 1) DENOISING using "Denoising_DWI.py" with the function "denoising()".
+     # input: subject directory
+     # functionality: patch2self (as in dipy) on all cores, optionally only within a dilated brain mask
+     # output: denoised nii image (the png of a denoised slice is rendered in the background, see qc_render.py)
+def denoise(base_dir, subj, configurations):
+    data_dir = subject_dir(base_dir, subj)
+    backend("denoising")(data_dir, configurations.get("denoising_mask", "no") == "yes")
+    qc_render.request(configurations, data_dir, "denoising", [data_dir + "/dti/dti.nii.gz", data_dir + "/processing/dti/denoising/denoised_patch2self.nii", data_dir + "/dti/bvals"])
+
+
+# 2) Unringing using MRtrix command mrdegibbs.
+     # input: subject directory of denoised image (uncompressed nii, read by mrdegibbs directly)
+     # functionality: uses mrdegibbs from MRtrix to do gibbs ringing correction
+     # output: degibbs.nii (uncompressed, the input format of eddy)
+def unring(base_dir, subj, configurations):
+    dti_dir = subject_dir(base_dir, subj) + "/processing/dti"
+    call_atomic(["mrdegibbs", dti_dir + "/denoising/denoised_patch2self.nii", dti_dir + "/degibbs.nii"] + mrtrix_nthreads(), [dti_dir + "/degibbs.nii"])
+    call(["chmod", "a+rwx", dti_dir + "/degibbs.nii"])
+
+
+# ageGroup influences the choise of FSL_basic_preprocessing
+# 3) MOTION & DISTORTION CORRECTION using FSL_basic_preprocessing_v6.sh
+     # input: degibbs image as nii
+     # functionality: uses eddy for motion and distortion correction with within-volume correction (depends on eddy_cuda8.0)
+     # output: eddy_images.nii (eddy and motion corrected images, uncompressed)
+def eddy_correct(base_dir, subj, configurations):
+    data_dir = subject_dir(base_dir, subj)
+    call([sys.path[0] + "/pipe_helpers/FSL_basic_preprocessing_agegroup_degibbsed.sh", data_dir, configurations["ageGroup"]])
+# Here one could add the eddy quality controL
+
+
+# 4) B1 bias field correction using MRtrix command dwibias correct ants.
+     # input: subject directory of eddy nii image, gradients from bvecs/bvals (-fslgrad, no conversion to mif before)
+     # functionality: uses dwibiascorrect ants from MRtrix to do correct for itnensity modulations
+     # output: corrected image (biascorr.mif) and the estimated bias field image (biasfield.mif)
+def bias_correct(base_dir, subj, configurations):
+    data_dir = subject_dir(base_dir, subj)
+    dti_dir = data_dir + "/processing/dti"
+    call_atomic(["dwibiascorrect", "ants", dti_dir + "/eddy_images.nii", dti_dir + "/biascorr.mif", "-fslgrad", data_dir + "/dti/bvecs", data_dir + "/dti/bvals", "-bias", dti_dir + "/biasfield.mif"] + mrtrix_nthreads(), [dti_dir + "/biascorr.mif", dti_dir + "/biasfield.mif"])
+    call(["chmod", "a+rwx", dti_dir + "/biascorr.mif"])
+
+
+# 5) In the single subject pipeline for SSST the global intensity normalisation is done now.
+     # input: subject directory of bias corrected mif image
+     # functionality: uses dwinormalise from MRtrix to do global intensity normalisation
+     # output: normalised image (bias_normcorr.mif)
+def normalise_individual(base_dir, subj, configurations):
+    dti_dir = subject_dir(base_dir, subj) + "/processing/dti"
+    call_atomic(["dwinormalise", "individual", dti_dir + "/biascorr.mif", dti_dir + "/hifi_nodif_brain_mask.mif", dti_dir + "/bias_normcorr.mif"] + mrtrix_nthreads(), [dti_dir + "/bias_normcorr.mif"])
+    call(["chmod", "a+rwx", dti_dir + "/bias_normcorr.mif"])
+### The mask computed during edddy correction (hifi_nodif_brain_mask.nii.gz) will be used.
+
+
+###############################
+### T2 PREPROCESSING STEPS  ###
+###############################
+
+# 1) REFORMATTING of the super-resolution reconstructed images using chd_to_mmc_network_reformat_anna_cs5.sh
+     # input: super-resolution reconstructed T2 image (T2_SVRTK.nii.gz)
+     # functionality: in order to be able to run the T2 through the segmentation U-net, it needs this reformatting
+     # output: T2_SVRTk_reformatted.nii.gz (reformatted image)
+def reformat_t2(base_dir, subj, configurations):
+    data_dir = subject_dir(base_dir, subj)
+    call([sys.path[0] + "/pipe_helpers/chd_to_mmc_network_reformat_anna_cs5.sh", data_dir + "/t2/T2_SVRTK.nii.gz", configurations["seg_atlas_path"]], cwd=sys.path[0]) # the atlas path may be relative to the working directory
+    print("Please check if the reformatting of ", subj, "worked out. \n Otherwise use instead of 'chd_to_mmc_network_reformat_anna_cs5.sh' the script 'chd_to_mmc_network_reformat_anna_cs5_new.sh' which uses 12 DOF or 'chd_to_mmc_network_reformat_anna_cs5_new_B.sh' which registeres to other reformatted image.")
+
+
+# 2) SEGMENTATION of the reformatted image using neonatal_segmentation_single_file_probabilityLabels.py
+     # input: reformatted super-resolution T2 image
+     # functionality: segments T2 in 8 labels
+     # output: t2_labeled and 8 separate label files within label folder
+def segment_t2(base_dir, subj, configurations):
+    data_dir = subject_dir(base_dir, subj)
+    if configurations.get("segmentation_server", "no") == "yes": # one process per machine keeps the UNet loaded (see segmentation_server.py)
+        from pipe_helpers.segmentation_server import segment
+        segment(data_dir + "/processing/t2/T2_SVRTK_reformatted.nii.gz", configurations)
+        return
+    call(["./pipe_helpers/neonatal_segmentation_single_file_probabilityLabels.py", data_dir + "/processing/t2/T2_SVRTK_reformatted.nii.gz", configurations.get("segmentation_crop_margin", "128") or "none",
+          configurations.get("segmentation_precision", "float32") or "float32"], cwd=sys.path[0]) # the model is loaded from the working directory
+
+
+########################
+### ACT PREPARATIONS ###
+########################
+
+# 1) CREATE 5-TISUE-TYPE (5TT) IMAGE using make_5tt.py with the function m_5tt()
+     # input: subject directory
+     # functionality: based on 8 separate label files, the 5tt image for ACT is created
+     # output: 5tt image within label folder (built in one pass, see make_5tt.build_5tt)
+def create_5tt(base_dir, subj, configurations):
+    data_dir = subject_dir(base_dir, subj)
+    backend("5tt")(data_dir + "/")
+    qc_render.request(configurations, data_dir, "5tt", [data_dir + "/processing/t2/T2_SVRTK_reformatted.nii.gz", data_dir + "/processing/t2/Labels/5tt.nii.gz"])
+
+
+# 2) REGISTRATION of 5tt image to the diffusion space using registration_reformatted_to_B0_for5tt.py with the function reg_5tt_tDWI()
+     # input: subject directory
+     # functionality: 1) non-linear registration (SyN from ANTS) of T2_reformatted to diffusion space (using skull-stripped b0 image)
+     #                2) apply transformation matrix to 5tt using interpolator multiLabel
+     # output: 5tt registred image to the diffusion space (5tt_reg_to_dwi.nii.gz)
+def register_5tt(base_dir, subj, configurations):
+    data_dir = subject_dir(base_dir, subj)
+    backend("5tt registration")(data_dir + "/")
+    request_registration_qc(configurations, data_dir, data_dir + "/processing/t2/Labels/t2reformatted_regtodwi.nii.gz")
+
+
+# 1) Using Freesurfer the Segmentation is created and based on that the 5tt.mif (within segmentation_child_ado.sh)
+# input: base_dir, subj
+# functionality: 1) Using freesurfer, the nii.gz gets converted to mgz, and the segmenation is computed
+#                2) Based on the segemnted output file, the mrtrix command 5ttgen creates the 5tt image
+# output: 5tt.mif image which is still in the subject structural space
+def create_5tt_child_ado(base_dir, subj, configurations):
+    call([sys.path[0] + "/pipe_helpers/segmentation_child_ado.sh", base_dir, subj, configurations["structural_type"]])
+
+
+# 2) REGISTRATION of 5tt image to the diffusion space using registration_freeS_to_B0_for5tt.py with the function reg_5ttsurfer_tDWI()
+     # input: subject directory
+     # functionality: 1) non-linear registration (SyN from ANTS) of T2 to diffusion space (using skull-stripped b0 image)
+     #                2) apply transformation matrix to 5tt using interpolator multiLabel
+     # output: 5tt registred image to the diffusion space (5tt_reg_to_dwi.nii.gz)
+def register_5tt_freesurfer(base_dir, subj, configurations):
+    data_dir = subject_dir(base_dir, subj)
+    backend("freesurfer 5tt registration")(data_dir + "/")
+    request_registration_qc(configurations, data_dir, data_dir + "/processing/t2/Labels/t2_regtodwi.nii.gz")
+
+
+def request_registration_qc(configurations, data_dir, warped_t2=None):
+    # warped T2 and 5tt over the skull-stripped b0
+    b0 = data_dir + "/processing/dti/hifi_nodif_brain.nii.gz"
+    if warped_t2 is not None:
+        qc_render.request(configurations, data_dir, "t2_dwi", [b0, warped_t2])
+    qc_render.request(configurations, data_dir, "5tt_dwi", [b0, data_dir + "/processing/t2/Labels/5tt_reg_to_dwi.nii.gz"])
+
+
+def check_provided_5tt(base_dir, subj, configurations):
+    if os.path.exists(subject_dir(base_dir, subj) + "/processing/t2/Labels/5tt_reg_to_dwi.nii.gz"):
+        print(subj, ": The 5tt registered to the diffusion space exists.")
+        return None
+    print(subj, ": The 5tt does not exist under /processing/t2/Labels/. Please provide a 5tt image registered to the diffusion space in this directory or change the variable '5tt_provided' in the config file.")
+    return "5tt provided"
+
+
+def create_5tt_fsl(base_dir, subj, configurations):
+    labels_dir = subject_dir(base_dir, subj) + "/processing/t2/Labels"
+    call(["mkdir", "-m777", "-p", labels_dir + "/"])
+    call_atomic(["5ttgen", "fsl", base_dir + "/" + subj + "/t2/orig_T1.nii.gz", labels_dir + "/5tt.nii.gz"], [labels_dir + "/5tt.nii.gz"]) # you can add the mask already if output is bad
+    call(["mrconvert", labels_dir + "/5tt.nii.gz", labels_dir + "/5tt.mif"])
+    backend("5tt to dwi")(base_dir, subj)
+    request_registration_qc(configurations, subject_dir(base_dir, subj))
+
+
+def create_5tt_freesurfer(base_dir, subj, configurations):
+    backend("freesurfer 5tt")(base_dir, subj, configurations["freesurfer_version"])
+    backend("5tt to dwi")(base_dir, subj)
+    request_registration_qc(configurations, subject_dir(base_dir, subj))
+
+
+#############################################
+### ANATOMICALLY CONSTRAINED TRACTOGRAPHY ###
+#############################################
+
+def response_paths(base_dir, subj, rfe):
+    """Returns the per-subject response function files written by rfe.sh (wm first)."""
+    tract_dir = subject_dir(base_dir, subj) + "/processing/tractography/" + TISSUE_DIRS[rfe]
+    if rfe == "SSST":
+        return [tract_dir + "/response_wm_tournier.txt"]
+    elif rfe == "SS2T":
+        return [tract_dir + "/response_wm.txt", tract_dir + "/response_csf.txt"]
+    return [tract_dir + "/response_wm.txt", tract_dir + "/response_gm.txt", tract_dir + "/response_csf.txt"]
+
+
+# 0) MASK of the bias corrected dwi using MRtrix command dwi2mask (for SSST, SS3T and SS2T)
+     # input: subject directory of the bias corrected mif image
+     # functionality: the mask of the CSD and mtnormalise, created for every subject, also when the Groupmean already exists
+     # output: mask.mif
+def create_dwi_mask(base_dir, subj, configurations):
+    dti_dir = subject_dir(base_dir, subj) + "/processing/dti"
+    call_atomic(["dwi2mask", dti_dir + "/biascorr.mif", dti_dir + "/mask.mif"] + mrtrix_nthreads(), [dti_dir + "/mask.mif"])
+    call(["chmod", "a+rwx", dti_dir + "/mask.mif"])
+
+
+# 1) RESPONSE FUNCTION ESTIMATION
+def estimate_response(base_dir, subj, configurations):
+    script_directory = sys.path[0]
+    call([script_directory + "/pipe_helpers/rfe.sh", subject_dir(base_dir, subj), configurations["rfe"], configurations["pipe_kind"], subj, script_directory])
+
+
+# 2) CSD computation
+  # input: 1) subject directory, 2) rfe, 3) pipe kind
+  # functionality: creates FOD
+  # output: FOD
+def compute_fod(base_dir, subj, configurations):
+    call(["./pipe_helpers/csd_total_CS5.sh", subject_dir(base_dir, subj), configurations["rfe"], configurations["pipe_kind"]], cwd=sys.path[0])
+
+
+# 3.a) FOD NORMALISATION and TRACTOGRAM CREATION using tractograms_SSST_I.sh, tractograms_SSMT.sh resp. tractograms_SSMT_topup.sh
+       # input: 1) subject directory, 2) number of tracts for the tractogram (as string)
+       # functionality: normalises the FOD(s), creates GMWM-seeding mask, creates ACT with backtrack option
+       # output: tractogram
+def generate_tracks(base_dir, subj, configurations):
+    data_dir = subject_dir(base_dir, subj)
+    rfe = configurations["rfe"]
+    n_tract = configurations["streamlinesACT"] # number of tracts for the tractogram
+    if rfe == "SSST":
+        command = [sys.path[0] + "/pipe_helpers/tractograms_SSST_I.sh", data_dir, n_tract, configurations["seeding"]] # bash script needs two inpusts: directory and number of tracts to be created as string
+    elif rfe == "SS3T":
+        command = [sys.path[0] + "/pipe_helpers/tractograms_SSMT.sh", data_dir, n_tract, configurations["seeding"]]
+    else:
+        command = [sys.path[0] + "/pipe_helpers/tractograms_SSMT_topup.sh", data_dir, n_tract, configurations["seeding"], rfe]
+    call(command)
+
+
+# 3.b) FILTERING of tractograms with SIFT or SIFT2
+        # input: 1) subject directory, 2) number of resulting tracts after filtering (as string), 3) original number of total existing tracts (as string)
+        # functionality: Filters the connectome according to Smith et al. to decrease biases
+        # output: filtered tractogram containing as many streamlines as the second input says (eg. sift_1mio.tck) resp. the SIFT2 weights
+SIFT_SCRIPTS = {"sift1": {"SSST": ["sift_filtering_SSST.sh"], "SS3T": ["sift_filtering_SSMT.sh"], "SS2T": ["sift_filtering_SSMT_topup.sh", "SS2T"]},
+                "sift2": {"SSST": ["sift2_filtering_SSST.sh"], "SS3T": ["sift2_filtering_SSMT.sh"], "SS2T": ["sift2_filtering_SSMT_topup.sh", "SS2T"]}}
+
+
+def filter_tracks(base_dir, subj, configurations):
+    script = SIFT_SCRIPTS[configurations["SIFTmeth"]][configurations["rfe"]]
+    n_tract = configurations["streamlinesACT"]
+    n_filt = configurations["streamlinesSIFT"] # resulting number of tracts after filtering
+    call([sys.path[0] + "/pipe_helpers/" + script[0], subject_dir(base_dir, subj), n_filt, n_tract] + script[1:])
+
+
+##############################################
+### PARCELLATION & CONNECTOME CONSTRUCTION ###
+##############################################
+
+def connectome_name(configurations):
+    if configurations["parcellationMethod"] != "none":
+        return configurations["parcellationMethod"]
+    return configurations["parcellationName"]
+
+
+# Parcellation & Registration of Atlas Parcellation to Subject Diffusion Space
+def parcellate_t2(base_dir, subj, configurations):
+    backend("atlas registration")(subject_dir(base_dir, subj), configurations["parcellationMethod"], configurations["parcellation_t2"], configurations["parcellation_labels"])
+
+
+def parcellation_to_dwi(base_dir, subj, configurations):
+    atlas_name = configurations["parcellationMethod"]
+    data_dir = subject_dir(base_dir, subj)
+    connectome_dir = data_dir + "/processing/connectome/" + atlas_name
+    call(["mkdir", "-m777", "-p", connectome_dir])
+    T2_parcellated = data_dir + "/processing/t2/Parcellation/" + atlas_name + "/T2_parcellated_" + atlas_name + ".nii.gz"
+    backend("parcellation to dwi")(data_dir, T2_parcellated, atlas_name, configurations["ageGroup"])
+    if atlas_name == "ENA33_improved":
+        call([sys.path[0] + "/pipe_helpers/corrENA33.sh", base_dir, subj])
+    else:
+        call_atomic(["mrconvert", connectome_dir + "/parcels_" + atlas_name + "_coreg.nii.gz", connectome_dir + "/nodes.mif"], [connectome_dir + "/nodes.mif"])
+        call(["chmod", "a+rwx", connectome_dir + "/nodes.mif"])
+    qc_render.request(configurations, data_dir, "parcels_dwi", [data_dir + "/processing/dti/hifi_nodif_brain.nii.gz", connectome_dir + "/parcels_" + atlas_name + "_coreg.nii.gz"])
+
+
+def provide_parcellation_dir(base_dir, subj, configurations):
+    # here one can add the steps for transformation of Hui's parcellation for MRtrix.
+    # beware that it depends on ENA33 atlas.
+    connectome_dir = subject_dir(base_dir, subj) + "/processing/connectome/" + configurations["parcellationName"]
+    call(["mkdir", "-m777", "-p", connectome_dir])
+    if not os.path.exists(connectome_dir + "/nodes.mif"):
+        print(subj, ": Save the parcellation in the subject diffusion space under /subj/processing/connectome/", configurations["parcellationName"], "as .mif format and call the label image 'nodes.mif'.")
+        return "parcellation provided"
+
+
+###########################
+### Connectome Creation ###
+###########################
+
+def build_connectome(base_dir, subj, configurations):
+    data_dir = subject_dir(base_dir, subj)
+    tract_dir = data_dir + "/processing/tractography/" + TISSUE_DIRS[configurations["rfe"]]
+    connectome_dir = data_dir + "/processing/connectome/" + connectome_name(configurations)
+    n_tract = configurations["streamlinesACT"]
+    call_atomic(["tck2connectome", tract_dir + "/tracks_" + str(int(n_tract)//1000000) + "mio.tck", connectome_dir + "/nodes.mif", connectome_dir + "/connectome.csv", "-tck_weights_in", tract_dir + "/tck2_weights.txt", "-out_assignments", connectome_dir + "/assignments.txt", "-zero_diagonal", "-assignment_radial_search", "4"] + mrtrix_nthreads(),
+                [connectome_dir + "/connectome.csv", connectome_dir + "/assignments.txt"])
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Traces of a pipeline run in the Chrome trace-event format.
+
+Every stage run by stage_graph.py and every external command started with
+tracing.call() (instead of subprocess.call) is recorded with start, duration,
+exit code, CPU time and peak memory (RSS) of the command resp. its child
+processes. At the end of a run the events are written to
+    wor_dir/traces/<run id>/cohort_trace.json      (all subjects, one row per subject)
+    base_dir/subj/processing/trace_<run id>.json   (one subject)
+The files can be opened in chrome://tracing or https://ui.perfetto.dev to see
+where the wall-clock time of a cohort run goes.
+
+The peak memory of a stage (peak_rss_mb) is the largest of the peaks of its
+commands (wait4) and of the worker process during the stage. On Linux the
+high-water mark of the worker is set back to its current RSS when a stage
+begins (/proc/self/clear_refs), so a worker which ran a larger stage before
+(inprocess executor, queue workers) does not pass its old peak on to the next
+stage nor to the commands it starts (a child starts with the mark of its
+parent). Where that is not possible, the peak of the worker only counts if the
+stage raised it; process_peak_rss_mb is then the lifetime value of the worker.
+
+While a stage runs, the events are appended to one file per worker process
+(wor_dir/traces/<run id>/events-<pid>.jsonl), so parallel workers never write
+to the same file. Outside of a traced stage tracing.call() is just subprocess.call().
+
+@author: anna speckert
+"""
+import os
+import sys
+import json
+import time
+import resource
+import subprocess
+
+
+_context = {} # trace directory, subject and stage of the stage running in this process
+
+
+def now_us():
+    return int(time.time() * 1e6)
+
+
+def _exit_code(status):
+    if hasattr(os, "waitstatus_to_exitcode"):
+        return os.waitstatus_to_exitcode(status)
+    return -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+
+def new_run_dir(wor_dir):
+    run_dir = wor_dir + "/traces/" + time.strftime("%Y%m%d_%H%M%S") + "_" + str(os.getpid())
+    os.makedirs(run_dir, exist_ok=True)
+    return run_dir
+
+
+def write_event(event, run_dir=None):
+    run_dir = run_dir or _context.get("run_dir")
+    if run_dir is None:
+        return
+    with open(run_dir + "/events-" + str(os.getpid()) + ".jsonl", "a") as events:
+        events.write(json.dumps(event) + "\n")
+
+
+def reset_peak_rss():
+    # Linux: sets the high-water mark of the resident memory of this process back to its current RSS
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_kb():
+    # high-water mark since the last reset_peak_rss (VmHWM)
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return 0
+
+
+def begin_stage(run_dir, subj, stage_name):
+    """Marks the start of a stage in this (worker) process. Returns the token for end_stage()."""
+    _context.update(run_dir=run_dir, subj=subj, stage=stage_name, commands_peak_kb=0, peak_reset=reset_peak_rss())
+    return (now_us(), resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+
+
+def end_stage(token, result):
+    start, self_before, children_before = token
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (self_after.ru_utime - self_before.ru_utime + self_after.ru_stime - self_before.ru_stime
+           + children_after.ru_utime - children_before.ru_utime + children_after.ru_stime - children_before.ru_stime)
+    if _context["peak_reset"]:
+        process_peak_kb = peak_rss_kb() # peak of the worker during this stage
+    else:
+        # ru_maxrss is a lifetime high-water mark: it only belongs to this stage if the stage raised it
+        process_peak_kb = self_after.ru_maxrss if self_after.ru_maxrss > self_before.ru_maxrss else 0
+    children_peak_kb = children_after.ru_maxrss if children_after.ru_maxrss > children_before.ru_maxrss else 0 # children not started with call()
+    arguments = {"result": "ok" if result is None else str(result), "cpu_seconds": round(cpu, 3),
+                 "peak_rss_mb": round(max(_context["commands_peak_kb"], process_peak_kb, children_peak_kb) / 1024.0, 1)}
+    if not _context["peak_reset"]:
+        arguments["process_peak_rss_mb"] = round(self_after.ru_maxrss / 1024.0, 1) # lifetime of the worker, not of the stage
+    write_event({"name": _context["stage"], "cat": "stage", "ph": "X", "ts": start, "dur": now_us() - start,
+                 "subj": _context["subj"], "tid": os.getpid(), "args": arguments})
+    _context.clear()
+
+
+def call(command, **kwargs):
+    """
+    Drop-in replacement of subprocess.call which records the command in the trace.
+
+    Output:
+        exit code of the command
+    """
+    if "run_dir" not in _context:
+        return subprocess.call(command, **kwargs)
+    start = now_us()
+    process = subprocess.Popen(command, **kwargs)
+    try:
+        _, status, usage = os.wait4(process.pid, 0) # resource usage of exactly this command and its children
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    process.returncode = _exit_code(status)
+    _context["commands_peak_kb"] = max(_context["commands_peak_kb"], usage.ru_maxrss)
+    name = command if isinstance(command, str) else os.path.basename(str(command[0]))
+    write_event({"name": name, "cat": "command", "ph": "X", "ts": start, "dur": now_us() - start,
+                 "subj": _context["subj"], "tid": os.getpid(),
+                 "args": {"command": command if isinstance(command, str) else " ".join(str(part) for part in command),
+                          "stage": _context["stage"], "exit_code": process.returncode,
+                          "cpu_seconds": round(usage.ru_utime + usage.ru_stime, 3),
+                          "peak_rss_mb": round(usage.ru_maxrss / 1024.0, 1)}})
+    return process.returncode
+
+
+def read_events(run_dir):
+    events = []
+    for name in sorted(os.listdir(run_dir)):
+        if name.startswith("events-") and name.endswith(".jsonl"):
+            with open(run_dir + "/" + name) as event_file:
+                events.extend(json.loads(line) for line in event_file if line.strip())
+    return events
+
+
+def _chrome_trace(events, lanes):
+    # Chrome trace: a "process" row per subject, a "thread" row per worker process
+    trace = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": name}} for name, pid in lanes.items()]
+    for event in events:
+        event = dict(event)
+        event["pid"] = lanes[event.pop("subj") or "Group"]
+        trace.append(event)
+    return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+
+def export_traces(run_dir, base_dir, subjects):
+    """Writes the cohort trace and the per-subject traces of a run. Returns the path of the cohort trace."""
+    events = read_events(run_dir)
+    lanes = {"Group": 0}
+    for number, subj in enumerate(subjects):
+        lanes[subj] = number + 1
+    for event in events:
+        lanes.setdefault(event["subj"] or "Group", len(lanes))
+    with open(run_dir + "/cohort_trace.json", "w") as trace_file:
+        json.dump(_chrome_trace(events, lanes), trace_file)
+
+    run_id = os.path.basename(run_dir)
+    for subj in subjects:
+        subject_events = [event for event in events if event["subj"] == subj]
+        if subject_events and os.path.isdir(base_dir + "/" + subj + "/processing"):
+            with open(base_dir + "/" + subj + "/processing/trace_" + run_id + ".json", "w") as trace_file:
+                json.dump(_chrome_trace(subject_events, {subj: 1}), trace_file)
+    print("The trace of this run was written to ", run_dir + "/cohort_trace.json", "(open it in chrome://tracing or ui.perfetto.dev).")
+    return run_dir + "/cohort_trace.json"
+
+
+def summary(run_dir):
+    """Prints the stages which took the most wall-clock time in total."""
+    totals = {}
+    for event in read_events(run_dir):
+        if event["cat"] == "stage":
+            total = totals.setdefault(event["name"], [0, 0.0])
+            total[0] += 1
+            total[1] += event["dur"] / 1e6
+    for name, (count, seconds) in sorted(totals.items(), key=lambda item: -item[1][1]):
+        print("{:<35s} {:4d} x {:10.1f} s".format(name, count, seconds))
+
+
+if __name__ == "__main__":
+    # python pipe_helpers/tracing.py <trace run directory>: prints where the time went
+    summary(sys.argv[1])
@@ -39,13 +39,13 @@ chmod a+rwx ./gmwmSeed_reg.mif > /dev/null 2>&1
 # 3) Create streamlines
 #    Probabilistic tractography with 10 Mio streamlines
 
-tckgen -force -act 5tt_regtodwi.mif -backtrack -seed_gmwmi gmwmSeed_reg.mif -select $num_tracts wmfod_norm.mif tracks_$((num_tracts/1000000))mio.tck
+tckgen -force -act 5tt_regtodwi.mif -backtrack -seed_gmwmi gmwmSeed_reg.mif -select $num_tracts wmfod_norm.mif .partial_$$_tracks_$((num_tracts/1000000))mio.tck && mv .partial_$$_tracks_$((num_tracts/1000000))mio.tck tracks_$((num_tracts/1000000))mio.tck || rm -f .partial_$$_tracks_$((num_tracts/1000000))mio.tck
 chmod a+rwx ./tracks_$((num_tracts/1000000))mio.tck > /dev/null 2>&1
 
 
 elif [[ "$seeding" == "dynamic" ]]; then
 
-tckgen -force -act 5tt_regtodwi.mif -backtrack -seed_dynamic wmfod_norm.mif -select $num_tracts wmfod_norm.mif tracks_$((num_tracts/1000000))mio.tck
+tckgen -force -act 5tt_regtodwi.mif -backtrack -seed_dynamic wmfod_norm.mif -select $num_tracts wmfod_norm.mif .partial_$$_tracks_$((num_tracts/1000000))mio.tck && mv .partial_$$_tracks_$((num_tracts/1000000))mio.tck tracks_$((num_tracts/1000000))mio.tck || rm -f .partial_$$_tracks_$((num_tracts/1000000))mio.tck
 chmod a+rwx ./tracks_$((num_tracts/1000000))mio.tck > /dev/null 2>&1
 
 fi